@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+'''
+Module provides admission control for expensive git processes
+(upload-pack, receive-pack, archive).
+
+A request takes a slot before starting its git process and gives it back
+when the server is done sending the response. Slots are limited in total,
+per repo and per operation class ('upload-pack', 'receive-pack', 'archive'),
+so that a clone storm does not take the slots the browser UI's archives need,
+and the other way around. Requests that do not fit wait in a bounded queue.
+When the queue is full, or the wait is too long, they are refused, and the
+app answers "503 Service Unavailable" with a Retry-After header.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+import multiprocessing
+from collections import deque, defaultdict
+
+from on_close import OnClose
+
+class AdmissionRefused(Exception):
+    '''
+    Raised when there is no slot for the request and it cannot wait for one.
+    retry_after is the number of seconds the client may try again after.
+    '''
+    def __init__(self, message, retry_after):
+        super(AdmissionRefused, self).__init__(message)
+        self.retry_after = retry_after
+
+class Ticket(object):
+    '''A taken slot. release() gives it back. Releasing twice is harmless.'''
+
+    def __init__(self, admission, repo, op_class):
+        self.admission = admission
+        self.repo = repo
+        self.op_class = op_class
+        self.granted = False
+        self.event = threading.Event()
+
+    def release(self):
+        admission, self.admission = self.admission, None
+        if admission is not None:
+            admission._release(self)
+
+    def hold(self, iterable):
+        '''
+        @returns A response iterable passing on the contents of the given one
+            and releasing the slot when the server closes it.
+        '''
+        return OnClose(iterable, self.release)
+
+def _default_total():
+    try:
+        return max(4, 2 * multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 4
+
+class Admission(object):
+    '''
+    Hands out slots for git processes. One instance is meant to be shared
+    by all apps of the server.
+
+    Waiting requests are granted slots in the order they came, except that
+    a request that does not fit (its repo or class is at its limit) does
+    not hold up those behind it that do.
+    '''
+
+    def __init__(self, max_total = None, max_per_repo = None,
+            class_limits = None, max_queue = 64, max_wait = 30, retry_after = 10):
+        '''
+        @param max_total Git processes at once, all repos and classes.
+            Default is twice the number of CPUs, at least 4.
+
+        @param max_per_repo Git processes at once for one repo. Default is
+            half of max_total, at least 1.
+
+        @param class_limits Dict of op class : max at once. Classes not in
+            it are limited only by max_total and max_per_repo. Default gives
+            upload-pack all of max_total, receive-pack and archive half.
+
+        @param max_queue Requests allowed to wait for a slot. Others are
+            refused right away.
+
+        @param max_wait Seconds a request waits before it is refused.
+
+        @param retry_after Seconds, suggested to refused clients.
+        '''
+        if max_total is None:
+            max_total = _default_total()
+        if max_per_repo is None:
+            max_per_repo = max(1, max_total // 2)
+        if class_limits is None:
+            class_limits = {
+                'upload-pack': max_total,
+                'receive-pack': max(1, max_total // 2),
+                'archive': max(1, max_total // 2)
+                }
+        self.max_total = max_total
+        self.max_per_repo = max_per_repo
+        self.class_limits = class_limits
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        self.running = 0
+        self._per_repo = defaultdict(int)
+        self._per_class = defaultdict(int)
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.queued = 0
+        self.refused = 0
+        self.timed_out = 0
+        self.max_depth = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _fits(self, repo, op_class):
+        '''Lock must be held.'''
+        return self.running < self.max_total \
+            and self._per_repo[repo] < self.max_per_repo \
+            and self._per_class[op_class] < self.class_limits.get(op_class, self.max_total)
+
+    def _take(self, ticket):
+        '''Lock must be held.'''
+        self.running += 1
+        self._per_repo[ticket.repo] += 1
+        self._per_class[ticket.op_class] += 1
+        self.admitted += 1
+        ticket.granted = True
+
+    def acquire(self, repo, op_class):
+        '''
+        Takes a slot, waiting for one if need be.
+
+        @param repo Path of the repo the process runs in.
+
+        @param op_class Like 'upload-pack', 'receive-pack', 'archive'
+
+        @returns Ticket. Call its release(), or hold() the response with it.
+
+        @raises AdmissionRefused
+        '''
+        ticket = Ticket(self, repo, op_class)
+        self._lock.acquire()
+        try:
+            if not self._queue and self._fits(repo, op_class):
+                self._take(ticket)
+                return ticket
+            if len(self._queue) >= self.max_queue:
+                self.refused += 1
+                raise AdmissionRefused(
+                    'Too many git processes waiting to start.', self.retry_after)
+            self._queue.append(ticket)
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+        finally:
+            self._lock.release()
+
+        _start = time.time()
+        ticket.event.wait(self.max_wait)
+        _waited = time.time() - _start
+        self._lock.acquire()
+        try:
+            self.wait_seconds += _waited
+            self.max_wait_seconds = max(self.max_wait_seconds, _waited)
+            if ticket.granted:
+                return ticket
+            self._queue.remove(ticket)
+            self.timed_out += 1
+            self.refused += 1
+        finally:
+            self._lock.release()
+        raise AdmissionRefused(
+            'Waited %.1f seconds for git process slot.' % _waited, self.retry_after)
+
+    def _release(self, ticket):
+        self._lock.acquire()
+        try:
+            self.running -= 1
+            for _d, _k in [(self._per_repo, ticket.repo), (self._per_class, ticket.op_class)]:
+                _d[_k] -= 1
+                if not _d[_k]:
+                    del _d[_k]
+            for waiting in list(self._queue):
+                if self.running >= self.max_total:
+                    break
+                if self._fits(waiting.repo, waiting.op_class):
+                    self._queue.remove(waiting)
+                    self._take(waiting)
+                    waiting.event.set()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        @returns dict with keys: running, queue_depth, max_queue_depth,
+            admitted, queued, refused, timed_out, wait_seconds (total of all
+            waits), max_wait_seconds, per_class (dict of class : running)
+        '''
+        self._lock.acquire()
+        try:
+            return {
+                'running': self.running,
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self.max_depth,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'refused': self.refused,
+                'timed_out': self.timed_out,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'per_class': dict(self._per_class)
+                }
+        finally:
+            self._lock.release()
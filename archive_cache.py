@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+class ArchiveCache(object):
+    '''On-disk cache of generated repo folder archives (zip, tar etc.)
+
+    An archive of a git tree never changes. Once made, it can be served from
+    disk for as long as we can afford to keep it. Archives are keyed by
+    (repo path, commit id, tree id, format, prefix) and evicted, least
+    recently used first, when total size of the cache goes over max_bytes.
+
+    Archives are written to the cache as they are being sent to the first
+    client that asked (see fill()). Only completely written archives ever
+    show up in the cache.
+    '''
+
+    def __init__(self, path, max_bytes = 1024 * 1024 * 1024):
+        '''
+        @param path Folder to keep archives in. Created if missing. Files
+            already there (from earlier runs) are reused.
+
+        @param max_bytes Total size of archives to keep, in bytes.
+        '''
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # name : size
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        _found = []
+        for name in os.listdir(self.path):
+            _f = os.path.join(self.path, name)
+            if name.startswith('tmp'):
+                # left over from a run that was killed mid-write.
+                try:
+                    os.remove(_f)
+                except OSError:
+                    pass
+                continue
+            try:
+                _s = os.stat(_f)
+            except OSError:
+                continue
+            _found.append((_s.st_atime, name, _s.st_size))
+        # oldest first, as that is the order we evict in.
+        for _atime, name, size in sorted(_found):
+            self._entries[name] = size
+            self.bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(repo_path, commit_id, tree_id, format, prefix):
+        '''
+        Returns the name of the cache file for the archive.
+
+        Commit id is part of the key as git puts it, and the commit's time,
+        into the archive. Two commits with the same tree give two archives.
+        '''
+        _k = u'\0'.join([repo_path, commit_id, tree_id, format, prefix])
+        return '%s.%s' % (hashlib.sha1(_k.encode('utf8')).hexdigest(), format)
+
+    def get(self, key):
+        '''
+        @param key String returned by key().
+
+        @returns An open (binary, read) file object or None if the archive
+            is not in the cache.
+        '''
+        self._lock.acquire()
+        try:
+            size = self._entries.pop(key, None)
+            if size is None:
+                self.misses += 1
+                return None
+            # re-inserting moves the entry to the "most recently used" end.
+            self._entries[key] = size
+            self.hits += 1
+        finally:
+            self._lock.release()
+        _f = os.path.join(self.path, key)
+        try:
+            # atime is what we sort by on restart. Many mounts don't keep it.
+            os.utime(_f, None)
+            return open(_f, 'rb')
+        except (IOError, OSError):
+            # someone removed it from under us.
+            self._forget(key)
+            return None
+
+    def fill(self, key, iterable):
+        '''
+        Wraps an iterable yielding archive's contents into one that yields the
+        same, while also writing it into the cache. The archive is added to
+        the cache only if the iterable is consumed completely.
+
+        @returns An iterable usable as a WSGI response.
+        '''
+        return CacheFiller(self, key, iterable)
+
+    def _add(self, key, temp_name):
+        _f = os.path.join(self.path, key)
+        size = os.path.getsize(temp_name)
+        if size > self.max_bytes:
+            os.remove(temp_name)
+            return
+        os.rename(temp_name, _f)
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old
+            self._entries[key] = size
+            self.bytes += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _forget(self, key):
+        self._lock.acquire()
+        try:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self.bytes -= size
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        '''Removes least recently used archives until we fit. Lock must be held.'''
+        while self.bytes > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last = False)
+            self.bytes -= size
+            try:
+                # open file handles on POSIX keep serving removed files.
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        '''
+        @returns dict with keys: hits, misses, entries, bytes, max_bytes
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes
+            }
+
+class CacheFiller(object):
+    '''
+    Iterable passing through chunks of an archive while also writing them to
+    a temp file in the cache folder. On the last chunk the temp file becomes
+    a cache entry. If the client goes away early, the temp file is removed.
+    '''
+
+    def __init__(self, cache, key, iterable):
+        self.cache = cache
+        self.key = key
+        self.source = iterable
+        if hasattr(iterable, 'read'):
+            self.iterator = iter(lambda: iterable.read(65536), '')
+        else:
+            self.iterator = iter(iterable)
+        _fd, self.temp_name = tempfile.mkstemp(prefix = 'tmp', dir = cache.path)
+        self.temp_file = os.fdopen(_fd, 'wb')
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            chunk = self.iterator.next()
+        except StopIteration:
+            self._finish(True)
+            raise
+        except:
+            self._finish(False)
+            raise
+        self.temp_file.write(chunk)
+        return chunk
+
+    def _finish(self, complete):
+        if self.temp_file is None:
+            return
+        self.temp_file.close()
+        self.temp_file = None
+        try:
+            if complete:
+                self.cache._add(self.key, self.temp_name)
+            else:
+                os.remove(self.temp_name)
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        # WSGI server calls this when done, completely or not.
+        self._finish(False)
+        if hasattr(self.source, 'close'):
+            self.source.close()
@@ -19,7 +19,15 @@ along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licen
 '''
 import io
 import os
+import sys
+import subprocess
 import git
+import subprocessio
+import spawner
+import archive_cache
+import admission
+import response_compression
+from repo_index import get_index
 from wsgiref.headers import Headers
 import urllib
 
@@ -62,7 +70,9 @@ class BaseWSGIClass(object):
         'execution_failed':'417 Execution failed',
         '200': "200 OK",
         '501': "501 Not Implemented",
-        'not_implemented': "501 Not Implemented"
+        'not_implemented': "501 Not Implemented",
+        '503': "503 Service Unavailable",
+        'busy': "503 Service Unavailable"
     }
 
     def canned_handlers(self, environ, start_response, code = '200', headers = []):
@@ -95,6 +105,9 @@ class BaseWSGIClass(object):
         elif hasattr(outIO,'read'):
             outIO.seek(0)
             retobj = iter( lambda: outIO.read(self.bufsize), '' )
+        if self.gzip_response:
+            return response_compression.compress_response(
+                environ, start_response, "200 OK", headers, retobj)
         start_response("200 OK", headers)
         return retobj
 
@@ -112,16 +125,76 @@ class FuzzyPathHandler(BaseWSGIClass):
     #file:
     # - sanitize the path.
     #
+    stream_archives = True
+    # format : (mimetype, media types in Accept header that select the format)
+    archive_formats = {
+        'zip': ('application/zip', ['application/zip', 'application/x-zip-compressed']),
+        'tar': ('application/x-tar', ['application/x-tar']),
+        'tar.gz': ('application/gzip', ['application/gzip', 'application/x-gzip', 'application/x-tgz']),
+        'tar.zst': ('application/zstd', ['application/zstd'])
+        }
+    default_archive_format = 'zip'
+    # format : command git pipes tar through to compress it (tar.<format>.command)
+    # git compresses tar.gz on its own if no command is set for it.
+    archive_filters = {
+        'tar.zst': 'zstd -c -q'
+        }
+
     def __init__(self, **kw):
         '''
         Inputs:
             content_path (mandatory)
                 String containing a file-system level path behaving as served root.
+
+            archive_cache_path (optional)
+                Folder where zip archives of repo folders are kept, so that
+                same folder of same commit is archived only once.
+                No caching if None (default).
+
+            archive_cache_max_bytes (optional)
+                Max total size of cached archives. Defaults to 1GB.
+
+            archive_filters (optional)
+                Dictionary of archive format : compressor command, like
+                {'tar.gz':'pigz -cn -1', 'tar.zst':'zstd -c -q -1 -T0'}
+                Commands read tar on stdin and write to stdout. Use faster
+                settings for internal mirrors, denser ones for the public.
+
+            stream_archives (optional)
+                If True (default), zip archives of repo folders are sent to
+                the client as `git archive` makes them. If False, archives
+                are made in a temp file first and sent when complete.
+
+            repo_index (optional)
+                repo_index.RepoIndex instance for content_path. Shared,
+                process-wide one is used by default.
+
+            admission (optional)
+                admission.Admission instance limiting `git archive`
+                processes. No limits if None (default).
         '''
         self.__dict__.update(kw)
+        self.admission = kw.get('admission')
         self.base_path = os.path.abspath(kw['content_path'])
         self.base_path_len = len(self.base_path)
         self.git_folder_signature = set(['head', 'info', 'objects', 'refs'])
+        if not kw.get('repo_index'):
+            self.repo_index = get_index(self.base_path)
+        self.archive_filters = dict(
+            FuzzyPathHandler.archive_filters,
+            **(kw.get('archive_filters') or {})
+            )
+        # formats are offered only if their compressor is installed.
+        self.archive_formats = dict([
+            (_format, _types) for _format, _types in self.archive_formats.items()
+            if self._filter_found(self.archive_filters.get(_format))
+            ])
+        self.archive_cache = None
+        if kw.get('archive_cache_path'):
+            self.archive_cache = archive_cache.ArchiveCache(
+                kw['archive_cache_path'],
+                kw.get('archive_cache_max_bytes') or 1024 * 1024 * 1024
+                )
 
     def _sanitize_path(self, relative_path):
         '''Takes a relative path and cleans it and evaluates it against base path.
@@ -188,34 +261,15 @@ class FuzzyPathHandler(BaseWSGIClass):
         '''
         # we expect completely sanitized paths here.
         # this means no leading slashes, dirs are separated by unix-like slash /
-        repo_path = None
-        _path_chain = relative_path.split('/')
-        if _path_chain[0] != '':
-            # because we don't get leading slash, on non-root paths we don't
-            # get a reference to the root - '' - in the array. Inserting:
-            _path_chain.insert(0, '')
-        _p = self.base_path
-        while _path_chain:
-            _p = os.path.join(_p,_path_chain.pop(0))
-            _d = os.path.isdir(_p)
-            if _d and self.git_folder_signature.issubset([i.lower() for i in os.listdir(_p)]):
-                repo_path = _p
-                break
-            elif not _d:
-                # it's not a folder. Likely a shortcut or a file. Either way,
-                # it's not what we need or can work with .
-                # intentionally interrupting the "while" to signal that remaining
-                # section of path does not point to a real file system path.
-                _path_chain.insert(0,os.path.split(_p)[1])
-                break
-        del _d, _p
-        return repo_path, '/'.join(_path_chain)
+        # The index knows which folders are repos. No listing of folders here.
+        return self.repo_index.find_repo_in_path(relative_path)
 
     ################
     # Git repo-specific discovery methods.
     ################
 
-    def _get_repo_item_contents(self, repo_path, commit_name, obj_path = ''):
+    def _get_repo_item_contents(self, repo_path, commit_name, obj_path = '', if_none_match = None,
+            archive_format = None, folders_only = False):
         '''Returns contents of tree or file for a commit (Commit ID, Tag or Branch name)
 
         @param repo_path A relative file-system path to repo folder against
@@ -226,10 +280,25 @@ class FuzzyPathHandler(BaseWSGIClass):
         @param obj_path A string (or None) with virtual path to a file or folder
             within the repo.
 
-        @returns (type, data) A tuple of:
-            type A string containing the name of object type.
-                (Possible values: 'repo', 'repofolder', 'repoitem', None)
-            data A JSON-compatible list or dictionary with object-type-specific data.
+        @param if_none_match Value of If-None-Match header, if any. If the ETag
+            of the object matches it, contents are not produced.
+
+        @param archive_format A key from self.archive_formats. Format in
+            which folders are served. Defaults to self.default_archive_format.
+
+        @param folders_only If True, paths pointing to files are reported as
+            not found.
+
+        @returns (data, mimetype, size, file_name, etag) A tuple of:
+            data A file-like or iterable with contents. None if etag matched
+                if_none_match.
+            mimetype A string.
+            size An int, size in bytes, or None if not known ahead of time.
+            file_name A string with recommended file name.
+            etag A string. Git objects never change. Object's id is its ETag.
+                For folders, it is the commit's id, the tree's id and the
+                archive format, as the archive carries the commit's id and
+                time.
         '''
         _r = git.Repo(
             os.path.join(
@@ -241,7 +310,8 @@ class FuzzyPathHandler(BaseWSGIClass):
         # since gitpython is a wrapper for command line git, this may be scary.
         # Put in the code to sanitize commit_name.
         try:
-            _t = _r.commit(commit_name).tree
+            _c = _r.commit(commit_name)
+            _t = _c.tree
         except:
             raise PathUnfitError(
                 'Requested object "%s" is not found in the repository %s.' % (
@@ -260,13 +330,44 @@ class FuzzyPathHandler(BaseWSGIClass):
                             ,os.path.join(self.base_path,repo_path)
                             )
                         )
+        if type(_t) == git.Blob and folders_only:
+            raise PathUnfitError(
+                'Requested object "%s" is not a folder.' % '/'.join([commit_name,obj_path])
+                )
+        archive_format = archive_format or self.default_archive_format
+        if type(_t) == git.Tree:
+            _etag = '"%s.%s.%s"' % (_c.id, _t.id, archive_format)
+        else:
+            _etag = '"%s"' % _t.id
+        _not_modified = bool(if_none_match) and (if_none_match == '*' or _etag in if_none_match)
         if type(_t) == git.Blob:
-            # returning: dataIO, mimetype, size, recommended file name.
+            # size comes from the object's header. Cheap, content is not read.
+            _size = _t.size
+            if _not_modified:
+                _data = None
+            elif _size <= self.bufsize:
+                # small ones are likely in the object cache already.
+                _data = io.BytesIO(_t.data)
+            else:
+                # large ones are streamed from git, buffer-full at a time.
+                try:
+                    _data = subprocessio.SubprocessIOChunker(
+                        [git.utils.git_executable(), '--git-dir=%s' % _r.path, 'cat-file', 'blob', _t.id],
+                        buffer_size = self.bufsize
+                        )
+                except (EnvironmentError) as e:
+                    raise PathUnfitError(
+                        'Requested object "%s" cannot be read. %s' % (
+                            '/'.join([commit_name,obj_path])
+                            , e
+                            )
+                        )
             return (
-                    io.BytesIO(_t.data)
+                    _data
                     ,mimetypes.guess_type(obj_path, False)[0] or 'application/octet-stream'
-                    ,len(_t.data)
+                    ,_size
                     ,os.path.split(obj_path)[1]
+                    ,_etag
                     )
         elif type(_t) == git.Tree:
             _trash, _p = os.path.split(repo_path)
@@ -274,49 +375,29 @@ class FuzzyPathHandler(BaseWSGIClass):
                 name_elements = [_p, commit_name]
             else:
                 name_elements = [commit_name]
-            # the tempfile use is a bit of trickery.
-            # we need temp file because it self-destructs when .close()
-            # yet, we need git command like to write to it from outside of python.
-            # what we do is create the temp file, get name, ask
-            # git to put data into that file name in the back
-            # When we read() we read from start of what used to be empty file.
-            # If git is successful there will be data in it.
-            # If zip download stops working, then either the underlying
-            # python interpreter is weird (IronPython, Jython) or
-            # the tempfile implemnetation had changed to cache the "empty"
-            # state of the temp file.
-            _tf = tempfile.NamedTemporaryFile(
-                suffix = '_%s.zip' % '_'.join(name_elements)
-                , delete = True
-                )
-            try:
-                _trash = git.Repo(
-                    os.path.join(self.base_path,repo_path)
-                    ).git.archive(
-                        commit_name
-                        ,obj_path
-                        ,output = _tf.name
-                        ,format = "zip"
-                        ,prefix = "%s/" % '/'.join(name_elements)
-                        )
-                _tf.seek(0) # this is just in case the TF wrapper cached position / old data.
-            except:
-                raise PathUnfitError(
-                            'Requested object "%s" cannot be served in zip format.' % (
-                                '/'.join(name_elements)
-                                )
+            _prefix = "%s/" % '/'.join(name_elements)
+            _file_name = '%s.%s' % ('_'.join(name_elements), archive_format)
+            _mimetype = self.archive_formats[archive_format][0]
+            if _not_modified:
+                return (None, _mimetype, None, _file_name, _etag)
+            if self.archive_cache:
+                _key = self.archive_cache.key(_r.path, _c.id, _t.id, archive_format, _prefix)
+                _f = self.archive_cache.get(_key)
+                if _f:
+                    return (
+                            _f
+                            , _mimetype
+                            , os.fstat(_f.fileno()).st_size
+                            , _file_name
+                            , _etag
                             )
-            # returning:
-            #   data_IO_obj,
-            #   mimetype,
-            #   size in bytes. None for size is OK. We send Chunked.
-            #   recommended file name.
-            return (
-                    _tf
-                    , 'application/zip'
-                    , None
-                    , '%s.zip' % '_'.join(name_elements)
-                    )
+            _data = self._make_archive(
+                _r, _c.id, obj_path.strip('/'), _prefix, name_elements, archive_format
+                )
+            if self.archive_cache:
+                _data = self.archive_cache.fill(_key, _data)
+            # size is unknown. We send Chunked.
+            return (_data, _mimetype, None, _file_name, _etag)
         else:
             raise PathUnfitError(
                         'Requested object "%s" cannot be served in raw format.' % (
@@ -324,12 +405,124 @@ class FuzzyPathHandler(BaseWSGIClass):
                             )
                         )
 
-    def _get_path_contents(self,relative_path):
+    def _make_archive(self, repo, commit_id, obj_path, prefix, name_elements, archive_format = 'zip'):
+        '''Runs `git archive` for a folder in a commit.
+
+        Compression (other than zip's) is done by git, or by the filter command
+        set for the format in self.archive_filters, as the archive is being
+        written. Nothing is held in memory here.
+
+        @returns A file-like or iterable with contents of the archive.
+        '''
+        _cmd = [git.utils.git_executable(), '--git-dir=%s' % repo.path]
+        _filter = self.archive_filters.get(archive_format)
+        if _filter:
+            _cmd.extend(['-c', 'tar.%s.command=%s' % (archive_format, _filter)])
+        # Commit's id, not the name we got, goes to git. Names may
+        # start with "-" and pass for options.
+        _cmd.extend(['archive', '--format=%s' % archive_format
+            , '--prefix=%s' % prefix, commit_id, '--'])
+        if obj_path:
+            _cmd.append(obj_path)
+        _error = PathUnfitError(
+            'Requested object "%s" cannot be served in %s format.' % (
+                '/'.join(name_elements)
+                , archive_format
+                )
+            )
+        # raises admission.AdmissionRefused if busy.
+        _ticket = self.admission and self.admission.acquire(repo.path, 'archive')
+        if self.stream_archives:
+            # git writes the archive, we pass it on as it is being written.
+            try:
+                _out = subprocessio.SubprocessIOChunker(
+                    _cmd,
+                    buffer_size = self.bufsize
+                    )
+            except (EnvironmentError) as e:
+                if _ticket:
+                    _ticket.release()
+                raise _error
+            if _ticket:
+                # slot is taken until the archive is sent.
+                return _ticket.hold(_out)
+            return _out
+        # Archive is written to a temp file, which is sent when complete.
+        # Temp file self-destructs on .close()
+        _tf = tempfile.TemporaryFile(
+            suffix = '_%s.%s' % ('_'.join(name_elements), archive_format)
+            )
+        try:
+            # through the fork server, if started. See spawner.start()
+            _p = spawner.popen(_cmd, stdout = _tf, stderr = subprocess.PIPE)
+            # stdout goes to the file. Reading stderr to its end cannot
+            # hold git up.
+            _p.stderr.read()
+            _p.stderr.close()
+            if _p.wait():
+                raise _error
+            _tf.seek(0)
+        except:
+            _tf.close()
+            raise _error
+        finally:
+            if _ticket:
+                _ticket.release()
+        return _tf
+
+    @staticmethod
+    def _filter_found(command):
+        '''True if there is no filter command or its program is on PATH.'''
+        if not command:
+            return True
+        _program = command.split()[0]
+        _names = [_program]
+        if sys.platform == 'win32' and not os.path.splitext(_program)[1]:
+            _names = [_program + '.exe', _program + '.cmd']
+        return git.utils.find_executable(*_names) is not None
+
+    def _archive_format_from_accept(self, accept):
+        '''Picks archive format by the value of Accept header.
+
+        @returns A key from self.archive_formats, or None if none of the
+            formats is mentioned in the header.
+        '''
+        for _e in (accept or '').split(','):
+            _e = _e.split(';')
+            _type = _e[0].strip().lower()
+            if [_q for _q in _e[1:] if _q.replace(' ','') in ('q=0', 'q=0.0')]:
+                continue
+            for _format, (_mimetype, _accepted) in self.archive_formats.items():
+                if _type in _accepted:
+                    return _format
+        return None
+
+    def _split_archive_suffix(self, name):
+        '''Splits "folder.tar.gz" into ("folder", "tar.gz")
+
+        @returns A tuple (name, format) or None if name does not end with
+            an archive format's suffix.
+        '''
+        # longest first, so that "tar.gz" wins over "gz"-like ones.
+        for _format in sorted(self.archive_formats, key = len, reverse = True):
+            _suffix = '.' + _format
+            if name.endswith(_suffix) and len(name) > len(_suffix):
+                return name[:-len(_suffix)], _format
+        return None
+
+    def _get_path_contents(self, relative_path, if_none_match = None, accept = None):
         '''Takes a relative path, sanitizes and returns adequate
         summary about the path, if viewing that is allowed.
 
         @param relative_path A string like "qwer/asdf/zvcv"
 
+        @param if_none_match Value of If-None-Match header, if any.
+
+        @param accept Value of Accept header, if any. Picks the archive format
+            for folders, unless the path ends with format's suffix.
+
+        @returns See _get_repo_item_contents
+
         Design notes (may become stale with time):
         # now, we need to figure out what the path represents. Choices:
         # 1. Physical path to folder
@@ -393,13 +586,32 @@ class FuzzyPathHandler(BaseWSGIClass):
             # means we need to pick default commit.
             _unconsumed_path = 'HEAD'
         _vpath = _unconsumed_path.strip('/').split('/',1)
-        if len(_vpath) == 2:
-            # point to commit + object within a commit.
-            # returning : dataIOobj, _mimetype, size_in_bytes
-            return self._get_repo_item_contents(_repo_path, _vpath[0], _vpath[1])
-        else:
-            # points to commit's root tree.
-            return self._get_repo_item_contents(_repo_path, _vpath[0])
+        # either commit + object within a commit or commit's root tree.
+        _commit_name = _vpath[0]
+        _obj_path = len(_vpath) == 2 and _vpath[1].strip('/') or ''
+        try:
+            return self._get_repo_item_contents(
+                _repo_path, _commit_name, _obj_path, if_none_match,
+                self._archive_format_from_accept(accept)
+                )
+        except PathUnfitError:
+            # "folder.tar.gz" is not there. Maybe it's "folder" as tar.gz.
+            # (Only checked after a miss. Real files named so win.)
+            if _obj_path:
+                _head, _tail = (['']+_obj_path.rsplit('/',1))[-2:]
+                _split = self._split_archive_suffix(_tail)
+                if not _split:
+                    raise
+                _obj_path = '/'.join([_e for _e in [_head, _split[0]] if _e])
+            else:
+                _split = self._split_archive_suffix(_commit_name)
+                if not _split:
+                    raise
+                _commit_name = _split[0]
+            return self._get_repo_item_contents(
+                _repo_path, _commit_name, _obj_path, if_none_match,
+                _split[1], folders_only = True
+                )
 
     def __call__(self, environ, start_response):
         selector_matches = (environ.get('wsgiorg.routing_args') or ([],{}))[1]
@@ -418,15 +630,21 @@ class FuzzyPathHandler(BaseWSGIClass):
             return self.canned_handlers(environ, start_response, 'forbidden')
         _p = full_path[len(_pp):].strip('/\\')
 
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
         try:
-            file_like, _mimetype, _size, _file_name = self._get_path_contents(_p)
+            file_like, _mimetype, _size, _file_name, etag = self._get_path_contents(
+                _p, if_none, environ.get('HTTP_ACCEPT')
+                )
+        except admission.AdmissionRefused as e:
+            return self.canned_handlers(environ, start_response, 'busy',
+                [('Retry-After', str(e.retry_after))])
         except:
             return self.canned_handlers(environ, start_response, '404')
 
-        # TODO: wire up the time to commit. Until then, there will be no caching
-        #  on web client. Ugh!
+        # TODO: wire up the time to commit. Until then, only ETag-based
+        #  caching works on web client.
         mtime = time.time()
-        etag, last_modified =  str(mtime), email.utils.formatdate(mtime)
+        last_modified = email.utils.formatdate(mtime)
         headers = [
             ('Content-type', 'text/plain')
             ,('Date', email.utils.formatdate(time.time()))
@@ -437,13 +655,16 @@ class FuzzyPathHandler(BaseWSGIClass):
         if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
         if if_modified and (email.utils.parsedate(if_modified) >= email.utils.parsedate(last_modified)):
             return self.canned_handlers(environ, start_response, 'not_modified', headers)
-        if_none = environ.get('HTTP_IF_NONE_MATCH')
-        if if_none and (if_none == '*' or etag in if_none):
+        if file_like is None:
+            # ETag matched. Contents were not even produced.
             return self.canned_handlers(environ, start_response, 'not_modified', headers)
 
         if _size != None:
             headersIface['Content-Length'] = str(_size)
         headersIface['Content-Type'] = _mimetype
+        if _mimetype in [_f[0] for _f in self.archive_formats.values()]:
+            # same folder URL gives different archives for different Accept
+            headersIface['Vary'] = 'Accept'
         if _file_name:
             # See:
             #  RFC5987
@@ -20,12 +20,57 @@ along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licen
 import os.path
 import os
 import sys
+import re
 
 import git_http_backend
 import jsonrpc_wsgi_application as jrpc
 import ges_rpc_methods
 import fuzzy_path_handler
 import serve_index_file
+import repo_index
+import admission
+import spawner
+import request_trace
+import metrics
+import subprocessio
+import git.cache
+
+def _watch(options, git_rpc_handler, fuzzy_handler):
+    '''Adds what the apps and shared parts keep count of to metrics.registry.'''
+    _caches = {'object': git.cache.object_cache}
+    if git_rpc_handler.pack_cache:
+        _caches['pack'] = git_rpc_handler.pack_cache
+    if fuzzy_handler.archive_cache:
+        _caches['archive'] = fuzzy_handler.archive_cache
+    metrics.registry.watch_caches(_caches)
+
+    _admission = options['admission']
+    metrics.registry.collect('ges_admission_running', 'gauge',
+        'Git processes holding an admission slot, by class.',
+        lambda: dict([((('class', _k),), _v) for _k, _v in _admission.stats()['per_class'].items()]))
+    metrics.registry.collect('ges_admission_queue', 'gauge',
+        'Requests waiting for an admission slot.',
+        lambda: _admission.stats()['queue_depth'])
+    metrics.registry.collect('ges_admission_refused_total', 'counter',
+        'Requests refused a slot (503).',
+        lambda: _admission.stats()['refused'])
+
+    def _buffers():
+        _s = subprocessio.buffer_stats()
+        return {
+            (('where', 'memory'),): _s['memory_bytes'],
+            (('where', 'disk'),): _s['spilled_bytes']
+            }
+    metrics.registry.collect('ges_subprocess_buffer_bytes', 'gauge',
+        'Subprocess output read and not yet sent.', _buffers)
+    metrics.registry.collect('ges_subprocess_chunkers', 'gauge',
+        'Open SubprocessIOChunkers.', lambda: subprocessio.buffer_stats()['chunkers'])
+
+    _post_push = git_rpc_handler.post_push
+    metrics.registry.collect('ges_post_push_pending', 'gauge',
+        'Repos waiting for post-push hooks.', lambda: _post_push.stats()['pending'])
+    metrics.registry.collect('ges_post_push_failures_total', 'counter',
+        'Post-push hooks that failed.', lambda: _post_push.stats()['failures'])
 
 def assemble_ges_app(*args, **kw):
     '''
@@ -53,6 +98,29 @@ def assemble_ges_app(*args, **kw):
         Default of '' means that no cutting marker is used, and whole URI after FQDN is
         used to find file relative to path_prefix.
 
+    gzip_response (Defaults to True)
+        Compress text, JSON-RPC and ref advert responses for clients that
+        accept it. Packs and archives are never compressed.
+
+    admission (Defaults to admission.Admission() with default limits)
+        Limits git upload-pack, receive-pack and archive processes running
+        at once. Requests over the limits wait, or get a 503.
+
+    use_spawner (Defaults to True)
+        Start git processes from a small helper process (see spawner.py),
+        not by forking this, potentially huge, one. Started here, so
+        assemble the app early, before caches fill up.
+
+    trace_requests (Defaults to True)
+        Time the git processes each request starts. Adds a Server-Timing
+        header and logs a JSON line per request to the "ges.trace" logger
+        (see request_trace.py). Logged to the console in devel mode.
+
+    metrics_path (Defaults to '/metrics')
+        Route (after uri_marker) serving counters of requests, git processes,
+        buffers and caches in the Prometheus text format (see metrics.py).
+        Shadows a repo folder of the same name. '' turns metrics off.
+
     returns WSGI application instance.
     '''
 
@@ -64,6 +132,9 @@ def assemble_ges_app(*args, **kw):
     options = dict(default_options)
     options.update(kw)
 
+    if options.get('use_spawner', True):
+        spawner.start()
+
     # this unfolds args into options in order of default_options
     args = list(args) # need this to allow .pop method on it.
     while default_options and args:
@@ -73,30 +144,58 @@ def assemble_ges_app(*args, **kw):
     for _e in ['content_path','static_content_path']:
         options[_e] = os.path.abspath(options[_e].decode('utf8'))
     options['uri_marker'] = options['uri_marker'].decode('utf8')
+    options.setdefault('gzip_response', True)
     if not os.path.isfile(os.path.join(options['static_content_path'],'favicon.ico')):
         raise Exception('G.E.S.: Specified static content directory - "%s" - does not contain expected files. Please, provide correct "static_content_path" variable value.' % options['static_content_path'])
 
+    # one index of repo folders under content_path, shared by all apps below.
+    # 'repo_index_watch' = 'rescan' if other hosts write to content_path over
+    # a network file system. See repo_index.RepoIndex.
+    options['repo_index'] = repo_index.get_index(
+        options['content_path'],
+        watch = options.get('repo_index_watch', 'auto')
+        )
+
+    # one set of git process slots, shared by git_http_backend and the
+    # archives of fuzzy_path_handler.
+    if not options.get('admission'):
+        options['admission'] = admission.Admission()
+
     # assembling JSONRPC WSGI app
     # it has two parts:
     #  (a) ges-specific RPC methods that return JSON-compatible objects
     #  (b) generic WSGI JSONRPC wrapper for stuff like (a)
     _methods_list = ges_rpc_methods.assemble_methods_list(
-        options['content_path']
+        options['content_path'],
+        repo_index = options['repo_index']
         )
-    _jsonrpc_app = jrpc.WSGIJSONRPCApplication()
+    _jsonrpc_app = jrpc.WSGIJSONRPCApplication(gzip_response = options['gzip_response'])
     for path, method_pointer in _methods_list:
         _jsonrpc_app.add_method(path, method_pointer)
 
     _serve_index_file = serve_index_file.ServeIndexFile(**options)
 
     # assembling static file server WSGI app
-    _static_server_app = git_http_backend.StaticWSGIServer(content_path = options['static_content_path'])
+    _static_server_app = git_http_backend.StaticWSGIServer(
+        content_path = options['static_content_path'],
+        gzip_response = options['gzip_response'])
 
     # git_http_backend-specific server components.
     git_inforefs_handler = git_http_backend.GitHTTPBackendInfoRefs(**options)
     git_rpc_handler = git_http_backend.GitHTTPBackendSmartHTTP(**options)
     fuzzy_handler = fuzzy_path_handler.FuzzyPathHandler(**options)
 
+    metrics_path = options.get('metrics_path', '/metrics')
+    if metrics_path:
+        _watch(options, git_rpc_handler, fuzzy_handler)
+        # labels requests by route, for metrics.MetricsMiddleware
+        _serve_index_file = metrics.route('index', _serve_index_file)
+        _jsonrpc_app = metrics.route('rpc', _jsonrpc_app)
+        _static_server_app = metrics.route('static', _static_server_app)
+        git_inforefs_handler = metrics.route('info-refs', git_inforefs_handler)
+        git_rpc_handler = metrics.route('git-rpc', git_rpc_handler)
+        fuzzy_handler = metrics.route('browse', fuzzy_handler)
+
     if options['uri_marker']:
         marker_regex = r'(?P<decorative_path>.*?)(?:/'+ options['uri_marker'] + ')'
     else:
@@ -125,12 +224,27 @@ def assemble_ges_app(*args, **kw):
         marker_regex + r'/(?P<working_path>.*)/(?P<git_command>git-[^/]+)$',
         POST = git_rpc_handler
         )
+    if metrics_path:
+        _metrics_app = metrics.route('metrics', metrics.MetricsApp())
+        selector.add(
+            marker_regex + re.escape('/' + metrics_path.strip('/')) + '$',
+            GET = _metrics_app,
+            HEAD = _metrics_app)
     selector.add(
         marker_regex + r'/(?P<working_path>.*)$',
         GET = fuzzy_handler,
         HEAD = fuzzy_handler)
 
+    if options.get('trace_requests', True):
+        selector = request_trace.TraceMiddleware(selector)
+    if metrics_path:
+        selector = metrics.MetricsMiddleware(selector)
+
     if 'devel' in options or 'debug' in options:
+        import logging
+        _trace_log = logging.getLogger(request_trace.LOGNAME)
+        _trace_log.setLevel(logging.INFO)
+        _trace_log.addHandler(logging.StreamHandler())
         import wsgilog
         return wsgilog.WsgiLog(selector, tostream=True, toprint=True)
     return selector
@@ -299,6 +413,7 @@ ges.py --port 80 --content_path '.'
 
         import wsgiserver
         httpd = wsgiserver.CherryPyWSGIServer(('0.0.0.0',int(options['port'])),app)
+        metrics.registry.watch_thread_pool(httpd.requests)
 
         if options['uri_marker']:
             _s = '"/%s/".' % options['uri_marker']
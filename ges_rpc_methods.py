@@ -23,6 +23,7 @@ from collections import defaultdict
 import time
 
 import git
+from repo_index import get_index
 
 class PathBoundsError(Exception):
     pass
@@ -43,10 +44,11 @@ mimetypes.add_type('image/png','.ico')
 
 class BaseRPCClass(object):
 
-    def __init__(self, content_path):
+    def __init__(self, content_path, repo_index=None):
         self.base_path = os.path.abspath(content_path)
         self.base_path_len = len(self.base_path)
         self.git_folder_signature = set(['head', 'info', 'objects', 'refs'])
+        self.repo_index = repo_index or get_index(self.base_path)
         self.text_like_files = ['js','c','cs','cpp','h','php','java',
             'asp','aspx','perl','cgi','sql','xml']
 
@@ -122,28 +124,8 @@ class BaseRPCClass(object):
         '''
         # we expect completely sanitized paths here.
         # this means no leading slashes, dirs are separated by unix-like slash /
-        repo_path = None
-        _path_chain = relative_path.split('/')
-        if _path_chain[0] != '':
-            # because we don't get leading slash, on non-root paths we don't
-            # get a reference to the root - '' - in the array. Inserting:
-            _path_chain.insert(0, '')
-        _p = self.base_path
-        while _path_chain:
-            _p = os.path.join(_p,_path_chain.pop(0))
-            _d = os.path.isdir(_p)
-            if _d and self.git_folder_signature.issubset([i.lower() for i in os.listdir(_p)]):
-                repo_path = _p
-                break
-            elif not _d:
-                # it's not a folder. Likely a shortcut or a file. Either way,
-                # it's not what we need or can work with.
-                # intentionally interrupting the "while" to signal that remaining
-                # section of path does not point to a real file system path.
-                _path_chain.insert(0,os.path.split(_p)[1])
-                break
-        del _d, _p
-        return repo_path, '/'.join(_path_chain)
+        # The index knows which folders are repos. No listing of folders here.
+        return self.repo_index.find_repo_in_path(relative_path)
 
 class PathSummaryProducer(BaseRPCClass):
     '''This class is the mothership for all various functionality
@@ -193,25 +175,23 @@ class PathSummaryProducer(BaseRPCClass):
         # actually refers to an actual file system path and that we are
         # authorized to give an answer.
 
-        _p = os.path.join(
+        _p = os.path.normpath(os.path.join(
             self.base_path,
             relative_path
-            )
+            ))
         dirs = []
-        for name in os.listdir(_p):
-            _s = os.path.join(_p, name)
-            if os.path.isdir(_s):
-                if self.git_folder_signature.issubset([i.lower() for i in os.listdir(_s)]):
-                    dirs.append({
-                        "name":name,
-                        "type":"folder",
-                        "is_repo":True
-                        })
-                else:
-                    dirs.append({
-                        "name":name,
-                        "type":"folder"
-                        })
+        for name, is_repo in self.repo_index.list_dir(_p):
+            if is_repo:
+                dirs.append({
+                    "name":name,
+                    "type":"folder",
+                    "is_repo":True
+                    })
+            else:
+                dirs.append({
+                    "name":name,
+                    "type":"folder"
+                    })
         return dirs
 
     ################
@@ -289,6 +269,9 @@ class PathSummaryProducer(BaseRPCClass):
                 _r[1]['type']['supermimetype'] = 'text' # thus our JavaScript UI renders application/x-* as text
             return _r
         elif type(_t) == git.Tree:
+            # we are about to ask every blob for its size. Getting all of
+            # them with one `ls-tree -l` beats one object lookup per blob.
+            _t.long_listing = True
             items = []
             for _o in _t.values():
                 if type(_o) == git.Blob:
@@ -351,28 +334,27 @@ class PathSummaryProducer(BaseRPCClass):
                 }
             )
 
-        for _e in _r.tags:
-            # Hmm.. Tags have their own commits it seems.
-            # Getting .id from tag gets an commit ID that does not
-            # point to a real commit, at least with git-python lib.
-            # this is a workaround - asking for commit with name of tag
-            # gets us real commit ID.
-            _tag_commit = _r.commit(_e.name)
-            _commit_data = _commits[_tag_commit.id]
-            self._repo_endpoints_helper(_commit_data, _tag_commit)
+        # One `git for-each-ref` gets us all branches and tags along with
+        # details of commits they point at. (None at all, if refs did not
+        # change since last time.) Annotated tags come peeled to commits.
+        _heads, _tags = _r.ref_summary()
+        for _e in _tags:
+            _commit_data = _commits[_e.commit.id]
+            self._repo_endpoints_helper(_commit_data, _e.commit)
             _commit_data['tags'].append(_e.name)
-        for _e in _r.branches:
+        for _e in _heads:
             _commit_data = _commits[_e.commit.id]
             self._repo_endpoints_helper(_commit_data, _e.commit)
             _commit_data['branches'].append(_e.name)
 
         # on occasion there is a mismatch between HEAD and a branch.
         # if so, we will show it separately. Else, a branch absorbs it.
-        if _r.heads: # bare, freshly inited repos don't have heads and code blows up.
-            _e = _r.commit('HEAD')
-            _commit_data = _commits[_e.id]
+        # (bare, freshly inited repos don't have a HEAD commit.)
+        _head_id = _r.resolve_ref('HEAD')
+        if _head_id:
+            _commit_data = _commits[_head_id]
             if not _commit_data['id']:
-                self._repo_endpoints_helper(_commit_data, _e)
+                self._repo_endpoints_helper(_commit_data, _r.commit(_head_id))
                 _commit_data['branches'].append('HEAD')
 
         _commits_list = [_commits[key] for key in _commits.keys()]
@@ -515,7 +497,8 @@ class RepoControl(BaseRPCClass):
                 }
 
 def assemble_methods_list(content_path, *args, **kw):
+    _index = kw.get('repo_index') or get_index(content_path)
     return [
-        ('browser.path_summary',PathSummaryProducer(content_path).get_path_summary),
-        ('repocontrol.setdescription',RepoControl(content_path).set_description)
+        ('browser.path_summary',PathSummaryProducer(content_path, _index).get_path_summary),
+        ('repocontrol.setdescription',RepoControl(content_path, _index).set_description)
         ]
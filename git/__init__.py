@@ -11,6 +11,7 @@ __version__ = 'git'
 
 from git.actor import Actor
 from git.blob import Blob
+from git.cache import ObjectCache, object_cache
 from git.commit import Commit
 from git.diff import Diff
 from git.errors import InvalidGitRepositoryError, NoSuchPathError, GitCommandError
@@ -15,7 +15,7 @@ class Blob(object):
     """A Blob encapsulates a git blob object"""
     DEFAULT_MIME_TYPE = "text/plain"
 
-    def __init__(self, repo, id, mode=None, name=None):
+    def __init__(self, repo, id, mode=None, name=None, size=None):
         """
         Create an unbaked Blob containing just the specified attributes
 
@@ -31,6 +31,10 @@ class Blob(object):
         ``name``
             is the file name
 
+        ``size``
+            is the size of the blob in bytes, if already known (from
+            `git ls-tree -l`, for example)
+
         Returns
             git.Blob
         """
@@ -39,7 +43,7 @@ class Blob(object):
         self.mode = mode
         self.name = name
 
-        self._size = None
+        self._size = size
         self.data_stored  = None
 
     @property
@@ -51,10 +55,17 @@ class Blob(object):
             int
 
         NOTE
-            The size will be cached after the first access
+            The size will be cached after the first access, and in the
+            repo's object_cache, if the blob's id is a SHA.
         """
         if self._size is None:
-            self._size = int(self.repo.git.cat_file(self.id, s=True).rstrip())
+            cache = self.repo.object_cache
+            if cache is not None:
+                self._size = cache.get(self.repo.path, 'size', self.id)
+            if self._size is None:
+                self._size = self.repo.git.get_object_header(self.id)[2]
+                if cache is not None:
+                    cache.set(self.repo.path, 'size', self.id, self._size)
         return self._size
 
     @property
@@ -66,9 +77,19 @@ class Blob(object):
             str
 
         NOTE
-            The data will be cached after the first access.
+            The data will be cached after the first access. Small blobs
+            are also kept in the repo's object_cache.
         """
-        self.data_stored = self.data_stored or self.repo.git.cat_file(self.id, p=True, with_raw_output=True)
+        if self.data_stored is None:
+            cache = self.repo.object_cache
+            if cache is not None:
+                self.data_stored = cache.get(self.repo.path, 'data', self.id)
+            if self.data_stored is None:
+                self.data_stored = self.repo.git.get_object_data(self.id)[3]
+                if cache is not None:
+                    cache.set(self.repo.path, 'data', self.id, self.data_stored)
+                    cache.set(self.repo.path, 'size', self.id, len(self.data_stored))
+            self._size = len(self.data_stored)
         return self.data_stored
 
     @property
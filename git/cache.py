@@ -0,0 +1,153 @@
+# cache.py
+# Copyright (C) 2008-2010 Michael Trier (mtrier@gmail.com) and contributors
+#
+# This module is part of GitPython and is released under
+# the BSD License: http://www.opensource.org/licenses/bsd-license.php
+"""
+Process-wide cache of immutable git object data.
+
+Objects addressed by their SHA never change. Once we read a tree listing, a
+blob's size or a small blob's contents, there is no reason to ask git again,
+no matter how many times Repo, Tree and Blob instances are rebuilt around it.
+
+Entries are keyed by (repo path, kind, object id) and evicted in least
+recently used order once the total (estimated) size goes over the byte budget.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+# Default total size budget for the shared cache, in bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Blobs larger than this are never kept in the cache. Their sizes still are.
+DEFAULT_MAX_BLOB_BYTES = 65536
+# Rough per-entry overhead of keys, tuples and the LRU bookkeeping.
+ENTRY_OVERHEAD = 200
+
+_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+def is_sha(id):
+    """
+    Returns
+        True if ``id`` is a full hex SHA1, i.e. names an immutable object.
+        Names like 'master' or 'HEAD^{tree}' are not safe to cache on.
+    """
+    return bool(id) and bool(_sha_re.match(id))
+
+class ObjectCache(object):
+    """
+    Byte-budgeted LRU cache for tree listings, blob sizes, small blob contents
+    and commit objects.
+
+    Kinds of entries and their values:
+
+    ``tree``
+        list: [(mode, type, id, name, size), ...] size is None when unknown.
+    ``size``
+        int (size of the blob in bytes)
+    ``data``
+        str (contents of a blob no larger than max_blob_bytes)
+    ``commit``
+        str (raw commit object)
+
+    Hit and miss counters are kept per kind. See stats().
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_blob_bytes=DEFAULT_MAX_BLOB_BYTES):
+        self.max_bytes = max_bytes
+        self.max_blob_bytes = max_blob_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = {}
+            self.misses = {}
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _estimate(kind, value):
+        if kind == 'tree':
+            return ENTRY_OVERHEAD + sum([len(e[3]) + 100 for e in value])
+        elif kind in ('data', 'commit'):
+            return ENTRY_OVERHEAD + len(value)
+        return ENTRY_OVERHEAD
+
+    def get(self, repo_path, kind, id):
+        """
+        Returns
+            The cached value or None
+        """
+        key = (repo_path, kind, id)
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            # re-inserting moves the entry to the "most recently used" end.
+            self._entries[key] = entry
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, repo_path, kind, id, value):
+        """
+        Stores the value, unless ``id`` is not a SHA or the value is too big.
+        """
+        if value is None or not is_sha(id):
+            return
+        if kind == 'data' and len(value) > self.max_blob_bytes:
+            return
+        size = self._estimate(kind, value)
+        if size > self.max_bytes:
+            return
+        key = (repo_path, kind, id)
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _k, (_v, _s) = self._entries.popitem(last=False)
+                self.bytes -= _s
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns
+            dict with keys: hits, misses (both per-kind dicts), hit_ratio,
+            entries, bytes, max_bytes, evictions
+        """
+        self._lock.acquire()
+        try:
+            hits = dict(self.hits)
+            misses = dict(self.misses)
+            _h = sum(hits.values())
+            _m = sum(misses.values())
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': _h and float(_h) / (_h + _m) or 0.0,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+                }
+        finally:
+            self._lock.release()
+
+# The one instance shared by all Repo objects in the process.
+object_cache = ObjectCache()
@@ -0,0 +1,280 @@
+# catfile.py
+# Copyright (C) 2008-2010 Michael Trier (mtrier@gmail.com) and contributors
+#
+# This module is part of GitPython and is released under
+# the BSD License: http://www.opensource.org/licenses/bsd-license.php
+"""
+Long-lived ``git cat-file --batch`` and ``git cat-file --batch-check``
+processes, pooled per repository.
+
+Forking git for every ``cat-file -s`` or ``cat-file -p`` is the dominant cost
+when a tree with thousands of entries is listed. Instead, we keep a few
+``cat-file`` processes running per repository and talk to them over pipes,
+so that every object lookup costs one pipe round-trip instead of one fork.
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+
+from errors import GitCommandError
+from utils import git_executable
+
+# How long (seconds) an unused process may sit in the pool before it is killed.
+IDLE_TIMEOUT = 300
+# Max number of processes of each kind ('--batch', '--batch-check') per repo.
+MAX_PROCESSES = 4
+# How often (seconds) we walk through all pools looking for idle processes.
+SWEEP_INTERVAL = 30
+
+extra = {}
+if sys.platform == 'win32':
+    extra = {'shell': True}
+
+class CatFileProcess(object):
+    """
+    One running ``git cat-file --batch`` (or ``--batch-check``) process.
+
+    Instances are not thread-safe. The owning CatFilePool hands each one to
+    a single thread at a time.
+    """
+    def __init__(self, git_dir, mode):
+        """
+        ``git_dir``
+            is the directory git is started in (repo or working folder)
+
+        ``mode``
+            is either '--batch' or '--batch-check'
+        """
+        self.git_dir = git_dir
+        self.mode = mode
+        self.last_used = time.time()
+        self._devnull = open(os.devnull, 'wb')
+        self.proc = subprocess.Popen(
+            [git_executable(), 'cat-file', mode],
+            cwd=git_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._devnull,
+            **extra
+            )
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def request(self, ref):
+        """
+        Ask the process about one object.
+
+        ``ref``
+            is anything `git rev-parse` understands: sha, 'master^{tree}' etc.
+
+        Returns
+            tuple(str(id), str(type), int(size), str(data) or None)
+            data is None for '--batch-check' processes.
+
+        Raise
+            ValueError if the object does not exist.
+            GitCommandError if the process died on us, or said something
+            unexpected. The process is then closed, as whatever it has not
+            said yet would be taken for the answer to the next request.
+        """
+        if '\n' in ref:
+            raise ValueError("Object name may not contain new line: %r" % ref)
+        self.last_used = time.time()
+        in_sync = False
+        try:
+            self.proc.stdin.write(ref + '\n')
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline()
+            if not header:
+                raise GitCommandError(['git', 'cat-file', self.mode], -1, 'cat-file exited')
+
+            parts = header.rstrip('\n').split(' ')
+            if len(parts) == 2 and parts[-1] in ('missing', 'ambiguous'):
+                # "<ref> missing" or "<ref> ambiguous"
+                in_sync = True
+                raise ValueError("Object %s: %s" % (ref, parts[-1]))
+            if len(parts) != 3 or not parts[2].isdigit():
+                raise GitCommandError(['git', 'cat-file', self.mode], -1,
+                    'unexpected cat-file output: %r' % header)
+            id, typ, size = parts[0], parts[1], int(parts[2])
+
+            data = None
+            if self.mode == '--batch':
+                data = self.proc.stdout.read(size)
+                if len(data) != size or self.proc.stdout.read(1) != '\n':
+                    raise GitCommandError(['git', 'cat-file', self.mode], -1, 'short read from cat-file')
+            in_sync = True
+            return id, typ, size, data
+        except (IOError, OSError):
+            raise GitCommandError(['git', 'cat-file', self.mode], -1, 'cat-file pipe broken')
+        finally:
+            if not in_sync:
+                self.close()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except:
+            pass
+        try:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+        except:
+            pass
+        try:
+            self.proc.stdout.close()
+        except:
+            pass
+        self._devnull.close()
+
+class CatFilePool(object):
+    """
+    A bounded pool of CatFileProcess instances for one repository.
+
+    At most ``max_processes`` of each kind run at any time. When all of them
+    are busy, the caller waits until one is handed back. Processes that were
+    not used for ``idle_timeout`` seconds are killed.
+    """
+    def __init__(self, git_dir, max_processes=None, idle_timeout=None):
+        self.git_dir = git_dir
+        self.max_processes = max_processes or MAX_PROCESSES
+        self.idle_timeout = idle_timeout or IDLE_TIMEOUT
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = {'--batch': [], '--batch-check': []}
+        self._count = {'--batch': 0, '--batch-check': 0}
+
+    def _checkout(self, mode):
+        self._lock.acquire()
+        try:
+            while True:
+                idle = self._idle[mode]
+                while idle:
+                    p = idle.pop()
+                    if p.alive:
+                        return p
+                    self._count[mode] -= 1
+                    p.close()
+                if self._count[mode] < self.max_processes:
+                    self._count[mode] += 1
+                    break
+                self._lock.wait()
+        finally:
+            self._lock.release()
+        try:
+            return CatFileProcess(self.git_dir, mode)
+        except:
+            self._lock.acquire()
+            try:
+                self._count[mode] -= 1
+                self._lock.notify()
+            finally:
+                self._lock.release()
+            raise
+
+    def _checkin(self, p):
+        self._lock.acquire()
+        try:
+            if p.alive:
+                self._idle[p.mode].append(p)
+            else:
+                self._count[p.mode] -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def request(self, ref, mode='--batch-check'):
+        """
+        Look up one object through a pooled cat-file process.
+
+        Returns
+            Same as CatFileProcess.request()
+        """
+        p = self._checkout(mode)
+        try:
+            return p.request(ref)
+        finally:
+            self._checkin(p)
+
+    def evict_idle(self, now=None):
+        """
+        Kill processes that were not used for ``idle_timeout`` seconds.
+
+        Returns
+            int (number of processes still running in the pool)
+        """
+        now = now or time.time()
+        stale = []
+        self._lock.acquire()
+        try:
+            for mode, idle in self._idle.items():
+                keep = []
+                for p in idle:
+                    if now - p.last_used > self.idle_timeout or not p.alive:
+                        stale.append(p)
+                        self._count[mode] -= 1
+                    else:
+                        keep.append(p)
+                self._idle[mode] = keep
+            running = sum(self._count.values())
+        finally:
+            self._lock.release()
+        for p in stale:
+            p.close()
+        return running
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            stale = self._idle['--batch'] + self._idle['--batch-check']
+            for mode in self._idle:
+                self._count[mode] -= len(self._idle[mode])
+                self._idle[mode] = []
+        finally:
+            self._lock.release()
+        for p in stale:
+            p.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+_last_sweep = [time.time()]
+
+def get_pool(git_dir):
+    """
+    Returns the process-wide CatFilePool for the given directory, creating it
+    if needed. Every so often also sweeps all pools for idle processes.
+    """
+    git_dir = os.path.abspath(git_dir)
+    now = time.time()
+    sweep = []
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(git_dir)
+        if pool is None:
+            pool = _pools[git_dir] = CatFilePool(git_dir)
+        if now - _last_sweep[0] > SWEEP_INTERVAL:
+            _last_sweep[0] = now
+            sweep = _pools.values()
+    finally:
+        _pools_lock.release()
+    for p in sweep:
+        p.evict_idle(now)
+    return pool
+
+def close_all():
+    """
+    Stops all pooled cat-file processes.
+    """
+    _pools_lock.acquire()
+    try:
+        pools = _pools.values()
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+    for p in pools:
+        p.close()
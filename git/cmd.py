@@ -9,6 +9,22 @@ import subprocess
 import re
 from utils import *
 from errors import GitCommandError
+import catfile
+try:
+    # spawns through the fork server, once one is started. See spawner.start()
+    from spawner import popen
+except ImportError:
+    popen = subprocess.Popen
+try:
+    # records the command in the current request's trace, if any
+    from request_trace import start_span
+except ImportError:
+    start_span = lambda argv: None
+try:
+    # counts running processes, for the /metrics of ges
+    from metrics import process_started, process_exited
+except ImportError:
+    process_started = process_exited = lambda *args: None
 
 # Enables debugging of GitPython's git commands
 GIT_PYTHON_TRACE = os.environ.get("GIT_PYTHON_TRACE", False)
@@ -34,7 +50,15 @@ class Git(object):
 	    Set the GIT_PYTHON_TRACE environment variable print each invocation
 	    of the command to stdout.
 	    Set its value to 'full' to see details about the returned values.
+
+	``Object lookups``
+	    get_object_header() and get_object_data() do not fork git. They talk
+	    to long-lived `git cat-file --batch[-check]` processes pooled per
+	    repository (see catfile.py). Set ``use_cat_file_pool`` to False to
+	    fall back to one `git cat-file` process per lookup.
     """
+    use_cat_file_pool = True
+
     def __init__(self, git_dir=None):
         """
         Initialize this instance with:
@@ -65,6 +89,45 @@ class Git(object):
         """
         return self.git_dir
 
+    def _cat_file_pool(self):
+        return catfile.get_pool(self.git_dir or os.getcwd())
+
+    def get_object_header(self, ref):
+        """
+        Returns
+            tuple(str(id), str(type), int(size)) of the object named by ``ref``
+
+        Raise
+            ValueError if there is no such object
+        """
+        if GIT_PYTHON_TRACE:
+            print 'git cat-file --batch-check <<< %s' % ref
+        if not self.use_cat_file_pool:
+            try:
+                typ = self.cat_file(ref, t=True)
+                size = int(self.cat_file(ref, s=True))
+                id = self.rev_parse(ref)
+            except GitCommandError:
+                raise ValueError("Object %s: missing" % ref)
+            return id, typ, size
+        return self._cat_file_pool().request(ref, '--batch-check')[:3]
+
+    def get_object_data(self, ref):
+        """
+        Returns
+            tuple(str(id), str(type), int(size), str(data)) of the object
+            named by ``ref``. Data is the raw (not pretty-printed) contents.
+
+        Raise
+            ValueError if there is no such object
+        """
+        if GIT_PYTHON_TRACE:
+            print 'git cat-file --batch <<< %s' % ref
+        if not self.use_cat_file_pool:
+            id, typ, size = self.get_object_header(ref)
+            return id, typ, size, self.cat_file(typ, id, with_raw_output=True)
+        return self._cat_file_pool().request(ref, '--batch')
+
     def execute(self, command,
                 istream=None,
                 with_keep_cwd=False,
@@ -120,13 +183,15 @@ class Git(object):
           cwd=self.git_dir
 
         # Start the process
-        proc = subprocess.Popen(command,
-                                cwd=cwd,
-                                stdin=istream,
-                                stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                **extra
-                                )
+        span = start_span(command)
+        proc = popen(command,
+                     cwd=cwd,
+                     stdin=istream,
+                     stderr=subprocess.PIPE,
+                     stdout=subprocess.PIPE,
+                     **extra
+                     )
+        counted = process_started(command)
 
         # Wait for the process to return
         try:
@@ -136,6 +201,9 @@ class Git(object):
         finally:
             proc.stdout.close()
             proc.stderr.close()
+            process_exited(counted)
+        if span is not None:
+            span.finish(status, bytes_out = len(stdout_value))
 
         # Strip off trailing whitespace by default
         if not with_raw_output:
@@ -215,7 +283,7 @@ class Git(object):
         ext_args = map(str, args)
         args = opt_args + ext_args
 
-        call = ["git", dashify(method)]
+        call = [git_executable(), dashify(method)]
         call.extend(args)
 
         return self.execute(call, **_kwargs)
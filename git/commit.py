@@ -78,7 +78,21 @@ class Commit(LazyMixin):
         Called by LazyMixin superclass when the first uninitialized member needs
         to be set as it is queried.
         """
-        temp = Commit.find_all(self.repo, self.id, max_count=1)[0]
+        cache = self.repo.object_cache
+        data = None
+        if cache is not None:
+            data = cache.get(self.repo.path, 'commit', self.id)
+        if data is not None:
+            temp = Commit.from_object_data(self.repo, self.id, data)
+        else:
+            try:
+                id, typ, size, data = self.repo.git.get_object_data(self.id + '^{commit}')
+            except ValueError:
+                temp = Commit.find_all(self.repo, self.id, max_count=1)[0]
+            else:
+                temp = Commit.from_object_data(self.repo, id, data)
+                if cache is not None:
+                    cache.set(self.repo.path, 'commit', id, data)
         self.parents = temp.parents
         self.tree = temp.tree
         self.author = temp.author
@@ -189,6 +203,45 @@ class Commit(LazyMixin):
 
         return commits
 
+    @classmethod
+    def from_object_data(cls, repo, id, data):
+        """
+        Parse a raw commit object (as stored by git, as given by
+        `git cat-file commit <id>`) into a Commit object.
+
+        ``repo``
+            is the Repo
+
+        ``id``
+            is the sha id of the commit
+
+        ``data``
+            is the raw contents of the commit object
+
+        Returns
+            git.Commit
+        """
+        headers, _, body = data.partition('\n\n')
+        tree = None
+        parents = []
+        author = authored_date = committer = committed_date = None
+        for line in headers.split('\n'):
+            if line.startswith('tree '):
+                tree = line[5:]
+            elif line.startswith('parent '):
+                parents.append(line[7:])
+            elif line.startswith('author '):
+                author, authored_date = cls.actor(line)
+            elif line.startswith('committer '):
+                committer, committed_date = cls.actor(line)
+            # gpgsig, encoding, mergetag etc. are of no interest to us.
+
+        # same shape as what list_from_string makes of `--pretty=raw` output
+        message = '\n'.join([l.strip() for l in body.splitlines() if l.strip()])
+
+        return Commit(repo, id=id, parents=parents, tree=tree, author=author, authored_date=authored_date,
+                      committer=committer, committed_date=committed_date, message=message)
+
     @classmethod
     def diff(cls, repo, a, b=None, paths=None):
         """
@@ -0,0 +1,202 @@
+# refs.py
+# Copyright (C) 2008-2010 Michael Trier (mtrier@gmail.com) and contributors
+#
+# This module is part of GitPython and is released under
+# the BSD License: http://www.opensource.org/licenses/bsd-license.php
+"""
+Per-repository table of refs (branch and tag names) and the commits they
+point at.
+
+The table is built from a single `git for-each-ref` call and is reused,
+process-wide, for as long as the refs fingerprint (see utils.refs_fingerprint)
+stays the same. Looking up 'master' or a tag name then costs a few stat calls
+instead of a `git rev-list` process.
+"""
+
+import os
+import threading
+
+from utils import refs_fingerprint
+from cache import is_sha
+import catfile
+
+class RefTable(object):
+    """
+    Maps full ref names ('refs/heads/master', 'refs/tags/0.1') to tuples of
+    (object id, commit id). For annotated tags, object id is the id of the tag
+    object and commit id is the id of the commit the tag (eventually) points
+    at. Commit id is None for refs pointing at trees and blobs.
+    """
+    # Order in which short names are expanded, per `git help revisions`
+    # ($GIT_DIR/<name> is handled separately, for HEAD only.)
+    ref_rules = ['%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+                 'refs/remotes/%s', 'refs/remotes/%s/HEAD']
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.fingerprint = None
+        self.refs = {}
+        self.head = None
+        self.builds = 0
+        self._summary = None
+        self._lock = threading.Lock()
+
+    def refresh(self, git):
+        """
+        Rebuilds the table if any ref changed since it was last built.
+
+        ``git``
+            is the git.Git instance to run `for-each-ref` with.
+
+        Returns
+            self
+        """
+        fingerprint = refs_fingerprint(self.git_dir)
+        if fingerprint is not None and fingerprint == self.fingerprint:
+            return self
+        self._lock.acquire()
+        try:
+            if fingerprint is None or fingerprint != self.fingerprint:
+                self._build(git)
+                # taken before the build. If refs moved while we were at it,
+                # the next refresh() will notice and rebuild.
+                self.fingerprint = fingerprint
+        finally:
+            self._lock.release()
+        return self
+
+    def _build(self, git):
+        refs = {}
+        output = git.for_each_ref(
+            format='%(refname)%00%(objecttype)%00%(objectname)%00%(*objecttype)%00%(*objectname)')
+        for line in output.splitlines():
+            try:
+                name, typ, id, peeled_typ, peeled_id = line.split('\x00')
+            except ValueError:
+                continue
+            if typ == 'commit':
+                refs[name] = (id, id)
+            elif typ == 'tag' and peeled_typ == 'commit':
+                refs[name] = (id, peeled_id)
+            else:
+                refs[name] = (id, None)
+
+        head = None
+        try:
+            f = open(os.path.join(self.git_dir, 'HEAD'))
+            try:
+                head = f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            pass
+        if head and head.startswith('ref:'):
+            head = head[4:].strip()
+        elif not is_sha(head):
+            head = None
+
+        self.refs = refs
+        self.head = head
+        self._summary = None
+        self.builds += 1
+
+    # Fields of the commit a ref points at. Annotated tags carry their own,
+    # mostly empty, values for these. '*' fields are those of the tagged object.
+    summary_fields = ['objectname', 'authorname', 'authoremail',
+                      'authordate:raw', 'committerdate:raw', 'subject']
+
+    def summary(self, git):
+        """
+        Details about the commit every branch and tag points at, gathered with
+        one `git for-each-ref` call, no matter how many refs there are.
+        Kept until the table is rebuilt. Call refresh() first.
+
+        Returns
+            list: [(refname, commit id, author name, author email,
+                    authored epoch, committed epoch, subject), ...]
+            Refs not pointing (through tags) at commits are left out.
+        """
+        summary = self._summary
+        if summary is not None:
+            return summary
+        fields = ['refname', 'objecttype'] + self.summary_fields + \
+                 ['*objecttype'] + ['*' + f for f in self.summary_fields]
+        output = git.for_each_ref(
+            'refs/heads', 'refs/tags',
+            format='%00'.join(['%(' + f + ')' for f in fields]))
+        summary = []
+        width = len(self.summary_fields)
+        for line in output.splitlines():
+            values = line.split('\x00')
+            if len(values) != len(fields):
+                continue
+            name, typ = values[0], values[1]
+            if typ == 'commit':
+                details = values[2:2 + width]
+            elif typ == 'tag' and values[2 + width] == 'commit':
+                details = values[3 + width:]
+            else:
+                # trees, blobs, tags of tags. Rare enough not to bother.
+                continue
+            id, author, email, authored, committed, subject = details
+            summary.append((
+                name,
+                id,
+                author,
+                email.strip('<>'),
+                int(authored.split()[0]),
+                int(committed.split()[0]),
+                subject))
+        self._summary = summary
+        return summary
+
+    def resolve(self, name):
+        """
+        Find the commit a short or full ref name points at.
+
+        ``name``
+            is 'HEAD', a branch or tag name ('master', 'heads/master',
+            'refs/tags/0.1') or a full SHA.
+
+        Returns
+            str (commit id) or None if the name cannot be resolved through the
+            table and git has to be asked (like 'master~2', short SHAs, SHAs
+            of missing objects or of trees and blobs).
+        """
+        if is_sha(name):
+            # any 40 hex digits look like a SHA. Whether it is a commit (or a
+            # tag, peeled to one) is one round-trip to a pooled cat-file.
+            try:
+                return catfile.get_pool(self.git_dir).request(name + '^{commit}')[0]
+            except ValueError:
+                return None
+        refs = self.refs
+        if name == 'HEAD':
+            head = self.head
+            if head is None or is_sha(head):
+                return head
+            entry = refs.get(head)
+            return entry and entry[1]
+        for rule in self.ref_rules:
+            entry = refs.get(rule % name)
+            if entry:
+                return entry[1]
+        return None
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+def get_ref_table(git_dir):
+    """
+    Returns the process-wide RefTable for the repository. Call its refresh()
+    before use.
+    """
+    git_dir = os.path.abspath(git_dir)
+    _tables_lock.acquire()
+    try:
+        table = _tables.get(git_dir)
+        if table is None:
+            table = _tables[git_dir] = RefTable(git_dir)
+        return table
+    finally:
+        _tables_lock.release()
@@ -6,9 +6,8 @@
 
 import os
 import re
-import gzip
-import StringIO
-from errors import InvalidGitRepositoryError, NoSuchPathError
+import time
+from errors import InvalidGitRepositoryError, NoSuchPathError, GitCommandError
 from utils import touch, is_git_dir
 from cmd import Git
 from head import Head
@@ -16,6 +15,9 @@ from blob import Blob
 from tag import Tag
 from commit import Commit
 from tree import Tree
+from cache import object_cache
+from refs import get_ref_table
+from actor import Actor
 
 class Repo(object):
     """
@@ -71,6 +73,9 @@ class Repo(object):
            raise InvalidGitRepositoryError(epath)
 
         self.git = Git(self.wd)
+        # Process-wide cache of immutable (SHA-addressed) object data.
+        # Set to None to always ask git.
+        self.object_cache = object_cache
 
     # Description property
     def _get_description(self):
@@ -203,6 +208,17 @@ class Repo(object):
         Returns
             ``git.Commit``
         """
+        if not path:
+            sha = self.resolve_ref(id)
+            if sha is None:
+                # 'master~2', short SHAs. Only git knows.
+                try:
+                    sha = self.git.rev_parse(id + '^{commit}', verify=True, quiet=True)
+                except GitCommandError:
+                    raise ValueError, "Invalid identifier %s" % id
+            # Lazy. Details are read (or pulled from object_cache) on first use.
+            return Commit(self, id=sha)
+
         options = {'max_count': 1}
 
         commits = Commit.find_all(self, id, path, **options)
@@ -211,6 +227,61 @@ class Repo(object):
             raise ValueError, "Invalid identifier %s, or given path '%s' too restrictive" % ( id, path )
         return commits[0]
 
+    @property
+    def ref_table(self):
+        """
+        The process-wide, up-to-date table of this repo's refs.
+
+        It is rebuilt (with one `git for-each-ref` call) only when the
+        mtimes of HEAD, packed-refs or anything under refs/ change.
+
+        Returns
+            ``git.refs.RefTable``
+        """
+        return get_ref_table(self.path).refresh(self.git)
+
+    def resolve_ref(self, name):
+        """
+        The commit id a ref name ('HEAD', 'master', 'tags/0.1', full SHA)
+        points at, looked up without running git when refs did not change.
+
+        Returns
+            str (commit id) or None if the name is not a plain ref name and
+            has to be resolved by git.
+        """
+        return self.ref_table.resolve(name)
+
+    def ref_summary(self):
+        """
+        All branches and tags, with the details of the commits they point at
+        already filled in, read with a constant number of git processes (and
+        none at all if refs did not change since the last call).
+
+        The Commit objects carry id, author, authored_date, committed_date
+        and the first line of the message only. Anything else makes them
+        read the whole commit.
+
+        Returns
+            tuple(``git.Head[]``, ``git.Tag[]``)
+        """
+        heads = []
+        tags = []
+        commits = {}
+        for name, id, author, email, authored, committed, subject in \
+                self.ref_table.summary(self.git):
+            commit = commits.get(id)
+            if commit is None:
+                commit = commits[id] = Commit(self, id=id,
+                    author=Actor(author, email),
+                    authored_date=time.gmtime(authored),
+                    committed_date=time.gmtime(committed),
+                    message=subject)
+            if name.startswith('refs/heads/'):
+                heads.append(Head(name[len('refs/heads/'):], commit))
+            elif name.startswith('refs/tags/'):
+                tags.append(Tag(name[len('refs/tags/'):], commit))
+        return heads, tags
+
     def commit_deltas_from(self, other_repo, ref='master', other_ref='master'):
         """
         Returns a list of commits that is in ``other_repo`` but not in self
@@ -224,13 +295,17 @@ class Repo(object):
         diff_refs = list(set(other_repo_refs) - set(repo_refs))
         return map(lambda ref: Commit.find_all(other_repo, ref, max_count=1)[0], diff_refs)
 
-    def tree(self, treeish='master'):
+    def tree(self, treeish='master', long_listing=False):
         """
         The Tree object for the given treeish reference
 
         ``treeish``
             is the reference (default 'master')
 
+        ``long_listing``
+            if True, the tree (and its sub-trees) is read with
+            `git ls-tree -l`, which gets the sizes of all blobs in one go.
+
         Examples::
 
           repo.tree('master')
@@ -239,7 +314,7 @@ class Repo(object):
         Returns
             ``git.Tree``
         """
-        return Tree(self, id=treeish)
+        return Tree(self, id=treeish, long_listing=long_listing)
 
     def blob(self, id):
         """
@@ -375,7 +450,7 @@ class Repo(object):
         options = {}
         if prefix:
             options['prefix'] = prefix
-        return self.git.archive(treeish, **options)
+        return self.git.archive(treeish, with_raw_output=True, **options)
 
     def archive_tar_gz(self, treeish='master', prefix=None):
         """
@@ -404,12 +479,8 @@ class Repo(object):
         kwargs = {}
         if prefix:
             kwargs['prefix'] = prefix
-        resultstr =  self.git.archive(treeish, **kwargs)
-        sio = StringIO.StringIO()
-        gf = gzip.GzipFile(fileobj=sio, mode ='wb')
-        gf.write(resultstr)
-        gf.close()
-        return sio.getvalue()
+        # git gzips as it writes. No uncompressed copy of the tar in memory.
+        return self.git.archive(treeish, format='tar.gz', with_raw_output=True, **kwargs)
 
     def _get_daemon_export(self):
         filename = os.path.join(self.path, self.DAEMON_EXPORT_FILE)
@@ -10,7 +10,7 @@ import blob
 import submodule
 
 class Tree(LazyMixin):
-    def __init__(self, repo, id, mode=None, name=None, commit_context = '', path = ''):
+    def __init__(self, repo, id, mode=None, name=None, commit_context = '', path = '', long_listing = False):
         LazyMixin.__init__(self)
         self.repo = repo
         self.id = id
@@ -48,21 +48,99 @@ class Tree(LazyMixin):
         # as "folder/folder/name" in .gitmodules. path helps us keep up with the
         # the folder changes.
         self.path = path
+        # long_listing makes us read the tree with one `git ls-tree -l -z`
+        # call, which gives us the sizes of all blobs in the tree up front.
+        # Worth it when you know you will ask every Blob for its .size
+        # (directory listings). Child Trees inherit the setting.
+        self.long_listing = long_listing
         self._contents = None
 
     def __bake__(self):
-        # Ensure the treeish references directly a tree
-        treeish = self.id
-        if not treeish.endswith(':'):
-            treeish = treeish + ':'
-
-        # Read the tree contents.
         self._contents = {}
-        for line in self.repo.git.ls_tree(self.id).splitlines():
-            obj = self.content_from_string(self.repo, line, commit_context = self.commit_context, path = self.path)
+        cache = self.repo.object_cache
+        entries = None
+        if cache is not None:
+            entries = cache.get(self.repo.path, 'tree', self.id)
+            if entries and self.long_listing and \
+                    [e for e in entries if e[1] == 'blob' and e[4] is None]:
+                # cached listing has no sizes. We were asked for them.
+                entries = None
+        if entries is None:
+            if self.long_listing:
+                entries = self.entries_from_long_listing(
+                    self.repo.git.ls_tree(self.id, l=True, z=True, with_raw_output=True))
+            else:
+                # Read the tree contents through the pooled `cat-file --batch` process.
+                # '^{tree}' peels commit-ish ids (like 'master') down to their tree.
+                id, typ, size, data = self.repo.git.get_object_data(self.id + '^{tree}')
+                entries = [e + (None,) for e in self.entries_from_object_data(data)]
+            if cache is not None:
+                cache.set(self.repo.path, 'tree', self.id, entries)
+        for mode, typ, id, name, size in entries:
+            obj = self.content_from_entry(self.repo, mode, typ, id, name,
+                                          commit_context = self.commit_context, path = self.path,
+                                          size = size, long_listing = self.long_listing)
             if obj is not None:
                 self._contents[obj.name] = obj
 
+    @staticmethod
+    def entries_from_long_listing(text):
+        """
+        Parse the output of `git ls-tree -l -z`
+
+        ``text``
+            is NUL-delimited list of "<mode> <type> <id> <size>\\t<name>"
+            records. Size is '-' for anything but blobs. Names are not quoted,
+            and may contain tabs and new lines.
+
+        Returns
+            list: [(mode, type, id, name, size), ...] where size is int or None
+        """
+        entries = []
+        for record in text.split('\0'):
+            if not record:
+                continue
+            meta, name = record.split('\t', 1)
+            mode, typ, id, size = meta.split()
+            if size == '-':
+                size = None
+            else:
+                size = int(size)
+            entries.append((mode, typ, id, name, size))
+        return entries
+
+    @staticmethod
+    def entries_from_object_data(data):
+        """
+        Parse the raw (binary) contents of a tree object
+
+        ``data``
+            is the raw tree object as stored by git. It's a sequence of
+            "<octal mode> <name>\\0<20 byte binary sha>" records.
+
+        Returns
+            list: [(mode, type, id, name), ...] where mode is formatted the way
+            `git ls-tree` shows it (6 digits) and id is the hex sha.
+        """
+        entries = []
+        i = 0
+        end = len(data)
+        while i < end:
+            space = data.index(' ', i)
+            nul = data.index('\0', space)
+            mode = data[i:space].rjust(6, '0')
+            name = data[space + 1:nul]
+            id = data[nul + 1:nul + 21].encode('hex')
+            i = nul + 21
+            if mode == '040000':
+                typ = 'tree'
+            elif mode == '160000':
+                typ = 'commit'
+            else:
+                typ = 'blob'
+            entries.append((mode, typ, id, name))
+        return entries
+
     @staticmethod
     def content_from_string(repo, text, commit_context = None, path=''):
         """
@@ -81,12 +159,24 @@ class Tree(LazyMixin):
             mode, typ, id, name = text.expandtabs(1).split(" ", 3)
         except:
             return None
+        return Tree.content_from_entry(repo, mode, typ, id, name,
+                                       commit_context = commit_context, path = path)
+
+    @staticmethod
+    def content_from_entry(repo, mode, typ, id, name, commit_context = None, path='',
+                           size = None, long_listing = False):
+        """
+        Create the appropriate object for one parsed tree entry
 
+        Returns
+            ``git.Blob`` or ``git.Tree`` or ``git.Submodule``
+        """
         if typ == "tree":
             return Tree(repo, id=id, mode=mode, name=name,
-                        commit_context = commit_context, path='/'.join([path,name]))
+                        commit_context = commit_context, path='/'.join([path,name]),
+                        long_listing = long_listing)
         elif typ == "blob":
-            return blob.Blob(repo, id=id, mode=mode, name=name)
+            return blob.Blob(repo, id=id, mode=mode, name=name, size=size)
         elif typ == "commit" and mode == '160000':
             return submodule.Submodule(repo, id=id, name=name,
                         commit_context = commit_context, path='/'.join([path,name]))
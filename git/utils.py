@@ -5,6 +5,7 @@
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
 
 import os
+import sys
 
 def dashify(string):
     return string.replace('_', '-')
@@ -25,3 +26,80 @@ def is_git_dir(d):
                 (os.path.islink(headref) and
                 os.readlink(headref).startswith('refs'))
     return False
+
+def refs_fingerprint(git_dir):
+    """
+    A cheap (no git process, only stat calls) value that changes whenever
+    any ref in the repository changes.
+
+    Made of the modification times (sizes and inodes) of HEAD, packed-refs
+    and of every directory and file under refs/. Git updates loose refs by
+    renaming lock files into place, which bumps the mtime of the containing
+    folder and gives the ref a new inode. (That's how we see two updates
+    within one tick of a coarse file system clock.) We stat the files too,
+    for tools that write refs in place.
+
+    Returns
+        tuple (comparable, hashable) or None if git_dir is not readable.
+    """
+    parts = []
+    for name in ('HEAD', 'packed-refs'):
+        try:
+            st = os.stat(os.path.join(git_dir, name))
+            parts.append((name, st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            parts.append((name, None))
+    refs_dir = os.path.join(git_dir, 'refs')
+    if not os.path.isdir(refs_dir):
+        return None
+    for root, dirs, files in os.walk(refs_dir):
+        for name in [root] + [os.path.join(root, f) for f in files]:
+            try:
+                st = os.stat(name)
+                parts.append((name, st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                # deleted while we were walking. The next call will notice.
+                parts.append((name, None))
+    return tuple(parts)
+
+_git_executable = None
+
+def git_executable():
+    """
+    Absolute path of the git binary, looked up on PATH once and remembered,
+    so that git is exec'd directly, with no lookup (or shell) per call.
+    $GIT_PYTHON_GIT_EXECUTABLE, if set, is used instead.
+
+    Returns
+        str. Just 'git' if it is not found on PATH.
+    """
+    global _git_executable
+    if _git_executable is None:
+        found = os.environ.get('GIT_PYTHON_GIT_EXECUTABLE')
+        names = ['git']
+        if sys.platform == 'win32':
+            names = ['git.exe', 'git.cmd']
+        _git_executable = found or find_executable(*names) or 'git'
+    return _git_executable
+
+def find_executable(*names):
+    """
+    Absolute path of the first of the names found on PATH. Names with a
+    folder in them are checked as they are.
+
+    Returns
+        str or None if none is found.
+    """
+    for name in names:
+        if os.path.dirname(name):
+            if os.path.isfile(name) and os.access(name, os.X_OK):
+                return os.path.abspath(name)
+            continue
+    for folder in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        for name in names:
+            if os.path.dirname(name):
+                continue
+            candidate = os.path.abspath(os.path.join(folder, name))
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+    return None
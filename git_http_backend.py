@@ -28,19 +28,27 @@ along with git_http_backend.py Project.  If not, see <http://www.gnu.org/license
 import io
 import os
 import sys
-import gzip
-import StringIO
+import zlib
 
-import subprocess
 import subprocessio
+import spawner
+import pack_cache
+import post_push
+import admission
+import response_compression
+from on_close import OnClose
+from repo_index import get_index
+from git.utils import refs_fingerprint, git_executable
 
 import tempfile
+import hashlib
+import threading
 from wsgiref.headers import Headers
 
 # needed for WSGI Selector
 import re
 import urlparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # needed for static content server
 import time
@@ -75,7 +83,9 @@ class BaseWSGIClass(object):
         'execution_failed':'417 Execution failed',
         '200': "200 OK",
         '501': "501 Not Implemented",
-        'not_implemented': "501 Not Implemented"
+        'not_implemented': "501 Not Implemented",
+        '503': "503 Service Unavailable",
+        'busy': "503 Service Unavailable"
     }
 
     def canned_handlers(self, environ, start_response, code = '200', headers = []):
@@ -108,6 +118,9 @@ class BaseWSGIClass(object):
             retobj = iter( lambda: outIO.read(self.bufsize), '' )
         else:
             retobj = outIO
+        if self.gzip_response:
+            return response_compression.compress_response(
+                environ, start_response, "200 OK", headers, retobj)
         start_response("200 OK", headers)
         return retobj
 
@@ -343,6 +356,49 @@ class StaticWSGIServer(BaseWSGIClass):
         file_like = open(full_path, 'rb')
         return self.package_response(file_like, environ, start_response, headers)
 
+class GzipDecoder(object):
+    '''
+    File-like, reading and decompressing a gzip-compressed file-like (request
+    body) bit by bit, as read() is called. Memory use does not depend on
+    the size of the body, and its start is available before its end arrives.
+    '''
+    def __init__(self, source, chunk_size = 65536):
+        self.source = source
+        self.chunk_size = chunk_size
+        # 16 + : expect gzip header and trailer, not raw zlib stream.
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ''
+        self.done = False
+
+    def _decode(self, size):
+        '''Returns up to size bytes of decoded data. '' at the end of it.'''
+        while not self.done:
+            if self.pending:
+                data, self.pending = self.pending, ''
+            else:
+                data = self.source.read(self.chunk_size)
+                if not data:
+                    self.done = True
+                    return self.decoder.flush()
+            try:
+                out = self.decoder.decompress(data, size)
+            except zlib.error as e:
+                raise IOError('Request body is not valid gzip: %s' % e)
+            # what did not fit into size, and what is past the end of the gzip member.
+            self.pending = self.decoder.unconsumed_tail
+            if self.decoder.unused_data:
+                # concatenated gzip members decode into one stream.
+                self.pending += self.decoder.unused_data
+                self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if out:
+                return out
+        return ''
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self._decode(self.chunk_size), ''))
+        return self._decode(size)
+
 class GitHTTPBackendBase(BaseWSGIClass):
     git_folder_signature = set(['config', 'head', 'info', 'objects', 'refs'])
     repo_auto_create = True
@@ -398,11 +454,8 @@ class GitHTTPBackendBase(BaseWSGIClass):
             ):
             return self.canned_handlers(environ, start_response, 'forbidden')
 
-        try:
-            files = os.listdir(repo_path)
-        except:
-            files = []
-        if not self.git_folder_signature.issubset([i.lower() for i in files]):
+        _index = getattr(self, 'repo_index', None) or get_index(_pp)
+        if not _index.is_repo(repo_path, self.git_folder_signature):
             if not ( self.repo_auto_create and git_command == 'git-receive-pack' ):
                 return self.canned_handlers(environ, start_response, 'not_found')
             else:
@@ -420,9 +473,14 @@ class GitHTTPBackendBase(BaseWSGIClass):
                         except:
                             return self.canned_handlers(environ, start_response, 'not_found')
                         break
-                    elif not os.path.isdir(_pf) or self.git_folder_signature.issubset([i.lower() for i in os.listdir(_pf)]):
+                    elif not os.path.isdir(_pf) or _index.is_repo(_pf, self.git_folder_signature):
                         return self.canned_handlers(environ, start_response, 'forbidden')
-                if subprocess.call('git init --quiet --bare "%s"' % repo_path, shell=True):
+                _failed = spawner.popen([
+                    git_executable(), 'init', '--quiet', '--bare', repo_path.encode('utf8')
+                    ]).wait()
+                # not waiting for the watcher to notice the new repo.
+                _index.refresh(_pf)
+                if _failed:
                     return self.canned_handlers(environ, start_response, 'execution_failed')
         #
         #############################################################
@@ -440,15 +498,75 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
     to show to Git client that we are an "intelligent" server.
 
     The "right" content is special header and custom top 2 rows of data in the response.
+
+    The response only changes when refs change. We keep it in memory, per repo
+    and service, along with the fingerprint of the ref state it was made for.
     '''
+    advert_cache_max_entries = 1000
+
     def __init__(self, **kw):
         '''
         inputs:
             content_path (Mandatory) - Local file system path = root of served files.
             bufsize (Default = 65536) Chunk size for WSGI file feeding
             gzip_response (Default = False) Compress response body
+            advert_cache_max_entries (Default = 1000) Max number of (repo, service)
+                advertisements kept in memory. 0 turns caching off.
         '''
         self.__dict__.update(kw)
+        # (repo_path, git_command) : (refs fingerprint, etag, advertisement)
+        self._adverts = OrderedDict()
+        self._adverts_lock = threading.Lock()
+
+    def _get_advert(self, repo_path, git_command):
+        '''
+        @returns (etag, advertisement) for current ref state of the repo.
+            Taken from memory if refs did not change, produced by git if they did.
+
+        Raises EnvironmentError if git fails.
+        '''
+        _key = (repo_path, git_command)
+        _fingerprint = self.advert_cache_max_entries and refs_fingerprint(repo_path)
+        if _fingerprint:
+            self._adverts_lock.acquire()
+            try:
+                _cached = self._adverts.pop(_key, None)
+                if _cached and _cached[0] == _fingerprint:
+                    # re-inserting moves the entry to the "most recently used" end.
+                    self._adverts[_key] = _cached
+                    return _cached[1:]
+            finally:
+                self._adverts_lock.release()
+
+        # note to self:
+        # please, resist the urge to add '\n' to git capture and increment line count by 1.
+        # The code in Git client not only does NOT need '\n', but actually blows up
+        # if you sprinkle "flush" (0000) as "0001\n".
+        # It reads binary, per number of bytes specified.
+        # if you do add '\n' as part of data, count it.
+        smart_server_advert = '# service=%s' % git_command
+        out = subprocessio.SubprocessIOChunker(
+            [git_executable(), str(git_command[4:]), '--stateless-rpc', '--advertise-refs',
+                repo_path.encode('utf8')],
+            starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
+            )
+        try:
+            _advert = ''.join(out)
+        finally:
+            out.close()
+        _etag = '"%s"' % hashlib.sha1(_advert).hexdigest()
+
+        if _fingerprint:
+            self._adverts_lock.acquire()
+            try:
+                # fingerprint taken before git ran. If refs moved meanwhile,
+                # next request sees a mismatch and asks git again.
+                self._adverts[_key] = (_fingerprint, _etag, _advert)
+                while len(self._adverts) > self.advert_cache_max_entries:
+                    self._adverts.popitem(last = False)
+            finally:
+                self._adverts_lock.release()
+        return _etag, _advert
 
     def __call__(self, environ, start_response):
         """WSGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
@@ -461,19 +579,8 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
         git_command = dataObj['git_command']
         repo_path = dataObj['repo_path']
 
-        # note to self:
-        # please, resist the urge to add '\n' to git capture and increment line count by 1.
-        # The code in Git client not only does NOT need '\n', but actually blows up
-        # if you sprinkle "flush" (0000) as "0001\n".
-        # It reads binary, per number of bytes specified.
-        # if you do add '\n' as part of data, count it.
-        smart_server_advert = '# service=%s' % git_command
-
         try:
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc --advertise-refs "%s"' % (git_command[4:], repo_path),
-                starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
-                )
+            etag, advert = self._get_advert(repo_path, git_command)
         except (EnvironmentError) as e:
             environ['wsgi.errors'].write(str(e))
             return self.canned_handlers(environ, start_response, 'execution_failed')
@@ -481,9 +588,18 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
 #            environ['wsgi.errors'].write(str(e))
 #            return self.canned_handlers(environ, start_response, 'internal_server_error')
 
-        headers = [('Content-type','application/x-%s-advertisement' % str(git_command))]
+        headers = [
+            ('Content-type','application/x-%s-advertisement' % str(git_command)),
+            ('ETag', etag),
+            # may be stored, but must be checked with us before reuse.
+            ('Cache-Control', 'no-cache')
+            ]
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none and (if_none == '*' or etag in if_none):
+            return self.canned_handlers(environ, start_response, 'not_modified', headers)
+        headers.append(('Content-Length', str(len(advert))))
         return self.package_response(
-            out,
+            [advert],
             environ,
             start_response,
             headers)
@@ -508,8 +624,41 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             These include
                 bufsize (Default = 65536) Chunk size for WSGI file feeding
                 gzip_response (Default = False) Compress response body
+                pack_cache_path (Default = None) Folder for caching
+                    upload-pack responses. No caching if None.
+                pack_cache_max_bytes (Default = 2GB) Max total size of
+                    cached responses.
+                pack_cache_max_body_bytes (Default = 1MB) Requests with
+                    larger bodies are not cached. Bodies are hashed in
+                    memory.
+                post_push_hooks (Default = [post_push.update_server_info])
+                    Callables, taking repo path, run in the background
+                    once receive-pack exits.
+                post_push_delay (Default = 1.0) Seconds to wait for more
+                    pushes to the same repo before running the hooks once.
+                admission (Default = None) admission.Admission instance
+                    limiting git processes. No limits if None.
         '''
         self.__dict__.update(kw)
+        self.admission = kw.get('admission')
+        self.post_push = post_push.PostPushQueue(
+            kw.get('post_push_hooks'),
+            kw.get('post_push_delay', 1.0)
+            )
+        self.pack_cache = None
+        if kw.get('pack_cache_path'):
+            self.pack_cache = pack_cache.PackCache(
+                kw['pack_cache_path'],
+                kw.get('pack_cache_max_bytes') or 2 * 1024 * 1024 * 1024,
+                self.bufsize,
+                kw.get('pack_cache_max_body_bytes') or 1024 * 1024
+                )
+
+    def _after_push(self, repo_path, process):
+        if self.pack_cache:
+            # refs are likely different once the push is through.
+            self.pack_cache.invalidate(repo_path)
+        self.post_push.schedule(repo_path, process)
 
     def __call__(self, environ, start_response):
         """
@@ -571,17 +720,50 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             if environ.get('HTTP_CONTENT_ENCODING','') in ['gzip', 'x-gzip']:
                 # since we have decoded it, it's no longer true.
                 # del environ['HTTP_CONTENT_ENCODING']
-                tmpfile = StringIO.StringIO(stdin.read())
-                stdin = gzip.GzipFile(fileobj = tmpfile).read()
-                tmpfile.close()
-                del tmpfile
-                # environ['wsgi.errors'].write('stdin is "%s"\n' % stdin)
-                # environ['CONTENT_LENGTH'] = str(len(stdin))
-
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc "%s"' % (git_command[4:], repo_path),
-                inputstream = stdin
-                )
+                # Decoded as git reads it. Pushes can be large.
+                stdin = GzipDecoder(stdin, self.bufsize)
+
+            _size = None
+            _key = None
+            if self.pack_cache and git_command == 'git-upload-pack':
+                # identical requests against same ref state get identical packs.
+                # Only bodies small enough to hash in memory are looked at.
+                if not isinstance(stdin, basestring):
+                    stdin = subprocessio.PeekedReader(stdin, self.pack_cache.max_body_bytes)
+                    if stdin.complete:
+                        stdin = stdin.head
+                if isinstance(stdin, basestring):
+                    _key = self.pack_cache.key(repo_path, git_command, stdin)
+            def _producer():
+                # called only when there is no cached response to send.
+                _ticket = None
+                if self.admission:
+                    _ticket = self.admission.acquire(repo_path, git_command[4:])
+                try:
+                    _out = subprocessio.SubprocessIOChunker(
+                        [git_executable(), str(git_command[4:]), '--stateless-rpc',
+                            repo_path.encode('utf8')],
+                        inputstream = stdin,
+                        # a slow client must not keep git (and its locks and
+                        # memory) waiting. See subprocessio.SpillBuffer
+                        spill = True
+                        )
+                except:
+                    if _ticket:
+                        _ticket.release()
+                    raise
+                if _ticket:
+                    # slot is taken until the response is sent.
+                    return _ticket.hold(_out)
+                return _out
+            if _key:
+                out, _size = self.pack_cache.get(_key, repo_path, _producer)
+            else:
+                out = _producer()
+        except (admission.AdmissionRefused) as e:
+            environ['wsgi.errors'].write(str(e))
+            return self.canned_handlers(environ, start_response, 'busy',
+                [('Retry-After', str(e.retry_after))])
         except (EnvironmentError) as e:
             environ['wsgi.errors'].write(str(e))
             return self.canned_handlers(environ, start_response, 'execution_failed')
@@ -590,10 +772,14 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             raise e
 
         if git_command == u'git-receive-pack':
-            # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
-            subprocess.call(u'git --git-dir "%s" update-server-info' % repo_path, shell=True)
+            # update-server-info (needed for pre-1.7.0.4 git clients using
+            # regular HTTP mode) and such run after receive-pack exits.
+            _process = getattr(out, 'process', None)
+            out = OnClose(out, lambda: self._after_push(repo_path, _process))
 
         headers = [('Content-type', 'application/x-%s-result' % git_command.encode('utf8'))]
+        if _size is not None:
+            headers.append(('Content-Length', str(_size)))
         return self.package_response(
             out,
             environ,
@@ -639,6 +825,8 @@ def assemble_WSGI_git_app(*args, **kw):
     options['content_path'] = os.path.abspath(options['content_path'].decode('utf8'))
     options['uri_marker'] = options['uri_marker'].decode('utf8')
 
+    options['repo_index'] = get_index(options['content_path'])
+
     selector = WSGIHandlerSelector()
     generic_handler = StaticWSGIServer(**options)
     git_inforefs_handler = GitHTTPBackendInfoRefs(**options)
@@ -24,6 +24,11 @@ import io
 import json
 import tempfile
 from wsgiref.headers import Headers
+try:
+    import response_compression
+except ImportError:
+    # used on its own, outside of G.E.S. gzip_response then does nothing.
+    response_compression = None
 
 # the errors strucutre is stolen from JSONRPC 2.0. v.1.0 does
 # not prescribe any particular way of dressing up error objects.
@@ -242,6 +247,9 @@ class WSGIJSONRPCApplication(JSONRPCHandlerRouter):
         elif hasattr(outIO,'read'):
             outIO.seek(0)
             retobj = iter( lambda: outIO.read(self.bufsize), '' )
+        if self.gzip_response and response_compression:
+            return response_compression.compress_response(
+                environ, start_response, "200 OK", headers, retobj)
         start_response("200 OK", headers)
         return retobj
 
@@ -279,4 +287,5 @@ class WSGIJSONRPCApplication(JSONRPCHandlerRouter):
          ('Content-Length', str(len(stdout)))
         ]
 
-        return self.package_response(io.BytesIO(stdout), environ, start_response, headers)
\ No newline at end of file
+        # a list, not a file, so that it can be compressed whole, with Content-Length.
+        return self.package_response([stdout], environ, start_response, headers)
\ No newline at end of file
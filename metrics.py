@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+'''
+Module provides counters, histograms and gauges for the server, and WSGI
+apps to count requests and to serve it all in the Prometheus text format.
+
+Counters and histograms are sharded per thread: each thread adds to dicts
+of its own, so counting takes no lock. Reading (a scrape) sums the shards.
+A thread's shard is registered, under a lock, on the first count it makes.
+Gauges, and counters kept elsewhere (like the hits of caches), are read
+from callables at scrape time only.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import bisect
+import threading
+
+from on_close import OnClose
+from request_trace import command_name
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+ROUTE_KEY = 'ges.route'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(labels, extra = ()):
+    _all = tuple(labels) + tuple(extra)
+    if not _all:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (_k, _escape(_v)) for _k, _v in _all])
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(int(value))
+
+class Metrics(object):
+    '''
+    Registry of metrics. Labels are passed as tuples of (name, value) pairs,
+    always in the same order for the same metric: (('route', 'git-rpc'),)
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = [] # (thread, counters, histograms)
+        self._retired = ({}, {}) # shards of threads gone, summed
+        self._lock = threading.Lock()
+        self._described = {} # name : (kind, help, buckets)
+        self._order = []
+        self._collectors = {} # name : callable
+
+    def describe(self, name, kind, help, buckets = None):
+        '''
+        @param kind 'counter', 'gauge' or 'histogram'
+
+        @param buckets For histograms, sorted upper bounds. Default is
+            DEFAULT_BUCKETS.
+        '''
+        if kind == 'histogram' and buckets is None:
+            buckets = DEFAULT_BUCKETS
+        if name not in self._described:
+            self._order.append(name)
+        self._described[name] = (kind, help, buckets and tuple(buckets))
+
+    def collect(self, name, kind, help, fn):
+        '''
+        Adds a metric kept elsewhere, read at scrape time.
+
+        @param fn Callable returning a number, or a dict of labels tuple :
+            number. Exceptions in it leave the metric out of the scrape.
+        '''
+        self.describe(name, kind, help)
+        self._collectors[name] = fn
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            self._lock.acquire()
+            try:
+                self._shards.append((threading.current_thread(), shard[0], shard[1]))
+            finally:
+                self._lock.release()
+            return shard
+
+    def inc(self, name, labels = (), value = 1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        '''Adds value (seconds, usually) to a histogram. describe() it first.'''
+        histograms = self._shard()[1]
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # per bucket (not cumulative), then +Inf, then the sum.
+            counts = histograms[key] = [0] * (len(self._described[name][2]) + 1) + [0.0]
+        counts[bisect.bisect_left(self._described[name][2], value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _merge(counters, histograms, into_counters, into_histograms):
+        # .items() copies the dict in one go, while its thread may add to it.
+        for key, value in counters.items():
+            into_counters[key] = into_counters.get(key, 0) + value
+        for key, counts in histograms.items():
+            counts = list(counts)
+            _into = into_histograms.get(key)
+            if _into is None:
+                into_histograms[key] = counts
+            else:
+                for i in xrange(len(counts)):
+                    _into[i] += counts[i]
+
+    def values(self):
+        '''
+        @returns (counters, histograms), both dicts of (name, labels) : sum
+            of all threads. Histograms are lists of per-bucket counts, the
+            +Inf count and the sum.
+        '''
+        counters, histograms = {}, {}
+        self._lock.acquire()
+        try:
+            _alive = []
+            for shard in self._shards:
+                if shard[0].is_alive():
+                    _alive.append(shard)
+                else:
+                    # done counting. Folded, so that shards of short-lived
+                    # threads do not pile up.
+                    self._merge(shard[1], shard[2], *self._retired)
+            self._shards = _alive
+            self._merge(self._retired[0], self._retired[1], counters, histograms)
+            for thread, _c, _h in self._shards:
+                self._merge(_c, _h, counters, histograms)
+        finally:
+            self._lock.release()
+        return counters, histograms
+
+    def render(self):
+        '''@returns All metrics, in the Prometheus text exposition format.'''
+        counters, histograms = self.values()
+        _by_name = {}
+        for (name, labels), value in counters.items() + histograms.items():
+            _by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in self._order:
+            kind, help, buckets = self._described[name]
+            if name in self._collectors:
+                try:
+                    _v = self._collectors[name]()
+                except Exception:
+                    continue
+                samples = _v.items() if isinstance(_v, dict) else [((), _v)]
+            else:
+                samples = _by_name.get(name, [])
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(samples):
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+                    continue
+                _cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-1]):
+                    _cumulative += count
+                    lines.append('%s_bucket%s %s' % (name,
+                        _labels(labels, [('le', _number(float(bound)))]), _cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(float(value[-1]))))
+                lines.append('%s_count%s %s' % (name, _labels(labels), _cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def watch_caches(self, caches, name = 'ges_cache'):
+        '''
+        Adds hits, misses and hit ratio of caches.
+
+        @param caches Dict of cache name : object whose stats() has hits
+            and misses, as numbers or as dicts of numbers (by kind).
+        '''
+        def _read(key):
+            _values = {}
+            for cache_name, cache in caches.items():
+                _v = cache.stats()[key]
+                _values[(('cache', cache_name),)] = sum(_v.values()) if isinstance(_v, dict) else _v
+            return _values
+        def _ratio():
+            _hits, _misses = _read('hits'), _read('misses')
+            return dict([(labels, _hits[labels] and float(_hits[labels]) / (_hits[labels] + _misses[labels]) or 0.0)
+                for labels in _hits])
+        self.collect(name + '_hits_total', 'counter', 'Cache hits.', lambda: _read('hits'))
+        self.collect(name + '_misses_total', 'counter', 'Cache misses.', lambda: _read('misses'))
+        self.collect(name + '_hit_ratio', 'gauge', 'Cache hits over lookups, since start.', _ratio)
+
+    def watch_thread_pool(self, pool, name = 'ges_server_threads'):
+        '''
+        Adds gauges for a wsgiserver.ThreadPool: worker threads idle and
+        busy, and connections queued for a worker.
+        '''
+        def _threads():
+            _idle = pool.idle
+            return {
+                (('state', 'idle'),): _idle,
+                (('state', 'busy'),): len(pool._threads) - _idle
+                }
+        self.collect(name, 'gauge', 'Worker threads of the HTTP server.', _threads)
+        self.collect(name + '_queue', 'gauge',
+            'Connections waiting for a worker thread.', lambda: pool.qsize)
+
+# The one instance shared by all apps in the process.
+registry = Metrics()
+registry.describe('ges_processes_started_total', 'counter', 'Processes (git, mostly) started.')
+registry.describe('ges_processes_exited_total', 'counter', 'Processes (git, mostly) done with.')
+
+def process_started(argv):
+    '''
+    Counts a process started. Call process_exited() with what this returns
+    when done with it.
+    '''
+    name = command_name(argv)
+    registry.inc('ges_processes_started_total', (('cmd', name),))
+    return name
+
+def process_exited(name):
+    registry.inc('ges_processes_exited_total', (('cmd', name),))
+
+def live_processes():
+    '''@returns dict of labels tuple : processes started and not exited.'''
+    counters = registry.values()[0]
+    _live = {}
+    for (name, labels), value in counters.items():
+        if name == 'ges_processes_started_total':
+            _live[labels] = _live.get(labels, 0) + value
+        elif name == 'ges_processes_exited_total':
+            _live[labels] = _live.get(labels, 0) - value
+    return _live
+
+registry.collect('ges_processes_running', 'gauge',
+    'Processes (git, mostly) started and not yet done with, by command.', live_processes)
+
+def route(name, app):
+    '''
+    @returns WSGI app passing requests on to app, noting for
+        MetricsMiddleware that they took the named route.
+    '''
+    def _route(environ, start_response):
+        environ[ROUTE_KEY] = name
+        return app(environ, start_response)
+    return _route
+
+class Counted(OnClose):
+    '''
+    OnClose wrapper that also counts the bytes sent, passing the count to
+    on_close.
+    '''
+
+    def __init__(self, iterable, on_close):
+        OnClose.__init__(self, iterable, lambda: on_close(self.sent))
+        self.sent = 0
+
+    def next(self):
+        chunk = self.iterator.next()
+        self.sent += len(chunk)
+        return chunk
+
+    def splice_finished(self, spliced = 0):
+        self.sent += spliced
+        return self.iterable.splice_finished(spliced)
+
+class MetricsMiddleware(object):
+    '''
+    WSGI middleware counting requests, their duration and bytes sent, by
+    route (see route()), method and status.
+    '''
+
+    methods = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
+
+    def __init__(self, app, metrics = None):
+        self.app = app
+        self.metrics = metrics or registry
+        self.metrics.describe('ges_requests_total', 'counter', 'HTTP requests served.')
+        self.metrics.describe('ges_request_duration_seconds', 'histogram',
+            'Time from the request coming in to the response sent.')
+        self.metrics.describe('ges_response_bytes_total', 'counter', 'Response body bytes sent.')
+
+    def __call__(self, environ, start_response):
+        _start = time.time()
+        _status = ['500']
+
+        def _record(sent):
+            _route = environ.get(ROUTE_KEY, 'none')
+            _method = environ.get('REQUEST_METHOD')
+            if _method not in self.methods:
+                _method = 'other'
+            self.metrics.inc('ges_requests_total',
+                (('route', _route), ('method', _method), ('status', _status[0])))
+            self.metrics.observe('ges_request_duration_seconds',
+                (('route', _route),), time.time() - _start)
+            if sent:
+                self.metrics.inc('ges_response_bytes_total', (('route', _route),), sent)
+
+        def _start_response(status, headers, exc_info = None):
+            _status[0] = status[:3]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+
+        try:
+            response = self.app(environ, _start_response)
+        except:
+            _status[0] = '500'
+            _record(0)
+            raise
+        return Counted(response, _record)
+
+class MetricsApp(object):
+    '''WSGI app serving metrics in the Prometheus text format.'''
+
+    def __init__(self, metrics = None):
+        self.metrics = metrics or registry
+
+    def __call__(self, environ, start_response):
+        _body = self.metrics.render()
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(_body))),
+            ('Cache-Control', 'no-store')
+            ])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [_body]
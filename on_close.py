@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Module provides OnClose, the wrapper for WSGI response iterables that need
+something done once the server is done sending them: a slot given back
+(admission), a trace ended (request_trace), a request counted (metrics),
+hooks run after a push (git_http_backend).
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+class OnClose(object):
+    '''
+    Wraps a WSGI response iterable and calls callback once the WSGI server is
+    done with it (calls .close()), be it after the last chunk or on error.
+    The callback is called once, however many times close() is.
+
+    Wrappers stack. Any other attribute is looked up on the wrapped iterable,
+    so that servers still find what they look for there (splice_source() of
+    SubprocessIOChunker, say).
+    '''
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.callback = callback
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.iterator.next()
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            callback, self.callback = self.callback, None
+            if callback:
+                callback()
+
+    def __getattr__(self, name):
+        if name == 'iterable':
+            # not set yet. Looking it up on itself would never end.
+            raise AttributeError(name)
+        return getattr(self.iterable, name)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+'''
+Module provides an on-disk cache of `git upload-pack --stateless-rpc`
+responses, with coalescing of identical, concurrent requests.
+
+When many clients fetch the same repo at the same state (CI fan-out), they
+send byte-for-byte identical requests and get byte-for-byte identical packs.
+The first request starts one git process, which writes into a cache file.
+That request and all identical ones arriving meanwhile are fed from that
+file as it grows. Later ones get the finished file.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from git.utils import refs_fingerprint
+
+class PackFill(threading.Thread):
+    '''
+    Drains a response iterable (SubprocessIOChunker) into a temp file in a
+    thread of its own, so that it goes at git's pace, not that of the
+    slowest of the clients reading it.
+
+    Once more than the cache's max_bytes is written, the fill is dropped
+    from the cache (see PackCache._drop): readers it has keep reading, new
+    ones don't join, and the file goes away with the last of them.
+    '''
+    def __init__(self, cache, key, repo_path, source):
+        super(PackFill, self).__init__()
+        self.daemon = True
+        self.cache = cache
+        self.key = key
+        self.repo_path = repo_path
+        self.source = source
+        _fd, self.temp_name = tempfile.mkstemp(prefix = 'tmp', dir = cache.path)
+        self.temp_file = os.fdopen(_fd, 'wb')
+        self.written = 0
+        self.done = False
+        self.failed = False
+        self.uncacheable = False
+        self.changed = threading.Condition()
+
+    def run(self):
+        try:
+            try:
+                for chunk in self.source:
+                    self.temp_file.write(chunk)
+                    # readers open the file on their own. They must see it all.
+                    self.temp_file.flush()
+                    self.changed.acquire()
+                    try:
+                        self.written += len(chunk)
+                        self.changed.notify_all()
+                    finally:
+                        self.changed.release()
+                    if self.written > self.cache.max_bytes and not self.uncacheable:
+                        self.cache._drop(self)
+            finally:
+                self.temp_file.close()
+                if hasattr(self.source, 'close'):
+                    self.source.close()
+        except Exception:
+            self.failed = True
+        self.cache._finish(self)
+        self.changed.acquire()
+        try:
+            self.done = True
+            self.changed.notify_all()
+        finally:
+            self.changed.release()
+
+    def reader(self, chunk_size):
+        '''
+        @returns An iterable yielding what was, and will be, written to the
+            temp file, ending when the fill is done.
+        '''
+        return PackFillReader(self, chunk_size)
+
+class PackFillReader(object):
+    '''
+    Follows the temp file of a PackFill, like `tail -f`, until it is complete.
+    '''
+    def __init__(self, fill, chunk_size):
+        self.fill = fill
+        self.chunk_size = chunk_size
+        # Opened right away. The file may be renamed or evicted later, but we
+        # keep reading it through our handle.
+        self.file = open(fill.temp_name, 'rb')
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        fill = self.fill
+        fill.changed.acquire()
+        try:
+            while self.position >= fill.written and not fill.done:
+                fill.changed.wait()
+            available = fill.written - self.position
+            failed = fill.failed
+        finally:
+            fill.changed.release()
+        if available > 0:
+            chunk = self.file.read(min(available, self.chunk_size))
+            self.position += len(chunk)
+            return chunk
+        self.close()
+        if failed:
+            raise IOError('Generation of the pack failed.')
+        raise StopIteration
+
+    def close(self):
+        self.file.close()
+
+class PackCache(object):
+    '''
+    Keyed by (repo path, ref state, service, hash of request body), which
+    is all the response of upload-pack depends on. Entries are files,
+    evicted least recently used first, when over max_bytes.
+    '''
+
+    def __init__(self, path, max_bytes = 2 * 1024 * 1024 * 1024, chunk_size = 65536, max_body_bytes = 1024 * 1024):
+        '''
+        @param path Folder to keep packs in. Created if missing. Cleared, as
+            we cannot tell which repo state the packs left there belong to.
+
+        @param max_bytes Total size of cached responses, in bytes.
+
+        @param max_body_bytes Largest request body callers should make a
+            key() of. key() hashes the body, which must be in memory.
+        '''
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_body_bytes = max_body_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict() # key : (size, repo_path)
+        self._filling = {} # key : PackFill
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def key(self, repo_path, service, body):
+        '''
+        @returns A string key, or None if the repo's ref state cannot be
+            determined (and the response must not be cached).
+        '''
+        _refs = refs_fingerprint(repo_path)
+        if _refs is None:
+            return None
+        _k = hashlib.sha1()
+        for _e in [repo_path, repr(_refs), service, hashlib.sha1(body).hexdigest()]:
+            if isinstance(_e, unicode):
+                _e = _e.encode('utf8')
+            _k.update(_e)
+            _k.update('\0')
+        return _k.hexdigest()
+
+    def get(self, key, repo_path, producer):
+        '''
+        Returns the cached response, or a response being produced for an
+        identical request, or starts producing one.
+
+        @param key String from key()
+
+        @param repo_path Used for invalidation. See invalidate()
+
+        @param producer A callable returning an iterable with the response.
+            Called at most once, in the calling thread, so that startup
+            errors are raised here, as if there was no cache.
+
+        @returns (data, size) Data is an open file (size is int) or an
+            iterable (size is None).
+        '''
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-inserting moves the entry to the "most recently used" end.
+                self._entries[key] = entry
+                self.hits += 1
+            fill = self._filling.get(key)
+            if fill is not None:
+                self.coalesced += 1
+                return fill.reader(self.chunk_size), None
+        finally:
+            self._lock.release()
+        if entry is not None:
+            try:
+                return open(os.path.join(self.path, key), 'rb'), entry[0]
+            except IOError:
+                self._forget(key)
+
+        source = producer()
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            fill = self._filling.get(key)
+            if fill is None:
+                fill = self._filling[key] = PackFill(self, key, repo_path, source)
+                fill.start()
+                source = None
+            # while under lock, before the fill is done and its file renamed.
+            reader = fill.reader(self.chunk_size)
+        finally:
+            self._lock.release()
+        if source is not None:
+            # someone beat us to it while we were starting git.
+            if hasattr(source, 'close'):
+                source.close()
+        return reader, None
+
+    def _finish(self, fill):
+        '''Called by PackFill when done.'''
+        self._lock.acquire()
+        try:
+            if self._filling.get(fill.key) is fill:
+                del self._filling[fill.key]
+            if fill.failed or fill.uncacheable \
+                    or getattr(fill, 'invalidated', False):
+                _keep = False
+            else:
+                _keep = True
+                try:
+                    os.rename(fill.temp_name, os.path.join(self.path, fill.key))
+                except OSError:
+                    _keep = False
+            if _keep:
+                self._entries[fill.key] = (fill.written, fill.repo_path)
+                self.bytes += fill.written
+                self._evict()
+        finally:
+            self._lock.release()
+        if not _keep:
+            try:
+                os.remove(fill.temp_name)
+            except OSError:
+                pass
+
+    def _drop(self, fill):
+        '''
+        Called by PackFill when it gets too large to keep. Identical requests
+        coming later start their own git, and the temp file is removed (open
+        handles of readers keep it readable on POSIX).
+        '''
+        self._lock.acquire()
+        try:
+            fill.uncacheable = True
+            if self._filling.get(fill.key) is fill:
+                del self._filling[fill.key]
+        finally:
+            self._lock.release()
+        try:
+            os.remove(fill.temp_name)
+        except OSError:
+            # Windows. Removed in _finish()
+            pass
+
+    def _forget(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[0]
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        '''Removes least recently used entries until we fit. Lock must be held.'''
+        while self.bytes > self.max_bytes and self._entries:
+            key, (size, repo_path) = self._entries.popitem(last = False)
+            self._remove(key, size)
+
+    def _remove(self, key, size):
+        self.bytes -= size
+        try:
+            # open file handles on POSIX keep serving removed files.
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            pass
+
+    def invalidate(self, repo_path):
+        '''
+        Drops all cached responses for the repo. Call when refs change.
+        (Keys include ref state, so stale entries would not be served anyway,
+        but they would take up space until evicted.)
+        '''
+        self._lock.acquire()
+        try:
+            for key, (size, _repo_path) in self._entries.items():
+                if _repo_path == repo_path:
+                    del self._entries[key]
+                    self._remove(key, size)
+            for fill in self._filling.values():
+                if fill.repo_path == repo_path:
+                    # readers get what they asked for. It's just not kept.
+                    fill.invalidated = True
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        @returns dict with keys: hits, misses, coalesced, entries, filling,
+            bytes, max_bytes
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+            'filling': len(self._filling),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes
+            }
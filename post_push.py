@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''
+Module provides a background queue of work to do in a repo after a push,
+like `git update-server-info`.
+
+Such work does not need to hold up the client that pushed, and must not
+start before `git receive-pack` is done updating refs. It also does not need
+to be done once per push: when many pushes land in a repo within `delay`
+seconds of each other, hooks run once, after the last of them.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+
+import spawner
+from git.utils import git_executable
+
+def update_server_info(repo_path):
+    '''
+    Refreshes info/refs and objects/info/packs. Needed by "dumb" HTTP clients
+    (pre-1.6.6 git) that read these files instead of asking git.
+    '''
+    if isinstance(repo_path, unicode):
+        repo_path = repo_path.encode('utf8')
+    _r = spawner.popen([git_executable(), '--git-dir', repo_path, 'update-server-info']).wait()
+    if _r:
+        raise EnvironmentError('git update-server-info exited with %s for %s' % (_r, repo_path))
+
+class PostPushQueue(object):
+    '''
+    Runs hooks for pushed-to repos in a thread of its own, one repo at a time.
+
+    A repo scheduled while its hooks are already running gets another run
+    after that one, as the running one may have missed the latest push.
+    '''
+
+    def __init__(self, hooks = None, delay = 1.0):
+        '''
+        @param hooks List of callables taking the repo path. Called in order.
+            An exception in one is counted (see stats()) and does not stop
+            the others. Default is [update_server_info]
+
+        @param delay Seconds to wait, from the first push, for more pushes
+            to the same repo to coalesce with.
+        '''
+        if hooks is None:
+            hooks = [update_server_info]
+        self.hooks = hooks
+        self.delay = delay
+        self.scheduled = 0
+        self.coalesced = 0
+        self.runs = 0
+        self.failures = 0
+        self.last_error = None
+        self._pending = {} # repo_path : (due time, [processes to wait for])
+        self._running = None
+        self._thread = None
+        self._changed = threading.Condition(threading.Lock())
+
+    def schedule(self, repo_path, process = None):
+        '''
+        @param process The subprocess.Popen of `git receive-pack` that did
+            the push. Hooks are not run until it exits.
+        '''
+        self._changed.acquire()
+        try:
+            self.scheduled += 1
+            entry = self._pending.get(repo_path)
+            if entry is None:
+                entry = self._pending[repo_path] = (time.time() + self.delay, [])
+            else:
+                self.coalesced += 1
+            if process is not None:
+                entry[1].append(process)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._changed.notify_all()
+        finally:
+            self._changed.release()
+
+    def _next(self):
+        '''Blocks until a repo is due. Lock must be held.'''
+        while True:
+            _due = [(_e[0], _p) for _p, _e in self._pending.items()]
+            if _due:
+                _time, repo_path = min(_due)
+                _wait = _time - time.time()
+                if _wait <= 0:
+                    return repo_path, self._pending.pop(repo_path)[1]
+                self._changed.wait(_wait)
+            else:
+                self._changed.wait()
+
+    def _run(self):
+        while True:
+            self._changed.acquire()
+            try:
+                repo_path, processes = self._next()
+                self._running = repo_path
+            finally:
+                self._changed.release()
+            try:
+                for process in processes:
+                    process.wait()
+                for hook in self.hooks:
+                    try:
+                        hook(repo_path)
+                    except Exception as e:
+                        self.failures += 1
+                        self.last_error = '%s: %s' % (repo_path, e)
+            finally:
+                self._changed.acquire()
+                try:
+                    self.runs += 1
+                    self._running = None
+                    self._changed.notify_all()
+                finally:
+                    self._changed.release()
+
+    def wait_idle(self, timeout = None):
+        '''
+        Blocks until nothing is pending or running.
+
+        @returns True if idle, False if timeout (seconds) ran out first.
+        '''
+        _end = timeout is not None and time.time() + timeout
+        self._changed.acquire()
+        try:
+            while self._pending or self._running is not None:
+                if _end is False:
+                    self._changed.wait()
+                else:
+                    _left = _end - time.time()
+                    if _left <= 0:
+                        return False
+                    self._changed.wait(_left)
+            return True
+        finally:
+            self._changed.release()
+
+    def stats(self):
+        '''
+        @returns dict with keys: scheduled, coalesced, runs, failures,
+            pending, last_error
+        '''
+        return {
+            'scheduled': self.scheduled,
+            'coalesced': self.coalesced,
+            'runs': self.runs,
+            'failures': self.failures,
+            'pending': len(self._pending),
+            'last_error': self.last_error
+            }
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+'''
+Module provides an in-memory index of folders and git repo folders found under
+the served content root, allowing requests to resolve paths to repos without
+listing folders on every path segment on every request.
+
+The index is built once, when created, and is kept current by inotify (Linux)
+or, where that is not available, by rescanning the content root periodically.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import atexit
+import errno
+import struct
+import threading
+import time
+
+# Lowercased names a folder must contain to be treated as a (bare) git repo.
+GIT_FOLDER_SIGNATURE = frozenset(['head', 'info', 'objects', 'refs'])
+
+class FolderNode(object):
+    '''
+    What we know about one folder under the content root.
+
+    names - frozenset of lowercased names of all entries in the folder.
+        Used for matching against git folder signatures.
+    subdirs - sorted list of names of contained folders. Empty for repo folders,
+        as we don't descend into those.
+    is_repo - True if names match GIT_FOLDER_SIGNATURE.
+    '''
+    __slots__ = ['names', 'subdirs', 'is_repo']
+
+    def __init__(self, names, subdirs, is_repo):
+        self.names = names
+        self.subdirs = subdirs
+        self.is_repo = is_repo
+
+class RepoIndex(object):
+    '''
+    Maps absolute folder paths under the content root to FolderNode objects.
+
+    Readers never lock. Nodes are replaced, never changed in place, and single
+    dictionary reads and writes are atomic. Anything not found in the index is
+    checked on disk and, if it is a folder, added to the index. This covers
+    changes the watcher has not told us about yet.
+    '''
+    def __init__(self, content_path, watch='auto', rescan_interval=60):
+        '''
+        @param content_path Path to the root of served folders.
+
+        @param watch One of:
+            'auto' - use inotify if available, periodic rescan if not.
+            'inotify' - same as 'auto'.
+            'rescan' - always use periodic rescan. Use this when other machines
+                write into the content root over a network file system. inotify
+                only sees changes made through the local kernel.
+            None - never refresh on its own. (Call refresh() when you know
+                things changed.)
+
+        @param rescan_interval Seconds between full rescans in 'rescan' mode.
+        '''
+        self.base_path = os.path.abspath(content_path)
+        self.rescan_interval = rescan_interval
+        self._nodes = {}
+        self._lock = threading.RLock()
+        self.watching = False
+        if watch in ('auto', 'inotify'):
+            self.watching = _get_watcher() is not None
+        self.rebuild()
+        if watch and not self.watching:
+            _start_rescanner(self)
+
+    ################
+    # Index maintenance
+    ################
+
+    def _read_folder(self, path):
+        '''Returns a FolderNode for the folder or None if it is not a folder.'''
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            return None
+        names = frozenset([i.lower() for i in entries])
+        is_repo = GIT_FOLDER_SIGNATURE.issubset(names)
+        subdirs = []
+        if not is_repo:
+            for name in entries:
+                if os.path.isdir(os.path.join(path, name)):
+                    subdirs.append(name)
+            subdirs.sort()
+        return FolderNode(names, subdirs, is_repo)
+
+    def _scan(self, path, seen, deep=True):
+        '''
+        (Re)reads the folder and, recursively, all folders under it,
+        dropping nodes for folders that disappeared. With deep=False, only
+        folders not in the index yet are read recursively.
+        Must be called with self._lock held.
+        '''
+        real = os.path.realpath(path)
+        if real in seen:
+            # symlink loop. Treat as opaque folder.
+            return
+        seen.add(real)
+        if self.watching:
+            # watching first, reading second. Else, whatever lands in the
+            # folder in between is missed.
+            if not _watcher.add(self, path):
+                # out of watches. Fall back to rescanning.
+                self.watching = False
+                _start_rescanner(self)
+        old = self._nodes.get(path)
+        node = self._read_folder(path)
+        if node is None:
+            self._forget(path)
+            return
+        self._nodes[path] = node
+        if old:
+            for name in set(old.subdirs).difference(node.subdirs):
+                self._forget(os.path.join(path, name))
+        for name in node.subdirs:
+            _s = os.path.join(path, name)
+            if deep or _s not in self._nodes:
+                self._scan(_s, seen)
+
+    def _forget(self, path):
+        '''Drops the node for the folder and all nodes under it.'''
+        node = self._nodes.pop(path, None)
+        if node:
+            for name in node.subdirs:
+                self._forget(os.path.join(path, name))
+
+    def rebuild(self):
+        '''Rescans the whole content root.'''
+        self._lock.acquire()
+        try:
+            self._scan(self.base_path, set())
+        finally:
+            self._lock.release()
+
+    def refresh(self, path, deep=True):
+        '''
+        Rescans the folder (and everything under it) and updates the
+        listing of its parent folder. Call this after creating or removing
+        folders if you need the index to see the change right away.
+
+        @param path Absolute path to a folder under the content root.
+
+        @param deep If False, rereads only the folder itself and folders
+            that are new to the index. (The watcher knows which folders
+            changed and uses this.)
+        '''
+        path = os.path.abspath(path)
+        if not self._inside(path):
+            return
+        self._lock.acquire()
+        try:
+            parent = os.path.dirname(path)
+            if deep and path != self.base_path and self._inside(parent):
+                parent_node = self._nodes.get(parent)
+                if parent_node is not None:
+                    self._nodes[parent] = self._read_folder(parent) or parent_node
+            self._scan(path, set(), deep)
+        finally:
+            self._lock.release()
+
+    def _inside(self, path):
+        '''True if path is the content root or a path under it.'''
+        return path == self.base_path or path.startswith(self.base_path.rstrip(os.sep) + os.sep)
+
+    ################
+    # Lookups
+    ################
+
+    def get(self, path):
+        '''
+        @param path Absolute path.
+
+        @returns FolderNode or None if path is not a folder.
+        '''
+        node = self._nodes.get(path)
+        if node is None and self._inside(path) and os.path.isdir(path):
+            # Not seen yet. May be new, may be inside of a repo folder.
+            _parent = self._nodes.get(os.path.dirname(path))
+            if _parent is not None and not _parent.is_repo:
+                self.refresh(path)
+                node = self._nodes.get(path)
+            if node is None:
+                node = self._read_folder(path)
+        return node
+
+    def is_repo(self, path, signature=None):
+        '''
+        @param path Absolute path.
+
+        @param signature Optional set of lowercased names the folder must
+            contain in addition to the usual GIT_FOLDER_SIGNATURE.
+
+        @returns True if path is a git repo folder.
+        '''
+        node = self.get(path)
+        if node is None or not node.is_repo:
+            return False
+        return not signature or signature.issubset(node.names)
+
+    def list_dir(self, path):
+        '''
+        @param path Absolute path to a folder.
+
+        @returns A list of tuples (name, is_repo), one per contained folder,
+            sorted by name. Empty list if path is not a folder.
+        '''
+        node = self.get(path)
+        if node is None:
+            return []
+        return [
+            (name, self.is_repo(os.path.join(path, name)))
+            for name in node.subdirs
+            ]
+
+    def find_repo_in_path(self, relative_path):
+        '''Takes a path relative to base path and tries to
+        find a repo folder somewhere on the path. Stops if repo is found
+        or if mid-path is not a folder anymore.
+
+        @param relative_path A sanitized string like "asdf/qwer/zxcv" or "",
+            representing the path relative to the base path.
+
+        @returns (repo_path, unconsumed_path) A tuple of two strings.
+            repo_path is None if no repo is found, ABSOLUTE path otherwise.
+            unconsumed_path is the unix-styled remainder of the path from the
+            point where we ran out of real folders, or "" if all is consumed.
+        '''
+        _path_chain = relative_path.split('/')
+        if _path_chain[0] != '':
+            # root of the tree is '', not part of a sanitized path. Inserting:
+            _path_chain.insert(0, '')
+        _p = self.base_path
+        while _path_chain:
+            _p = os.path.join(_p, _path_chain.pop(0))
+            node = self.get(os.path.normpath(_p))
+            if node is None:
+                # not a folder. Remaining section of path does not point to
+                # a real file system path.
+                _path_chain.insert(0, os.path.split(_p)[1])
+                return None, '/'.join(_path_chain)
+            elif node.is_repo:
+                return _p, '/'.join(_path_chain)
+        return None, ''
+
+################
+# inotify-based watcher. One inotify instance and one thread per process.
+################
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(threading.Thread):
+    '''
+    Reads inotify events for all watched folders of all RepoIndex instances
+    and asks the owning index to refresh the folders that changed.
+    '''
+    def __init__(self, ctypes, libc):
+        super(InotifyWatcher, self).__init__()
+        self.daemon = True
+        self._ctypes = ctypes
+        self._libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(errno.ENOSYS, 'inotify_init failed')
+        self._wds = {} # wd : (index, path)
+        self._lock = threading.Lock()
+        self.stopping = False
+
+    def stop(self):
+        self.stopping = True
+
+    def add(self, index, path):
+        '''
+        @returns False if the watch could not be added (usually, out of
+            inotify watches - see /proc/sys/fs/inotify/max_user_watches)
+        '''
+        _p = path
+        if isinstance(_p, unicode):
+            _p = _p.encode(sys.getfilesystemencoding() or 'utf8')
+        wd = self._libc.inotify_add_watch(self.fd, _p, _WATCH_MASK)
+        if wd < 0:
+            # folder may have gone away already. That's fine.
+            return self._ctypes.get_errno() not in (errno.ENOSPC, errno.ENOMEM)
+        self._lock.acquire()
+        try:
+            self._wds[wd] = (index, path)
+        finally:
+            self._lock.release()
+        return True
+
+    def run(self):
+        try:
+            self._run()
+        except:
+            # Daemon thread outlives module globals at interpreter shutdown.
+            # Nothing worth reporting then.
+            if not self.stopping:
+                raise
+
+    def _run(self):
+        _header = _EVENT_HEADER
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if self.stopping:
+                return
+            changed = {}
+            overflow = False
+            pos = 0
+            self._lock.acquire()
+            try:
+                while pos + _header.size <= len(data):
+                    wd, mask, cookie, length = _header.unpack_from(data, pos)
+                    pos += _header.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                    entry = self._wds.get(wd)
+                    if mask & IN_IGNORED:
+                        self._wds.pop(wd, None)
+                    if entry:
+                        changed[entry] = True
+                indexes = set([_e[0] for _e in self._wds.values()])
+            finally:
+                self._lock.release()
+            try:
+                if overflow:
+                    for index in indexes:
+                        index.rebuild()
+                else:
+                    for index, path in changed:
+                        index.refresh(path, deep=False)
+            except Exception:
+                # never let one bad folder kill the watcher.
+                pass
+
+_watcher = None
+_watcher_started = False
+_watcher_lock = threading.Lock()
+
+def _get_watcher():
+    '''
+    Starts the process-wide watcher on first call. Only indexes asking for
+    inotify call this, so importing the module starts no threads.
+
+    @returns InotifyWatcher or None if inotify is not available.
+    '''
+    global _watcher, _watcher_started
+    _watcher_lock.acquire()
+    try:
+        if not _watcher_started:
+            _watcher_started = True
+            _watcher = _start_watcher()
+        return _watcher
+    finally:
+        _watcher_lock.release()
+
+def _start_watcher():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        watcher = InotifyWatcher(ctypes, libc)
+    except (ImportError, OSError, AttributeError):
+        return None
+    watcher.start()
+    atexit.register(watcher.stop)
+    return watcher
+
+def _start_rescanner(index):
+    '''Starts a thread that periodically rebuilds the index.'''
+    def rescan():
+        while True:
+            time.sleep(index.rescan_interval)
+            try:
+                index.rebuild()
+            except Exception:
+                pass
+    t = threading.Thread(target=rescan)
+    t.daemon = True
+    t.start()
+
+################
+# Process-wide registry
+################
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(content_path, **kw):
+    '''
+    Returns the process-wide RepoIndex for the content root, creating it
+    if needed. Keyword args are passed to RepoIndex on creation.
+    '''
+    content_path = os.path.abspath(content_path)
+    _indexes_lock.acquire()
+    try:
+        index = _indexes.get(content_path)
+        if index is None:
+            index = _indexes[content_path] = RepoIndex(content_path, **kw)
+        return index
+    finally:
+        _indexes_lock.release()
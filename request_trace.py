@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''
+Module provides request-scoped tracing of the processes (git, mostly) a
+request starts.
+
+TraceMiddleware starts a Trace for each request, current for the thread
+serving it. Code starting a process asks for a Span (start_span()) and
+finishes it with the exit code and the bytes it fed the process and got out
+of it. Git.execute and SubprocessIOChunker do. Outside of a traced request,
+start_span() returns None and nothing is recorded.
+
+Per request, the middleware adds a Server-Timing header (process time per
+git subcommand, as of when the headers go out) and, once the response is
+sent, logs one JSON line with all spans. Many short spans of the same
+subcommand in one request point to an N+1 pattern of forks.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import time
+import json
+import logging
+import threading
+
+from on_close import OnClose
+
+LOGNAME = 'ges.trace'
+
+logging.getLogger(LOGNAME).addHandler(logging.NullHandler())
+
+_local = threading.local()
+
+def command_name(argv):
+    '''
+    @returns Name of what argv runs, for grouping. For git, with the
+        subcommand ('git-upload-pack'), else the program's name.
+    '''
+    if isinstance(argv, basestring):
+        argv = argv.split()
+    if not argv:
+        return 'unknown'
+    _name = os.path.basename(argv[0])
+    if not _name.startswith('git'):
+        return _name
+    _name = 'git'
+    _args = iter(argv[1:])
+    for _a in _args:
+        if _a in ('-c', '-C', '--git-dir', '--work-tree', '--namespace'):
+            next(_args, None)
+        elif not _a.startswith('-'):
+            return 'git-' + _a
+    return _name
+
+class Span(object):
+    '''One process. Finished spans have end set.'''
+
+    def __init__(self, trace, argv):
+        self.trace = trace
+        self.argv = argv
+        self.name = command_name(argv)
+        self.start = time.time()
+        self.end = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.returncode = None
+
+    def finish(self, returncode = None, bytes_in = None, bytes_out = None):
+        '''Later calls are ignored.'''
+        if self.end is not None:
+            return
+        if bytes_in is not None:
+            self.bytes_in = bytes_in
+        if bytes_out is not None:
+            self.bytes_out = bytes_out
+        self.returncode = returncode
+        self.end = time.time()
+
+    @property
+    def duration(self):
+        '''Seconds. For unfinished spans, so far.'''
+        return (self.end or time.time()) - self.start
+
+    def as_dict(self):
+        _argv = self.argv
+        if isinstance(_argv, basestring):
+            _argv = [_argv]
+        return {
+            'cmd': self.name,
+            'argv': [isinstance(_a, unicode) and _a or str(_a).decode('utf8', 'replace') for _a in _argv],
+            'ms': round(self.duration * 1000, 2),
+            'in': self.bytes_in,
+            'out': self.bytes_out,
+            'exit': self.returncode,
+            'finished': self.end is not None
+            }
+
+class Trace(object):
+    '''Spans of one request. Spans may be added from other threads.'''
+
+    def __init__(self, method = None, path = None):
+        self.method = method
+        self.path = path
+        self.status = None
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, argv):
+        span = Span(self, argv)
+        self._lock.acquire()
+        try:
+            self.spans.append(span)
+        finally:
+            self._lock.release()
+        return span
+
+    def _spans(self):
+        self._lock.acquire()
+        try:
+            return list(self.spans)
+        finally:
+            self._lock.release()
+
+    def server_timing(self):
+        '''
+        @returns Server-Timing header value. One metric per command name,
+            with the time of its spans summed and their count as desc, then
+            "app", the time since the request came in.
+        '''
+        _by_name = {}
+        _order = []
+        for span in self._spans():
+            if span.name not in _by_name:
+                _by_name[span.name] = [0, 0.0]
+                _order.append(span.name)
+            _by_name[span.name][0] += 1
+            _by_name[span.name][1] += span.duration
+        _metrics = []
+        for name in _order:
+            _count, _time = _by_name[name]
+            _metrics.append('%s;desc="%s";dur=%.2f' % (
+                re.sub(r'[^A-Za-z0-9_.-]', '_', name),
+                '%s process%s' % (_count, _count != 1 and 'es' or ''),
+                _time * 1000))
+        _metrics.append('app;dur=%.2f' % ((time.time() - self.start) * 1000))
+        return ', '.join(_metrics)
+
+    def as_dict(self):
+        _spans = [span.as_dict() for span in self._spans()]
+        return {
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'ms': round(((self.end or time.time()) - self.start) * 1000, 2),
+            'processes': len(_spans),
+            'process_ms': round(sum([_s['ms'] for _s in _spans]), 2),
+            'spans': _spans
+            }
+
+def begin(method = None, path = None):
+    '''Starts a Trace, current for this thread until end().'''
+    _local.trace = Trace(method, path)
+    return _local.trace
+
+def current():
+    '''@returns The Trace current for this thread, or None.'''
+    return getattr(_local, 'trace', None)
+
+def end():
+    '''Ends the Trace current for this thread. @returns it, or None.'''
+    trace = current()
+    _local.trace = None
+    if trace is not None and trace.end is None:
+        trace.end = time.time()
+    return trace
+
+def start_span(argv):
+    '''
+    Call right before starting a process.
+
+    @returns Span of the current Trace, to finish() when the process is
+        done, or None if there is no Trace.
+    '''
+    trace = current()
+    if trace is None:
+        return None
+    return trace.add(argv)
+
+class TraceMiddleware(object):
+    '''
+    WSGI middleware tracing each request. See module docstring.
+    '''
+
+    def __init__(self, app, log = None, header = True):
+        '''
+        @param app WSGI app to wrap.
+
+        @param log Callable taking a Trace's as_dict(), called once the
+            response is sent. Default logs it as a JSON line, at INFO level,
+            to the "ges.trace" logger. Logging is off until that logger (or
+            the root one) gets a handler.
+
+        @param header Adds the Server-Timing header to responses when True.
+        '''
+        self.app = app
+        self.log = log or self._log
+        self.header = header
+
+    @staticmethod
+    def _log(record):
+        logging.getLogger(LOGNAME).info(json.dumps(record, sort_keys = True))
+
+    def __call__(self, environ, start_response):
+        trace = begin(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'))
+
+        def _end():
+            # called once: by OnClose, or here, if the app raised.
+            if current() is trace:
+                end()
+            elif trace.end is None:
+                trace.end = time.time()
+            try:
+                self.log(trace.as_dict())
+            except Exception:
+                pass
+
+        def _start_response(status, headers, exc_info = None):
+            trace.status = status.split(' ', 1)[0]
+            if self.header:
+                headers = list(headers) + [('Server-Timing', trace.server_timing())]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+
+        try:
+            response = self.app(environ, _start_response)
+        except:
+            _end()
+            raise
+        return OnClose(response, _end)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+'''
+Module provides negotiated (Accept-Encoding) gzip and deflate compression of
+WSGI response bodies.
+
+Whether a response is compressed depends on its Content-Type. Text, JSON,
+JavaScript and git ref adverts are. Packs, archives and images are not: they
+are compressed already and would only cost us CPU time.
+
+Use either as WSGI middleware:
+
+    app = CompressionMiddleware(app)
+
+or, from inside an app, in place of start_response(status, headers):
+
+    return compress_response(environ, start_response, status, headers, body)
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import zlib
+from wsgiref.headers import Headers
+
+# Content types worth compressing. Entries ending with '/' match all subtypes.
+# Anything not listed here (application/x-git-*-result packs, zip, gzip,
+# images) is sent as is.
+compressible_types = [
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'image/svg+xml',
+    'application/x-git-upload-pack-advertisement',
+    'application/x-git-receive-pack-advertisement'
+    ]
+
+# In order of preference, when client likes them equally.
+# name : wbits for zlib.compressobj
+encodings = [
+    ('gzip', 16 + zlib.MAX_WBITS), # gzip header and trailer
+    ('deflate', zlib.MAX_WBITS) # HTTP's "deflate" is a zlib stream, not raw deflate
+    ]
+
+def compressible(content_type):
+    '''
+    @param content_type Value of Content-Type header. Parameters (charset)
+        are ignored.
+
+    @returns True if responses of this type are to be compressed.
+    '''
+    _t = (content_type or '').split(';')[0].strip().lower()
+    for _e in compressible_types:
+        if _t == _e or (_e.endswith('/') and _t.startswith(_e)):
+            return True
+    return False
+
+def negotiate(accept_encoding):
+    '''
+    Picks the encoding to use, per Accept-Encoding request header.
+
+    @param accept_encoding Value of the header, like 'gzip, deflate;q=0.5'
+
+    @returns (name, wbits) from `encodings` or None for "send as is".
+    '''
+    _q = {}
+    for _e in (accept_encoding or '').split(','):
+        _parts = _e.split(';')
+        _name = _parts[0].strip().lower()
+        if not _name:
+            continue
+        if _name == 'x-gzip':
+            _name = 'gzip'
+        _value = 1.0
+        for _p in _parts[1:]:
+            _p = _p.strip()
+            if _p.startswith('q='):
+                try:
+                    _value = float(_p[2:])
+                except ValueError:
+                    _value = 0.0
+        _q[_name] = _value
+    _best, _best_q = None, 0.0
+    for _encoding in encodings:
+        _value = _q.get(_encoding[0], _q.get('*', 0.0))
+        if _value > _best_q:
+            _best, _best_q = _encoding, _value
+    return _best
+
+class CompressingIterable(object):
+    '''
+    Iterable compressing the output of a WSGI response iterable as it is
+    read. Memory use does not depend on the size of the response.
+    '''
+
+    def __init__(self, source, wbits, level = 6):
+        self.source = source
+        self.iterator = iter(source)
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.compressor is None:
+            raise StopIteration
+        try:
+            chunk = self.iterator.next()
+        except StopIteration:
+            _tail = self.compressor.flush()
+            self.compressor = None
+            return _tail
+        # may well be '' while zlib fills a block. Per PEP 333 we pass that on
+        # instead of blocking on more of the source.
+        return self.compressor.compress(chunk)
+
+    def close(self):
+        _close(self.source)
+
+def compress_response(environ, start_response, status, headers, body,
+        level = 6, min_size = 256, exc_info = None):
+    '''
+    Calls start_response and returns the body, compressed if the client
+    accepts it and Content-Type is in `compressible_types`.
+
+    Bodies that are lists (or tuples) are compressed right away and get a
+    Content-Length. Other iterables are compressed while being sent, without
+    a Content-Length (the server sends them chunked).
+
+    @param headers List of (name, value) tuples. Changed in place.
+
+    @param min_size Bodies known to be shorter than this are sent as is.
+
+    @returns WSGI response iterable. (What start_response returns, the
+        write() callable, is not, as it cannot be used to write compressed
+        data.)
+    '''
+    headersIface = Headers(headers)
+    _encoding = None
+    if status.startswith('200') and not headersIface.get('Content-Encoding') \
+            and compressible(headersIface.get('Content-Type')) \
+            and 'no-transform' not in (headersIface.get('Cache-Control') or ''):
+        # cached copies of this URL differ per Accept-Encoding, whether or not
+        # this particular client gets it compressed.
+        _vary = headersIface.get('Vary')
+        if not _vary:
+            headersIface['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in _vary.lower():
+            headersIface['Vary'] = _vary + ', Accept-Encoding'
+        _encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        _length = headersIface.get('Content-Length')
+        if _length is not None and _length.isdigit() and int(_length) < min_size:
+            _encoding = None
+
+    if _encoding is None:
+        _start(start_response, status, headers, exc_info)
+        return body
+
+    headersIface['Content-Encoding'] = _encoding[0]
+    _etag = headersIface.get('ETag')
+    if _etag and not _etag.startswith('W/'):
+        # bytes are not those the strong ETag was given to. Weak ETags still
+        # match in If-None-Match.
+        headersIface['ETag'] = 'W/' + _etag
+    del headersIface['Content-Length']
+    if isinstance(body, (list, tuple)):
+        _c = zlib.compressobj(level, zlib.DEFLATED, _encoding[1])
+        body = [_c.compress(''.join(body)) + _c.flush()]
+        headersIface['Content-Length'] = str(len(body[0]))
+    else:
+        body = CompressingIterable(body, _encoding[1], level)
+    _start(start_response, status, headers, exc_info)
+    return body
+
+def _start(start_response, status, headers, exc_info):
+    if exc_info is None:
+        # some start_response callables don't take the optional argument.
+        start_response(status, headers)
+    else:
+        start_response(status, headers, exc_info)
+
+def _close(body):
+    if hasattr(body, 'close'):
+        body.close()
+
+class _Prepended(object):
+    '''Puts back the chunk already taken out of a response iterable.'''
+
+    def __init__(self, first, iterator, source):
+        self.first = [first]
+        self.iterator = iterator
+        self.source = source
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.first:
+            return self.first.pop()
+        return self.iterator.next()
+
+    def close(self):
+        _close(self.source)
+
+class CompressionMiddleware(object):
+    '''
+    WSGI middleware compressing responses of the wrapped app, where the client
+    and the content type allow. See compress_response().
+
+    Responses written through the write() callable returned by
+    start_response are passed through uncompressed.
+    '''
+
+    def __init__(self, app, level = 6, min_size = 256):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        _state = {}
+
+        def _start_response(status, headers, exc_info = None):
+            if exc_info is not None and 'write' in _state:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            _state['response'] = (status, headers, exc_info)
+            return _write
+
+        def _write(data):
+            # app did not wait for us to see the body. No compressing then.
+            if 'write' not in _state:
+                _status, _headers, _exc_info = _state['response']
+                if _exc_info is None:
+                    _state['write'] = start_response(_status, _headers)
+                else:
+                    _state['write'] = start_response(_status, _headers, _exc_info)
+            _state['write'](data)
+
+        body = self.app(environ, _start_response)
+        if 'response' not in _state:
+            # generators call start_response when first asked for data.
+            _i = iter(body)
+            try:
+                body = _Prepended(_i.next(), _i, body)
+            except StopIteration:
+                _close(body)
+                body = []
+            except:
+                _close(body)
+                raise
+        if 'response' not in _state:
+            _close(body)
+            raise RuntimeError('The application did not call start_response.')
+        if 'write' in _state:
+            return body
+        _status, _headers, _exc_info = _state['response']
+        return compress_response(environ, start_response, _status, _headers,
+            body, self.level, self.min_size, _exc_info)
@@ -22,6 +22,7 @@ import os.path
 import os
 
 from wsgiref.headers import Headers
+import response_compression
 
 # needed for static content server
 import time
@@ -75,6 +76,9 @@ class BaseWSGIClass(object):
         elif hasattr(outIO,'read'):
             outIO.seek(0)
             retobj = iter( lambda: outIO.read(self.bufsize), '' )
+        if self.gzip_response:
+            return response_compression.compress_response(
+                environ, start_response, "200 OK", headers, retobj)
         start_response("200 OK", headers)
         return retobj
 
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+'''
+Module provides a fork server: a small helper process that starts
+subprocesses on behalf of the server process.
+
+subprocess.Popen forks the calling process. For a server with gigabytes of
+caches and dozens of threads, copying its page tables takes milliseconds per
+spawn, and more so under load, when spawns are frequent. The helper is a
+fresh, small Python process. It receives spawn requests over a Unix socket,
+starts the subprocess itself and passes pipe file descriptors back
+(SCM_RIGHTS, via _multiprocessing.sendfd / recvfd). It also reports the exit
+status, as the subprocess is its child, not ours.
+
+Usage:
+
+    spawner.start() # early, while the server process is still small.
+    p = spawner.popen(['git', 'version'], stdout = subprocess.PIPE)
+
+popen() takes (a subset of) subprocess.Popen's arguments and returns an
+object with the parts of the Popen interface we use: pid, stdin, stdout,
+stderr, returncode, poll(), wait(), send_signal(), terminate(), kill().
+When the helper is not started, not available (Windows), or dies, popen()
+falls back to subprocess.Popen.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import errno
+import select
+import signal
+import socket
+import struct
+import threading
+import subprocess
+import cPickle as pickle
+try:
+    import fcntl
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    fcntl = sendfd = recvfd = None
+
+_length = struct.Struct('!I')
+_status = struct.Struct('!i')
+
+class HelperGone(EnvironmentError):
+    '''The helper process went away. Spawn through subprocess.Popen instead.'''
+
+def _set_cloexec(fd):
+    _flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, _flags | fcntl.FD_CLOEXEC)
+
+def _recv_exactly(sock, size):
+    '''@returns string shorter than size only if the other end closed.'''
+    _parts = []
+    while size:
+        _b = sock.recv(size)
+        if not _b:
+            break
+        _parts.append(_b)
+        size -= len(_b)
+    return ''.join(_parts)
+
+def _send_message(sock, obj):
+    _data = pickle.dumps(obj, 2)
+    sock.sendall(_length.pack(len(_data)) + _data)
+
+def _recv_message(sock):
+    _h = _recv_exactly(sock, _length.size)
+    if len(_h) < _length.size:
+        raise HelperGone('Spawner helper closed the connection.')
+    _size = _length.unpack(_h)[0]
+    _data = _recv_exactly(sock, _size)
+    if len(_data) < _size:
+        raise HelperGone('Spawner helper closed the connection.')
+    return pickle.loads(_data)
+
+# How a std stream of the subprocess is set up. 'fd' streams are followed
+# by the descriptor itself.
+def _stream_spec(value):
+    if value is None:
+        return None
+    if value == subprocess.PIPE:
+        return 'pipe'
+    if value == subprocess.STDOUT:
+        return 'stdout'
+    return 'fd'
+
+def _stream_fd(value):
+    if type(value) in (int, long):
+        return value
+    return value.fileno()
+
+class SpawnedProcess(object):
+    '''
+    Popen-alike for a subprocess started by the helper. Exit status comes
+    over a socket of its own. Signals are sent through the helper too, as
+    only it knows whether the pid still belongs to our subprocess.
+    '''
+
+    def __init__(self, pid, stdin, stdout, stderr, status_socket):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._socket = status_socket
+        self._lock = threading.Lock()
+
+    def _read_status(self):
+        '''Blocks until the helper reports. Lock must be held.'''
+        _data = _recv_exactly(self._socket, _status.size)
+        if len(_data) == _status.size:
+            self.returncode = _status.unpack(_data)[0]
+        else:
+            # helper died. Our subprocess's fate is unknown. Call it a failure.
+            self.returncode = 255
+        self._socket.close()
+
+    def poll(self):
+        if self.returncode is None and self._lock.acquire(False):
+            try:
+                if self.returncode is None:
+                    _r = select.select([self._socket], [], [], 0)[0]
+                    if _r:
+                        self._read_status()
+            finally:
+                self._lock.release()
+        return self.returncode
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            if self.returncode is None:
+                self._read_status()
+        finally:
+            self._lock.release()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                self._socket.sendall(_status.pack(sig))
+            except socket.error:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class Spawner(object):
+    '''Client end of a helper process. Spawn requests are sent one at a time.'''
+
+    def __init__(self):
+        _ours, _theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(_ours.fileno())
+        # helper gets its end of the socket as stdin. close_fds keeps the rest
+        # of our descriptors out of it.
+        self.helper = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin = _theirs,
+            close_fds = True
+            )
+        _theirs.close()
+        self.socket = _ours
+        self.owner = os.getpid()
+        self.alive = True
+        self._lock = threading.Lock()
+
+    def spawn(self, args, stdin = None, stdout = None, stderr = None,
+            cwd = None, env = None, shell = False, bufsize = 0):
+        '''
+        @returns SpawnedProcess
+
+        @raises OSError if the subprocess could not be started.
+        @raises HelperGone if the helper is not there any more.
+        '''
+        _streams = [stdin, stdout, stderr]
+        _specs = [_stream_spec(_s) for _s in _streams]
+        _ours, _theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(_ours.fileno())
+        _fds = []
+        self._lock.acquire()
+        try:
+            if not self.alive:
+                raise HelperGone('Spawner helper is gone.')
+            try:
+                _send_message(self.socket, {
+                    'args': args,
+                    'streams': _specs,
+                    'cwd': cwd,
+                    'env': env,
+                    'shell': shell
+                    })
+                for _spec, _s in zip(_specs, _streams):
+                    if _spec == 'fd':
+                        sendfd(self.socket.fileno(), _stream_fd(_s))
+                sendfd(self.socket.fileno(), _theirs.fileno())
+                _reply = _recv_message(self.socket)
+                if 'error' not in _reply:
+                    for _spec in _specs:
+                        if _spec == 'pipe':
+                            _fd = recvfd(self.socket.fileno())
+                            # others may be spawning with subprocess.Popen now.
+                            _set_cloexec(_fd)
+                            _fds.append(_fd)
+                        else:
+                            _fds.append(None)
+            except (socket.error, OSError, HelperGone) as e:
+                self.alive = False
+                for _fd in _fds:
+                    if _fd is not None:
+                        os.close(_fd)
+                _ours.close()
+                raise HelperGone('Spawner helper is gone: %s' % e)
+        finally:
+            self._lock.release()
+            _theirs.close()
+
+        if 'error' in _reply:
+            _ours.close()
+            _errno, _strerror = _reply['error']
+            raise OSError(_errno, _strerror)
+        _files = []
+        for _fd, _mode in zip(_fds, ['wb', 'rb', 'rb']):
+            _files.append(_fd is not None and os.fdopen(_fd, _mode, bufsize) or None)
+        return SpawnedProcess(_reply['pid'], _files[0], _files[1], _files[2], _ours)
+
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self.alive = False
+            self.socket.close()
+        finally:
+            self._lock.release()
+        self.helper.wait()
+
+_spawner = None
+_spawner_lock = threading.Lock()
+
+def start():
+    '''
+    Starts the helper process, unless it is running already. Call early,
+    while the process is small, as this forks once, the usual way.
+
+    @returns True if spawns go through the helper from now on.
+    '''
+    global _spawner
+    if fcntl is None or sendfd is None:
+        return False
+    _spawner_lock.acquire()
+    try:
+        if _spawner is None or not _spawner.alive or _spawner.owner != os.getpid():
+            _spawner = Spawner()
+        return True
+    finally:
+        _spawner_lock.release()
+
+def stop():
+    global _spawner
+    _spawner_lock.acquire()
+    try:
+        _s, _spawner = _spawner, None
+    finally:
+        _spawner_lock.release()
+    if _s is not None and _s.owner == os.getpid():
+        _s.stop()
+
+def popen(args, bufsize = 0, stdin = None, stdout = None, stderr = None,
+        cwd = None, env = None, shell = False):
+    '''
+    Starts a subprocess, through the helper if it is running.
+    Arguments are those of subprocess.Popen.
+
+    @returns SpawnedProcess or subprocess.Popen
+    '''
+    _s = _spawner
+    if _s is not None and _s.alive and _s.owner == os.getpid():
+        try:
+            return _s.spawn(args, stdin, stdout, stderr, cwd, env, shell, bufsize)
+        except HelperGone:
+            pass
+    return subprocess.Popen(args, bufsize = bufsize, stdin = stdin,
+        stdout = stdout, stderr = stderr, cwd = cwd, env = env, shell = shell)
+
+class Helper(object):
+    '''The helper process's side. Runs serve() until the server goes away.'''
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.children = {} # status socket : subprocess.Popen
+        self.exited = [] # Popen objects whose exit status nobody waits for
+        _r, _w = os.pipe()
+        for _fd in (_r, _w, sock.fileno()):
+            _set_cloexec(_fd)
+        fcntl.fcntl(_w, fcntl.F_SETFL, fcntl.fcntl(_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.wakeup = _r
+        self._wakeup_write = _w
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        # restart interrupted system calls. Popen's and sendmsg's included.
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _on_sigchld(self, signum, frame):
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            pass
+
+    def spawn(self):
+        request = _recv_message(self.socket)
+        _fds = []
+        _streams = []
+        for _spec in request['streams']:
+            if _spec == 'fd':
+                _fd = recvfd(self.socket.fileno())
+                _fds.append(_fd)
+                _streams.append(_fd)
+            elif _spec == 'pipe':
+                _streams.append(subprocess.PIPE)
+            elif _spec == 'stdout':
+                _streams.append(subprocess.STDOUT)
+            else:
+                _streams.append(None)
+        _status_fd = recvfd(self.socket.fileno())
+        # fromfd dups the descriptor.
+        status_socket = socket.fromfd(_status_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(_status_fd)
+        try:
+            _p = subprocess.Popen(request['args'],
+                stdin = _streams[0], stdout = _streams[1], stderr = _streams[2],
+                cwd = request['cwd'], env = request['env'], shell = request['shell'])
+        except Exception as e:
+            _send_message(self.socket, {'error': (
+                getattr(e, 'errno', None) or errno.EINVAL,
+                getattr(e, 'strerror', None) or str(e)
+                )})
+            status_socket.close()
+            return
+        finally:
+            for _fd in _fds:
+                os.close(_fd)
+        _set_cloexec(status_socket.fileno())
+        _send_message(self.socket, {'pid': _p.pid})
+        for _f in (_p.stdin, _p.stdout, _p.stderr):
+            if _f is not None:
+                sendfd(self.socket.fileno(), _f.fileno())
+                _f.close()
+        _p.stdin = _p.stdout = _p.stderr = None
+        self.children[status_socket] = _p
+
+    def reap(self):
+        try:
+            while os.read(self.wakeup, 4096):
+                pass
+        except OSError:
+            pass
+        for status_socket, _p in self.children.items():
+            if _p.poll() is not None:
+                del self.children[status_socket]
+                try:
+                    status_socket.sendall(_status.pack(_p.returncode))
+                except socket.error:
+                    pass
+                status_socket.close()
+        self.exited = [_p for _p in self.exited if _p.poll() is None]
+
+    def on_request(self, status_socket):
+        _p = self.children[status_socket]
+        _data = _recv_exactly(status_socket, _status.size)
+        if len(_data) < _status.size:
+            # caller lost interest. Child is still reaped, just not reported.
+            del self.children[status_socket]
+            status_socket.close()
+            self.exited.append(_p)
+        elif _p.poll() is None:
+            _p.send_signal(_status.unpack(_data)[0])
+
+    def serve(self):
+        fcntl.fcntl(self.wakeup, fcntl.F_SETFL,
+            fcntl.fcntl(self.wakeup, fcntl.F_GETFL) | os.O_NONBLOCK)
+        while True:
+            try:
+                _r = select.select([self.socket, self.wakeup] + self.children.keys(), [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wakeup in _r:
+                self.reap()
+            for status_socket in _r:
+                if status_socket in self.children:
+                    self.on_request(status_socket)
+            if self.socket in _r:
+                try:
+                    self.spawn()
+                except HelperGone:
+                    # server is gone. Its subprocesses keep going on their own.
+                    return
+
+def _serve():
+    _fd = os.dup(0)
+    _null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(_null, 0)
+    os.close(_null)
+    _sock = socket.fromfd(_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(_fd)
+    Helper(_sock).serve()
+
+if __name__ == "__main__":
+    _serve()
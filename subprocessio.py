@@ -27,6 +27,71 @@ from collections import deque
 import threading
 import subprocess
 import os
+import stat
+import errno
+import select
+import atexit
+import tempfile
+import weakref
+import spawner
+import request_trace
+import metrics
+try:
+    import fcntl
+except ImportError:
+    # Windows. Its pipes cannot be polled anyway.
+    fcntl = None
+
+# When True (and the platform allows it) pipes are driven by one shared
+# IOLoop thread, instead of a reader (writer) thread per pipe.
+use_io_loop = True
+
+# Folder for output spilled to disk by SpillBuffer. None = system's temp folder.
+spill_path = None
+# Most one SpillBuffer puts on disk. Past that, reading pauses. None = no limit.
+max_spill_bytes = 256 * 1024 * 1024
+# File-like input (wsgi.input) up to this size is read up front and written by
+# the IOLoop. Larger input is copied by a StreamFeeder thread.
+max_inline_input_bytes = 1024 * 1024
+
+if hasattr(select, 'epoll'):
+    _make_poller = select.epoll
+    _READ, _WRITE = select.EPOLLIN, select.EPOLLOUT
+    _ERROR = select.EPOLLERR | select.EPOLLHUP
+elif hasattr(select, 'poll'):
+    _make_poller = select.poll
+    _READ, _WRITE = select.POLLIN, select.POLLOUT
+    _ERROR = select.POLLERR | select.POLLHUP
+else:
+    _make_poller = None
+
+class PeekedReader(object):
+    '''
+    File-like, reading up to peek_size bytes of a file-like (request body)
+    up front. If the body ends within that, complete is True and head is
+    all of it. read() returns head, then the rest of the body.
+    '''
+    def __init__(self, source, peek_size):
+        self.source = source
+        _parts = []
+        _left = peek_size + 1
+        while _left > 0:
+            _b = source.read(_left)
+            if not _b:
+                break
+            _parts.append(_b)
+            _left -= len(_b)
+        self.head = ''.join(_parts)
+        self.complete = len(self.head) <= peek_size
+
+    def read(self, size = -1):
+        if not self.head:
+            return self.source.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head, ''
+            return data + self.source.read()
+        data, self.head = self.head[:size], self.head[size:]
+        return data
 
 class StreamFeeder(threading.Thread):
     """
@@ -57,35 +122,61 @@ class StreamFeeder(threading.Thread):
         if not filelike and not self.bytes:
             raise TypeError("StreamFeeder's source object must be a readable file-like, a file descriptor, or a string-like.")
         self.source = source
+        self.written = 0
         self.readiface, self.writeiface = os.pipe()
+        if fcntl:
+            # subprocesses must not inherit our end. Else the one we feed
+            # holds it open and never sees the end of its input.
+            fcntl.fcntl(self.writeiface, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
 
     def run(self):
         t = self.writeiface
-        if self.bytes:
-            os.write(t, self.bytes)
-        else:
-            s = self.source
-            b = s.read(4096)
-            while b:
-                os.write(t, b)
+        try:
+            if self.bytes:
+                os.write(t, self.bytes)
+                self.written = len(self.bytes)
+            else:
+                s = self.source
                 b = s.read(4096)
-        os.close(t)
+                while b:
+                    os.write(t, b)
+                    self.written += len(b)
+                    b = s.read(4096)
+        except OSError as e:
+            # EPIPE. The subprocess exited early. Its exit code will tell why.
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            os.close(t)
 
     @property
     def output(self):
         return self.readiface
 
+def _notify(changed):
+    changed.acquire()
+    try:
+        changed.notify_all()
+    finally:
+        changed.release()
+
 class InputStreamChunker(threading.Thread):
-    def __init__(self, source, target, buffer_size, chunk_size):
+    def __init__(self, source, target, buffer_size, chunk_size, changed = None):
 
         super(InputStreamChunker,self).__init__()
 
         self.daemon = True # die die die.
 
         self.source = source
+        try:
+            self.fd = source.fileno()
+        except (AttributeError, ValueError, EnvironmentError):
+            self.fd = None
         self.target = target
         self.chunk_count_max = int(buffer_size / chunk_size) + 1
         self.chunk_size = chunk_size
+        # while False, we read on, no matter how full the buffer is.
+        self.pausable = True
 
         self.data_added = threading.Event()
         self.data_added.clear()
@@ -99,9 +190,17 @@ class InputStreamChunker(threading.Thread):
         self.go = threading.Event()
         self.go.set()
 
+        # notified on every change of target, EOF and keep_reading.
+        self.changed = changed or threading.Condition(threading.Lock())
+
     def stop(self):
         self.go.clear()
         self.EOF.set()
+        _notify(self.changed)
+        if self.fd is not None:
+            # we read the fd directly. Were it closed (and reused) under us,
+            # we'd read someone else's data. run() closes it when done.
+            return
         try:
             # this is not proper, but is done to force the reader thread let go of
             # the input because, if successful, .close() will send EOF down the pipe.
@@ -109,30 +208,474 @@ class InputStreamChunker(threading.Thread):
         except:
             pass
 
+    def resume(self):
+        if not self.keep_reading.is_set():
+            changed = self.changed
+            changed.acquire()
+            try:
+                self.keep_reading.set()
+                changed.notify_all()
+            finally:
+                changed.release()
+
+    def read(self):
+        try:
+            if self.fd is not None:
+                # what's there, up to chunk_size. file.read() would wait for all of it.
+                return os.read(self.fd, self.chunk_size)
+            return self.source.read(self.chunk_size)
+        except (EnvironmentError, ValueError):
+            # stop() closes the source from under us. That's how it's meant to be.
+            if self.go.is_set():
+                raise
+            return ''
+
     def run(self):
-        s = self.source
         t = self.target
-        cs = self.chunk_size
         ccm = self.chunk_count_max
         kr = self.keep_reading
         da = self.data_added
         go = self.go
-        b = s.read(cs)
+        changed = self.changed
+        b = self.read()
         while b and go.is_set():
-            if len(t) > ccm:
-                kr.clear()
-                kr.wait(2)
-#                # this only works on 2.7.x and up
-#                if not kr.wait(10):
-#                    raise Exception("Timed out while waiting for input to be read.")
-                # instead we'll use this
-                if len(t) > ccm + 3:
-                    raise IOError("Timed out while waiting for input from subprocess.")
+            if self.pausable and _is_full(t, ccm):
+                # no timeout. A slow client is no reason to fail the request.
+                changed.acquire()
+                try:
+                    while self.pausable and _is_full(t, ccm) and go.is_set():
+                        # cleared before we wait, so that resume() after any pop wakes us.
+                        kr.clear()
+                        changed.notify_all()
+                        changed.wait()
+                    kr.set()
+                finally:
+                    changed.release()
             t.append(b)
             da.set()
-            b = s.read(cs)
+            _notify(changed)
+            b = self.read()
+        if self.fd is not None:
+            try:
+                self.source.close()
+            except:
+                pass
         self.EOF.set()
         da.set() # for cases when done but there was no input.
+        _notify(changed)
+
+def _is_full(target, chunk_count_max):
+    '''True if a reader filling the target should pause.'''
+    if isinstance(target, SpillBuffer):
+        return target.full
+    return len(target) > chunk_count_max
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def _pollable(source):
+    '''
+    @returns True if source is a pipe (socket) the IOLoop can drive.
+    '''
+    if not (use_io_loop and fcntl and _make_poller):
+        return False
+    try:
+        mode = os.fstat(source.fileno()).st_mode
+    except (AttributeError, ValueError, EnvironmentError):
+        return False
+    # epoll refuses regular files, as these are always "ready".
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+class IOLoop(threading.Thread):
+    '''
+    One thread moving data between the pipes of all subprocesses and the
+    buffers of their BufferedGenerators (and from strings into stdin pipes.)
+    Number of threads does not grow with number of running subprocesses.
+
+    Pipes are put in non-blocking mode and are watched with epoll (poll).
+    Handlers (PipeReader, PipeWriter) are called in the loop's thread and
+    must never block. Anything touching the set of watched pipes must run in
+    the loop thread too. Other threads ask for it with call().
+    '''
+    def __init__(self):
+        super(IOLoop, self).__init__()
+        self.daemon = True
+        self.poller = _make_poller()
+        self.handlers = {} # fd : handler
+        self.calls = deque()
+        self.stopping = False
+        # writing a byte here wakes the loop up to run the calls.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        _set_nonblocking(self.wakeup_r)
+        _set_nonblocking(self.wakeup_w)
+        self.poller.register(self.wakeup_r, _READ)
+
+    def stop(self):
+        self.stopping = True
+
+    def call(self, function, *args):
+        '''Runs function(*args) in the loop thread, as soon as it can.'''
+        self.calls.append((function, args))
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            # pipe is full of wake-ups the loop did not get to yet.
+            pass
+
+    def watch(self, fd, events, handler):
+        '''Loop thread only. handler.handle(event) is called when fd is ready.'''
+        if fd not in self.handlers:
+            self.handlers[fd] = handler
+            self.poller.register(fd, events | _ERROR)
+
+    def unwatch(self, fd):
+        '''Loop thread only.'''
+        if self.handlers.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def run(self):
+        try:
+            self._run()
+        except:
+            # interpreter shutdown pulls modules out from under daemon threads.
+            if not self.stopping:
+                raise
+
+    def _run(self):
+        wakeup = self.wakeup_r
+        handlers = self.handlers
+        calls = self.calls
+        while True:
+            try:
+                events = self.poller.poll()
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == wakeup:
+                    try:
+                        os.read(wakeup, 4096)
+                    except OSError:
+                        pass
+                    continue
+                handler = handlers.get(fd)
+                if handler is not None:
+                    try:
+                        handler.handle(event)
+                    except Exception as e:
+                        handler.fail(e)
+            while calls:
+                function, args = calls.popleft()
+                try:
+                    function(*args)
+                except Exception:
+                    pass
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    '''
+    Returns the process-wide IOLoop, starting it if needed (again, in a
+    forked child, as threads do not survive fork.)
+    '''
+    global _loop, _loop_pid
+    _loop_lock.acquire()
+    try:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = IOLoop()
+            _loop_pid = os.getpid()
+            _loop.start()
+            atexit.register(_loop.stop)
+        return _loop
+    finally:
+        _loop_lock.release()
+
+class PipeReader(object):
+    '''
+    Does the job of InputStreamChunker (and has the same interface) for
+    pipes, without a thread of its own. Reads are done by the IOLoop when the
+    pipe has data. When the buffer is full, the pipe is no longer watched
+    (the subprocess blocks on write) until resume() is called.
+    '''
+    def __init__(self, source, target, buffer_size, chunk_size, changed = None):
+        self.source = source
+        self.fd = source.fileno()
+        self.target = target
+        self.chunk_count_max = int(buffer_size / chunk_size) + 1
+        self.chunk_size = chunk_size
+        # while False, we read on, no matter how full the buffer is.
+        self.pausable = True
+        self.paused = False
+        self.closed = False
+        self.detached = False
+
+        self.data_added = threading.Event()
+        self.keep_reading = threading.Event()
+        self.keep_reading.set()
+        self.EOF = threading.Event()
+        self.go = threading.Event()
+        self.go.set()
+        self.changed = changed or threading.Condition(threading.Lock())
+
+    def start(self):
+        _set_nonblocking(self.fd)
+        self.loop = get_loop()
+        self.loop.call(self._attach)
+
+    def _attach(self):
+        if not self.closed and not self.detached:
+            self.loop.watch(self.fd, _READ, self)
+
+    def detach(self):
+        '''
+        Stops reading, leaving the pipe open for someone else to read.
+        Returns once the loop let go of it. stop() still closes the pipe.
+        '''
+        detached = threading.Event()
+        def _detach():
+            self.detached = True
+            self.loop.unwatch(self.fd)
+            detached.set()
+        self.loop.call(_detach)
+        detached.wait()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.unwatch(self.fd)
+            try:
+                self.source.close()
+            except:
+                pass
+        self.EOF.set()
+        self.data_added.set()
+        _notify(self.changed)
+
+    def handle(self, event):
+        t = self.target
+        try:
+            while True:
+                if self.pausable and _is_full(t, self.chunk_count_max) and self._pause():
+                    return
+                try:
+                    b = os.read(self.fd, self.chunk_size)
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        return
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if not b:
+                    self._close()
+                    return
+                t.append(b)
+                self.data_added.set()
+        finally:
+            # once per batch of reads, not per chunk.
+            _notify(self.changed)
+
+    def _pause(self):
+        changed = self.changed
+        changed.acquire()
+        try:
+            # the consumer may have emptied the buffer since we looked.
+            if not _is_full(self.target, self.chunk_count_max):
+                return False
+            self.paused = True
+            self.keep_reading.clear()
+            self.loop.unwatch(self.fd)
+            return True
+        finally:
+            changed.release()
+
+    def fail(self, e):
+        self._close()
+
+    def resume(self):
+        if self.paused:
+            changed = self.changed
+            changed.acquire()
+            try:
+                if self.paused:
+                    self.paused = False
+                    self.keep_reading.set()
+                    self.loop.call(self._attach)
+            finally:
+                changed.release()
+
+    def stop(self):
+        self.go.clear()
+        self.EOF.set()
+        _notify(self.changed)
+        # closing is done by the loop. Closing here could pull the fd out
+        # from under a read in progress, or close someone else's new fd.
+        self.loop.call(self._close)
+
+class PipeWriter(object):
+    '''
+    Writes a string into a pipe (subprocess' stdin) through the IOLoop,
+    then closes the pipe.
+    '''
+    def __init__(self, data, target):
+        self.data = bytes(data)
+        self.offset = 0
+        self.target = target
+        self.fd = target.fileno()
+
+    def start(self):
+        _set_nonblocking(self.fd)
+        self.loop = get_loop()
+        self.loop.call(self.loop.watch, self.fd, _WRITE, self)
+
+    def handle(self, event):
+        while self.offset < len(self.data):
+            try:
+                self.offset += os.write(self.fd, self.data[self.offset:self.offset + 65536])
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                if e.errno == errno.EINTR:
+                    continue
+                # EPIPE. The subprocess is gone or does not want the rest.
+                break
+        self._close()
+
+    def fail(self, e):
+        self._close()
+
+    def _close(self):
+        self.loop.unwatch(self.fd)
+        try:
+            self.target.close()
+        except:
+            pass
+
+class SpillBuffer(object):
+    '''
+    deque-like buffer of chunks, keeping up to max_bytes in memory. Chunks
+    appended past that go to a temp file, in order, and are read back from
+    there when their turn comes. Readers do not have to stop reading (and
+    the subprocess does not stall), however slow the consumer is, until
+    max_spill_bytes are on disk. Then the buffer is full and readers pause.
+
+    One thread appends, another one pops.
+    '''
+    def __init__(self, max_bytes, starting_values = [], path = None, max_spill_bytes = None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_spill_bytes = max_spill_bytes
+        self.memory = deque(starting_values)
+        self.memory_bytes = sum([len(c) for c in starting_values])
+        self.spilled = deque() # sizes of chunks in the file, oldest first.
+        self.spilled_bytes = 0
+        self.file_name = None
+        self.writer = None
+        self.reader = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.writer, self.file_name = tempfile.mkstemp(prefix = 'spill', dir = self.path)
+        # own fd, own position. Python's file objects make EOF sticky.
+        self.reader = os.open(self.file_name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            os.remove(self.file_name)
+            self.file_name = None
+        except OSError:
+            # Windows. Removed on close()
+            pass
+
+    def append(self, chunk):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            if not self.spilled and self.memory_bytes + len(chunk) <= self.max_bytes:
+                self.memory.append(chunk)
+                self.memory_bytes += len(chunk)
+                return
+            if self.writer is None:
+                self._open()
+            view = buffer(chunk)
+            while view:
+                view = view[os.write(self.writer, view):]
+            self.spilled.append(len(chunk))
+            self.spilled_bytes += len(chunk)
+        finally:
+            self.lock.release()
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def appendleft(self, chunk):
+        self.lock.acquire()
+        try:
+            self.memory.appendleft(chunk)
+            self.memory_bytes += len(chunk)
+        finally:
+            self.lock.release()
+
+    def popleft(self):
+        self.lock.acquire()
+        try:
+            if self.memory:
+                chunk = self.memory.popleft()
+                self.memory_bytes -= len(chunk)
+                return chunk
+            size = self.spilled.popleft() # IndexError when empty, as deque's.
+            self.spilled_bytes -= size
+            parts = []
+            while size:
+                part = os.read(self.reader, size)
+                if not part:
+                    raise IOError('Spill file is shorter than what was written to it.')
+                parts.append(part)
+                size -= len(part)
+            if not self.spilled:
+                # all read back. Next spill starts at the top of an empty file.
+                os.ftruncate(self.writer, 0)
+                os.lseek(self.writer, 0, os.SEEK_SET)
+                os.lseek(self.reader, 0, os.SEEK_SET)
+            return ''.join(parts)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.memory) + len(self.spilled)
+
+    @property
+    def full(self):
+        '''True once max_spill_bytes are on disk. Appending still works.'''
+        return self.max_spill_bytes is not None and self.spilled_bytes >= self.max_spill_bytes
+
+    def __getitem__(self, i):
+        # in-memory part only.
+        return self.memory[i]
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for fd in [self.writer, self.reader]:
+                if fd is not None:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+            self.writer = self.reader = None
+            if self.file_name:
+                try:
+                    os.remove(self.file_name)
+                except OSError:
+                    pass
+            self.memory.clear()
+            self.spilled.clear()
+        finally:
+            self.lock.release()
 
 class BufferedGenerator():
     '''
@@ -147,16 +690,31 @@ class BufferedGenerator():
     StopIteration after the last chunk of data is yielded.
     '''
 
-    def __init__(self, source, buffer_size = 65536, chunk_size = 4096, starting_values = [], bottomless = False):
+    def __init__(self, source, buffer_size = 65536, chunk_size = 4096, starting_values = [], bottomless = False, changed = None, spill = False):
+        '''
+        @param changed (Default: None) A threading.Condition notified whenever
+            data is added, reading is paused or done. Pass the same one to
+            several generators to wait for any of them.
+        @param spill (Default: False) When the buffer is full, spill further
+            output to disk (see SpillBuffer), instead of pausing reading.
+            buffer_size is then the ceiling on memory taken by the buffer.
+            Reading pauses once max_spill_bytes (module setting) are on disk.
+        '''
 
         if bottomless:
             maxlen = int(buffer_size / chunk_size)
         else:
             maxlen = None
 
-        self.data = deque(starting_values, maxlen)
+        if spill and not bottomless:
+            self.data = SpillBuffer(buffer_size, starting_values, spill_path, max_spill_bytes)
+        else:
+            self.data = deque(starting_values, maxlen)
 
-        self.worker = InputStreamChunker(source, self.data, buffer_size, chunk_size)
+        if _pollable(source):
+            self.worker = PipeReader(source, self.data, buffer_size, chunk_size, changed)
+        else:
+            self.worker = InputStreamChunker(source, self.data, buffer_size, chunk_size, changed)
         if starting_values:
             self.worker.data_added.set()
         self.worker.start()
@@ -169,12 +727,20 @@ class BufferedGenerator():
         return self
 
     def next(self):
-        while not len(self.data) and not self.worker.EOF.is_set():
-            self.worker.data_added.clear()
-            self.worker.data_added.wait(0.2)
+        if not len(self.data) and not self.worker.EOF.is_set():
+            # no timeout. In Python 2, timed waits are sleep-and-poll loops.
+            changed = self.worker.changed
+            changed.acquire()
+            try:
+                while not len(self.data) and not self.worker.EOF.is_set():
+                    changed.wait()
+            finally:
+                changed.release()
         if len(self.data):
-            self.worker.keep_reading.set()
-            return bytes(self.data.popleft())
+            chunk = bytes(self.data.popleft())
+            # after the pop, so that the reader sees room in the buffer.
+            self.worker.resume()
+            return chunk
         elif self.worker.EOF.is_set():
             raise StopIteration
 
@@ -194,9 +760,15 @@ class BufferedGenerator():
             self.throw(GeneratorExit)
         except (GeneratorExit, StopIteration):
             pass
+        if isinstance(self.data, SpillBuffer):
+            self.data.close()
 
     def __del__(self):
-        self.close()
+        try:
+            self.close()
+        except:
+            # at interpreter exit, module globals (_notify...) are None.
+            pass
 
     ####################
     # Threaded reader's infrastructure.
@@ -216,6 +788,14 @@ class BufferedGenerator():
     def reading_paused(self):
         return not self.worker.keep_reading.is_set()
 
+    @property
+    def buffer_full(self):
+        '''
+        @return True if reading is paused or output no longer fits in memory
+            and goes to disk.
+        '''
+        return self.reading_paused or bool(getattr(self.data, 'spilled', None))
+
     @property
     def done_reading_event(self):
         '''
@@ -268,19 +848,152 @@ class BufferedGenerator():
     def __getitem__(self, i):
         return self.data[i]
 
+class TailBuffer(object):
+    '''
+    Sink for readers (PipeReader, InputStreamChunker), used in place of a
+    deque, keeping only the last max_bytes appended to it.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.seen = 0
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.seen += len(chunk)
+        while self.size > self.max_bytes:
+            extra = self.size - self.max_bytes
+            head = self.chunks[0]
+            if len(head) <= extra:
+                self.chunks.popleft()
+                self.size -= len(head)
+            else:
+                self.chunks[0] = head[extra:]
+                self.size -= extra
+
+    def __len__(self):
+        # We are never full. Readers never pause on our account.
+        return 0
+
+    def __iter__(self):
+        # list() of a deque is atomic. Iterating it while appended to is not.
+        return iter(list(self.chunks))
+
+class StreamTail(object):
+    '''
+    Reads a stream (subprocess' stderr) in large blocks, keeping only its
+    last max_bytes. Git's progress output can run into megabytes. All we
+    want of it is the end, for error messages.
+
+    Iterating over us yields what we have so far and does not wait for more.
+    '''
+    def __init__(self, source, max_bytes = 16384, chunk_size = 65536, changed = None):
+        self.data = TailBuffer(max_bytes)
+        if _pollable(source):
+            self.worker = PipeReader(source, self.data, max_bytes, chunk_size, changed)
+        else:
+            self.worker = InputStreamChunker(source, self.data, max_bytes, chunk_size, changed)
+        self.worker.start()
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def tail(self, wait = False):
+        '''
+        @param wait (Default: False) If True, waits for the end of the stream
+            first. Use only once the subprocess exited.
+
+        @return String. Last max_bytes of the stream.
+        '''
+        if wait and not self.worker.EOF.is_set():
+            changed = self.worker.changed
+            changed.acquire()
+            try:
+                while not self.worker.EOF.is_set():
+                    changed.wait()
+            finally:
+                changed.release()
+        return ''.join(self.data)
+
+    @property
+    def length(self):
+        '''Number of bytes kept. Not the number of bytes seen.'''
+        return self.data.size
+
+    @property
+    def bytes_seen(self):
+        return self.data.seen
+
+    @property
+    def done_reading(self):
+        return self.worker.EOF.is_set()
+
+    def stop(self):
+        self.worker.stop()
+
+    def close(self):
+        try:
+            self.worker.stop()
+        except:
+            pass
+
+    def __del__(self):
+        self.close()
+
+# SubprocessIOChunkers not yet closed. See buffer_stats()
+_live_chunkers = weakref.WeakSet()
+
+def buffer_stats():
+    '''
+    Output read from subprocesses of SubprocessIOChunkers and not yet taken
+    by the server.
+
+    @returns dict with keys: chunkers (not closed), memory_bytes,
+        spilled_bytes (in spill files)
+    '''
+    _chunkers = []
+    for _attempt in xrange(3):
+        try:
+            _chunkers = list(_live_chunkers)
+            break
+        except RuntimeError:
+            # one was added while we copied.
+            pass
+    _memory = _spilled = 0
+    for chunker in _chunkers:
+        data = chunker.output.data
+        if isinstance(data, SpillBuffer):
+            _memory += data.memory_bytes
+            _spilled += data.spilled_bytes
+        else:
+            try:
+                _memory += sum([len(c) for c in list(data)])
+            except RuntimeError:
+                pass
+    return {
+        'chunkers': len(_chunkers),
+        'memory_bytes': _memory,
+        'spilled_bytes': _spilled
+        }
+
 class SubprocessIOChunker():
     '''
     Processor class wrapping handling of subprocess IO.
 
     In a way, this is a "communicate()" replacement with a twist.
 
-    - We are multithreaded. Writing in and reading out, err are all sep threads.
+    - We are concurrent. Writing in and reading out, err all happen at the same
+      time, driven by one, shared IOLoop thread (or, where pipes cannot be
+      polled, by a thread per pipe.) File-like input is fed by a thread of its own.
     - We support concurrent (in and out) stream processing.
     - The output is not a stream. It's a queue of read string (bytes, not unicode)
       chunks. The object behaves as an iterable. You can "for chunk in obj:" us.
     - We are non-blocking in more respects than communicate()
-      (reading from subprocess out pauses when internal buffer is full, but
-       does not block the parent calling code. On the flip side, reading from
+      (output not fitting into internal buffer pauses reading from subprocess
+       out (or, with spill, goes to disk), but does not block the parent calling code.
+       On the flip side, reading from
        slow-yielding subprocess may block the iteration until data shows up. This
        does not block the parallel inpipe reading occurring parallel thread.)
 
@@ -313,63 +1026,168 @@ class SubprocessIOChunker():
 
 
     '''
-    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = []):
+    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = [], error_tail_size = 16384, spill = False):
         '''
         Initializes SubprocessIOChunker
 
-        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings
+        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings.
+            Strings are run through the shell, arrays are run directly. Use arrays
+            when any of the arguments come from the outside.
         @param inputstream (Default: None) A file-like, string, or file pointer.
+            Strings, and file-likes ending within max_inline_input_bytes
+            (module setting, 1MB), are written by the shared IOLoop. Larger
+            or streaming file-likes, and file pointers, are copied into the
+            subprocess by a StreamFeeder thread of their own.
         @param buffer_size (Default: 65536) A size of total buffer per stream in bytes.
+            (The most stdout is allowed to take in memory.)
         @param chunk_size (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
         @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param error_tail_size (Default: 16384) How much of the end of stderr
+            output to keep for error messages, in bytes.
+        @param spill (Default: False) If False, reading pauses (and the
+            subprocess stalls) until the consumer catches up. If True, output
+            not fitting into buffer_size goes to a temp file, so that the
+            subprocess can finish at its own pace, however slowly the output
+            is consumed. Only up to max_spill_bytes (module setting), then
+            reading pauses. Use where holding the subprocess up costs more
+            than disk space (git holding locks and memory, say).
         '''
 
-        if inputstream:
-            input_streamer = StreamFeeder(inputstream)
+        _feed = None
+        self.input_streamer = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        _use_loop = use_io_loop and fcntl and _make_poller
+        if _use_loop and hasattr(inputstream, 'read'):
+            # most request bodies are small. One read here spares a thread.
+            inputstream = PeekedReader(inputstream, max_inline_input_bytes)
+            if inputstream.complete:
+                # an empty body still gets a pipe, closed at once.
+                _feed = inputstream.head
+                inputstream = subprocess.PIPE
+        elif type(inputstream) in (type(''), bytes, bytearray) and inputstream \
+                and _use_loop:
+            # strings are written by the IOLoop.
+            _feed = inputstream
+            inputstream = subprocess.PIPE
+        if _feed is None and inputstream:
+            # larger file-likes (wsgi.input) may block on read, which the loop
+            # must never do. A thread copies them into the pipe, at the pace
+            # the subprocess reads, so reading of output can still pause.
+            input_streamer = self.input_streamer = StreamFeeder(inputstream)
             input_streamer.start()
             inputstream = input_streamer.output
 
-        _p = subprocess.Popen(cmd,
-            bufsize = -1,
-            shell = True,
-            stdin = inputstream,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE
-            )
-
-        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values)
-        bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless = True)
-
-        while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
-            # doing this until we reach either end of file, or end of buffer.
-            bg_out.data_added_event.wait(1)
-            bg_out.data_added_event.clear()
+        # None, unless within a request traced by request_trace.TraceMiddleware
+        self.span = request_trace.start_span(cmd)
+        self.command = None
+        try:
+            # through the fork server, if started. See spawner.start()
+            _p = spawner.popen(cmd,
+                bufsize = -1,
+                shell = isinstance(cmd, basestring),
+                stdin = inputstream,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE
+                )
+        finally:
+            if self.input_streamer is not None:
+                # the subprocess has its copy. With ours closed, the feeder
+                # gets EPIPE, not stuck, when the subprocess goes away.
+                os.close(inputstream)
+        self.command = metrics.process_started(cmd)
+
+        _changed = threading.Condition(threading.Lock())
+        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values, changed = _changed, spill = spill)
+        bg_err = StreamTail(_p.stderr, error_tail_size, changed = _changed)
+
+        if _feed is not None:
+            PipeWriter(_feed, _p.stdin).start()
+            self.bytes_in = len(_feed)
+
+        _changed.acquire()
+        try:
+            while not bg_out.done_reading and not bg_out.buffer_full:
+                # doing this until we reach either end of file, or end of buffer.
+                _changed.wait()
+        finally:
+            _changed.release()
 
         # at this point it's still ambiguous if we are done reading or just full buffer.
-        # Either way, if error (returned by ended process, or implied based on 
-        # presence of stuff in stderr output) we error out.
-        # Else, we are happy.
+        # At end of output, the process is exiting and we wait for its exit code.
+        # Only a non-zero exit code is an error. Output on stderr alone is not:
+        # git writes progress and warnings there.
         _returncode = _p.poll()
-        if _returncode or (_returncode == None and bg_err.length):
-            try:
-                _p.terminate()
-            except:
-                pass
+        if _returncode is None and bg_out.done_reading:
+            _returncode = _p.wait()
+        if _returncode:
             bg_out.stop()
+            # it exited. All it said is on its way.
+            _error = bg_err.tail(wait = True)
             bg_err.stop()
-            raise EnvironmentError("Subprocess exited due to an error.\n" + "".join(bg_err))
+            if self.span is not None:
+                self.span.finish(_returncode, self._bytes_fed())
+            metrics.process_exited(self.command)
+            self.command = None
+            raise EnvironmentError("Subprocess exited due to an error.\n" + _error)
 
         self.process = _p
         self.output = bg_out
         self.error = bg_err
+        _live_chunkers.add(self)
+
+    def _bytes_fed(self):
+        if self.input_streamer is not None:
+            return self.input_streamer.written
+        return self.bytes_in
 
     def __iter__(self):
         return self
 
     def next(self):
         if self.process.poll():
-            raise EnvironmentError("Subprocess exited due to an error:\n" + ''.join(self.error))
-        return self.output.next()
+            raise EnvironmentError("Subprocess exited due to an error:\n" + self.error.tail(wait = True))
+        chunk = self.output.next()
+        self.bytes_out += len(chunk)
+        return chunk
+
+    def splice_source(self):
+        '''
+        For servers able to move data from a pipe to a socket in the kernel,
+        with splice() (see wsgiserver2.WSGIGateway.splice_response). Hands
+        our stdout pipe over to the caller. Do not iterate over us after this.
+
+        @return None if output cannot be handed over (is not read through
+            the IOLoop, or spills to disk), else (chunks, fd). chunks is an
+            iterable of what was read already. Send it first. Then read fd
+            to its end and call splice_finished().
+        '''
+        worker = self.output.worker
+        if not isinstance(worker, PipeReader) or worker.closed:
+            return None
+        if isinstance(self.output.data, SpillBuffer):
+            # splice() would move output at the client's pace. With spill,
+            # the subprocess is not to be held up by a slow client.
+            return None
+        worker.detach()
+        data = self.output.data
+        def chunks():
+            while len(data):
+                chunk = data.popleft()
+                self.bytes_out += len(chunk)
+                yield chunk
+        return chunks(), worker.fd
+
+    def splice_finished(self, spliced = 0):
+        '''
+        Raises EnvironmentError if the subprocess, whose output was spliced
+        to its end, failed.
+
+        @param spliced Number of bytes moved from the pipe.
+        '''
+        self.bytes_out += spliced
+        if self.process.wait():
+            raise EnvironmentError("Subprocess exited due to an error:\n" + self.error.tail(wait = True))
 
     def throw(self, type, value=None, traceback=None):
         if self.output.length or not self.output.done_reading:
@@ -377,7 +1195,30 @@ class SubprocessIOChunker():
 
     def close(self):
         try:
-            self.process.terminate()
+            # module globals are None when called from __del__ at exit.
+            _live_chunkers.discard(self)
+        except:
+            pass
+        try:
+            if self.command is not None:
+                metrics.process_exited(self.command)
+                self.command = None
+        except:
+            pass
+        try:
+            if self.span is not None and self.span.end is None:
+                # at EOF on both pipes, the process is exiting. Its exit
+                # code is worth the short wait.
+                if self.output.done_reading and self.error.done_reading:
+                    self.process.wait()
+                self.span.finish(self.process.returncode, self._bytes_fed(), self.bytes_out)
+        except:
+            pass
+        try:
+            # once reaped (say, by post_push.PostPushQueue), the pid may
+            # belong to someone else.
+            if self.process.returncode is None:
+                self.process.terminate()
         except:
             pass
         try:
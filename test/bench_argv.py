@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+'''
+Latency of one git invocation of the kind every smart HTTP request makes
+(`git upload-pack --stateless-rpc --advertise-refs <repo>`, read to its end
+through SubprocessIOChunker), started:
+  - as a shell command string (/bin/sh, then a PATH lookup for git),
+  - as an argv list with the git path resolved once (git.utils.git_executable),
+each by forking this process and through the spawner.py helper.
+
+Usage: python test/bench_argv.py [runs]
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import time
+import shutil
+import tempfile
+import zipfile
+
+import subprocessio
+import spawner
+from git.utils import git_executable
+
+def measure(cmd, runs):
+    ''.join(subprocessio.SubprocessIOChunker(cmd)) # warm up
+    _start = time.time()
+    for i in xrange(runs):
+        _c = subprocessio.SubprocessIOChunker(cmd)
+        ''.join(_c)
+        _c.close()
+    return (time.time() - _start) / runs * 1000
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    _p = tempfile.mkdtemp()
+    try:
+        zipfile.ZipFile(os.path.join(tfpath, 'sample_tree_of_repos_v2.zip')).extractall(_p)
+        repo_path = os.path.join(_p, 'reposbase', 'projects', 'demorepoone')
+        _commands = [
+            ('shell string', 'git upload-pack --stateless-rpc --advertise-refs "%s"' % repo_path),
+            ('argv list', [git_executable(), 'upload-pack', '--stateless-rpc', '--advertise-refs', repo_path])
+            ]
+        print 'Runs: %s' % runs
+        for _spawner in (False, True):
+            if _spawner:
+                spawner.start()
+            for _name, _cmd in _commands:
+                print '%-14s %-18s %6.2f ms' % (
+                    _name,
+                    _spawner and 'spawner.popen' or 'subprocess.Popen',
+                    measure(_cmd, runs))
+        spawner.stop()
+    finally:
+        shutil.rmtree(_p, True)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+'''
+Spawns per second of a trivial command (`true`, with stdout and stderr
+piped, as SubprocessIOChunker does) through subprocess.Popen, which forks
+this process, and through the spawner.py helper process.
+
+The process is first grown to the given size (touched memory, like that of
+caches), as the cost of forking grows with it. The helper is started before
+that, as G.E.S. does.
+
+Usage: python test/bench_spawner.py [megabytes of memory] [spawns] [threads]
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import time
+import threading
+import subprocess
+
+import spawner
+
+def measure(popen, spawns, threads):
+    def _spawn(count):
+        for i in xrange(count):
+            _p = popen(['true'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            _p.stdout.read()
+            _p.stderr.close()
+            _p.stdout.close()
+            _p.wait()
+    _threads = [threading.Thread(target = _spawn, args = (spawns // threads,))
+        for i in xrange(threads)]
+    _start = time.time()
+    for _t in _threads:
+        _t.start()
+    for _t in _threads:
+        _t.join()
+    return (spawns // threads) * threads / (time.time() - _start)
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    spawns = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    spawner.start()
+    _ballast = bytearray(megabytes * 1024 * 1024)
+    for i in xrange(0, len(_ballast), 4096):
+        _ballast[i] = 1
+
+    print 'Memory: %s MB, spawns: %s, threads: %s' % (megabytes, spawns, threads)
+    for _name, _popen in [('subprocess.Popen', subprocess.Popen), ('spawner.popen', spawner.popen)]:
+        print '%-20s %8.0f spawns/sec' % (_name, measure(_popen, spawns, threads))
+    spawner.stop()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+'''
+Server CPU time per GB of response body streamed from a subprocess (as
+pack data is, from git upload-pack) through the bundled wsgiserver, with
+and without the splice() fast path.
+
+The client runs in a process of its own and is not counted.
+
+Usage: python test/bench_splice.py [megabytes]
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import time
+import socket
+import resource
+import threading
+import subprocess
+
+import subprocessio
+import wsgiserver
+from wsgiserver import wsgiserver2
+
+_client = r"""
+import sys, httplib
+c = httplib.HTTPConnection('127.0.0.1', int(sys.argv[1]))
+c.request('GET', '/')
+r = c.getresponse()
+n = 0
+while True:
+    b = r.read(1048576)
+    if not b:
+        break
+    n += len(b)
+print n
+"""
+
+def cpu():
+    _u = resource.getrusage(resource.RUSAGE_SELF)
+    return _u.ru_utime + _u.ru_stime
+
+def measure(megabytes, use_splice):
+    _s = socket.socket()
+    _s.bind(('127.0.0.1', 0))
+    port = _s.getsockname()[1]
+    _s.close()
+    def _app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/x-git-upload-pack-result')])
+        return subprocessio.SubprocessIOChunker(['head', '-c', str(megabytes * 1024 * 1024), '/dev/zero'])
+    server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', port), _app)
+    wsgiserver2.WSGIGateway.use_splice = use_splice
+    _t = threading.Thread(target = server.start)
+    _t.daemon = True
+    _t.start()
+    while not server.ready:
+        time.sleep(0.01)
+    try:
+        _cpu = cpu()
+        _t = time.time()
+        _received = subprocess.check_output([sys.executable, '-c', _client, str(port)])
+        _t = time.time() - _t
+        _cpu = cpu() - _cpu
+    finally:
+        server.stop()
+    assert int(_received) == megabytes * 1024 * 1024
+    return _cpu * 1024 / megabytes, megabytes / _t
+
+def main(megabytes):
+    for _name, _use_splice in [('read/write', False), ('splice', True)]:
+        _cpu, _rate = measure(megabytes, _use_splice)
+        print('%-12s server CPU %5.2f s/GB, %7.1f MB/s' % (_name, _cpu, _rate))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
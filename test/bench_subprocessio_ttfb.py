@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+'''
+Time to first byte (and to last) of tiny git responses, like info/refs
+advertisements, served through SubprocessIOChunker.
+
+Usage: python test/bench_subprocessio_ttfb.py [iterations] [--threads]
+
+--threads runs pipes through a thread each, instead of the shared IOLoop.
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import time
+import tempfile
+import shutil
+import zipfile
+
+import subprocessio
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def measure(cmd, iterations):
+    first = []
+    last = []
+    for i in xrange(iterations):
+        _t = time.time()
+        _c = subprocessio.SubprocessIOChunker(cmd)
+        _c.next()
+        first.append(time.time() - _t)
+        for chunk in _c:
+            pass
+        last.append(time.time() - _t)
+        _c.close()
+    return first, last
+
+def main(iterations):
+    _p = tempfile.mkdtemp()
+    try:
+        zipfile.ZipFile(os.path.join(tfpath, 'sample_tree_of_repos_v2.zip')).extractall(_p)
+        _repo = os.path.join(_p, 'reposbase', 'projects', 'demorepoone')
+        for _name, _cmd in [
+                ('git --version', ['git', '--version']),
+                ('info/refs advert', ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', _repo]),
+                # git on a cold disk, or a busy box.
+                ('slow advert', ['sh', '-c', 'sleep 0.02; exec git upload-pack --stateless-rpc --advertise-refs "$0"', _repo]),
+                # more than the buffer. The consumer catches up with git and waits.
+                ('1 MB stream', ['head', '-c', '1000000', '/dev/zero'])
+                ]:
+            first, last = measure(_cmd, iterations)
+            print('%-20s first byte: median %6.1f ms, p90 %6.1f ms | last byte: median %6.1f ms, p90 %6.1f ms' % (
+                _name,
+                percentile(first, 0.5) * 1000, percentile(first, 0.9) * 1000,
+                percentile(last, 0.5) * 1000, percentile(last, 0.9) * 1000))
+    finally:
+        shutil.rmtree(_p, True)
+
+if __name__ == "__main__":
+    if '--threads' in sys.argv:
+        sys.argv.remove('--threads')
+        subprocessio.use_io_loop = False
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -1,10 +1,14 @@
 import unittest
 import test_fuzzy_path_handler as fuzzy
 import test_ges_rpc_methods as gesrpc
+import test_git as gitpkg
+import test_repo_index as repoindex
+import test_git_http_backend as githttp
+import test_subprocessio as subprocio
 
 if __name__ == "__main__":
     testresults = []
-    tests = [fuzzy, gesrpc]
+    tests = [fuzzy, gesrpc, gitpkg, repoindex, githttp, subprocio]
     for t in tests:
         print('\nTESTING:\n%s\n' % t)
         testresults.append( 
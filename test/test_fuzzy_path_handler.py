@@ -24,10 +24,12 @@ import zipfile
 import shutil
 import os
 import sys
+import time
 
 sys.path.append(os.getcwd())
 
 import fuzzy_path_handler as subject
+import git
 
 class test_WSGIFuzzyApplication(unittest.TestCase):
 
@@ -77,6 +79,208 @@ class test_WSGIFuzzyApplication(unittest.TestCase):
             , open('./test/sample_git_archive_output.zip','rb').read()
             )
 
+    def test_02_getting_file(self):
+        _headers = {}
+        def _start_response(code, headers):
+            self._start_response(code, headers)
+            _headers.update(headers)
+        _environ = {
+            'wsgi.version': (1,1),
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'PATH_INFO':'projects/demorepoone/master/firstdoc.txt'
+            }
+        _in_memory = self._string_from_iterator(self.h(_environ, _start_response))
+        self.assertEquals(len(_in_memory), 65)
+        self.assertEquals(_headers['Content-Length'], '65')
+
+        # anything larger than the buffer is streamed from git.
+        self.h.bufsize = 16
+        _response = self.h(_environ, _start_response)
+        self.assertTrue(isinstance(_response, subject.subprocessio.SubprocessIOChunker))
+        self.assertEquals(self._string_from_iterator(_response), _in_memory)
+        self.assertEquals(_headers['Content-Length'], '65')
+
+    def test_03_zip_streamed_or_from_temp_file(self):
+        _environ = {
+            'wsgi.version': (1,1),
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'PATH_INFO':'projects/demorepoone/master'
+            }
+        _names = []
+        for _stream in [True, False]:
+            self.h.stream_archives = _stream
+            _z = zipfile.ZipFile(io.BytesIO(
+                self._string_from_iterator(self.h(_environ, self._start_response))
+                ))
+            _names.append(sorted(_z.namelist()))
+        self.assertEquals(_names[0], _names[1])
+        self.assertTrue('demorepoone/master/firstdoc.txt' in _names[0])
+
+        # with the fork server running, the temp file is written by its child.
+        _spawned = []
+        _popen = subject.spawner.popen
+        def _recording_popen(args, **kw):
+            _p = _popen(args, **kw)
+            _spawned.append(('archive' in args, isinstance(_p, subject.spawner.SpawnedProcess)))
+            return _p
+        self.assertTrue(subject.spawner.start())
+        subject.spawner.popen = _recording_popen
+        try:
+            _z = zipfile.ZipFile(io.BytesIO(
+                self._string_from_iterator(self.h(_environ, self._start_response))
+                ))
+        finally:
+            subject.spawner.popen = _popen
+            subject.spawner.stop()
+        self.assertEquals(sorted(_z.namelist()), _names[0])
+        self.assertTrue((True, True) in _spawned)
+
+    def test_04_archive_cache_and_etag(self):
+        _cache_path = os.path.join(os.path.split(self.base_path)[0], 'archives')
+        self.h = subject.FuzzyPathHandler(
+            content_path = self.base_path,
+            archive_cache_path = _cache_path
+            )
+        _environ = {
+            'wsgi.version': (1,1),
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'PATH_INFO':'projects/demorepoone/master'
+            }
+        _status = []
+        _headers = {}
+        def _start_response(code, headers):
+            _status.append(code)
+            _headers.update(headers)
+
+        _first = self._string_from_iterator(self.h(dict(_environ), _start_response))
+        self.assertEquals(self.h.archive_cache.stats()['entries'], 1)
+        _second = self._string_from_iterator(self.h(dict(_environ), _start_response))
+        self.assertEquals(_first, _second)
+        self.assertEquals(self.h.archive_cache.stats()['hits'], 1)
+        self.assertEquals(_headers['Content-Length'], str(len(_first)))
+        # ETag is the id of the commit, of the tree and archive format.
+        _c = git.Repo(os.path.join(self.base_path, 'projects', 'demorepoone')).commit('master')
+        self.assertEquals(_headers['ETag'], '"%s.79f8e83ff57a3284521e5430aad9ef079e737aa4.zip"' % _c.id)
+
+        _environ['HTTP_IF_NONE_MATCH'] = _headers['ETag']
+        self.h(dict(_environ), _start_response)
+        self.assertEquals(_status, ['200 OK', '200 OK', '304 Not Modified'])
+
+    def test_05_archive_formats(self):
+        import tarfile
+        _headers = {}
+        def _start_response(code, headers):
+            self._start_response(code, headers)
+            _headers.update(headers)
+        def _get(path, accept = None):
+            _environ = {
+                'wsgi.version': (1,1),
+                'REQUEST_METHOD': 'GET',
+                'wsgi.input': io.BytesIO(''),
+                'PATH_INFO': path
+                }
+            if accept:
+                _environ['HTTP_ACCEPT'] = accept
+            return self._string_from_iterator(self.h(_environ, _start_response))
+
+        _names = zipfile.ZipFile(io.BytesIO(_get('projects/demorepoone/master'))).namelist()
+        _tar = tarfile.open(fileobj = io.BytesIO(_get('projects/demorepoone/master.tar')))
+        self.assertEquals(sorted(_tar.getnames()), sorted([_n.rstrip('/') for _n in _names]))
+        self.assertEquals(_headers['Content-Type'], 'application/x-tar')
+
+        _tar = tarfile.open(fileobj = io.BytesIO(_get('projects/demorepoone/master', 'application/gzip')), mode = 'r:gz')
+        self.assertEquals(sorted(_tar.getnames()), sorted([_n.rstrip('/') for _n in _names]))
+        self.assertEquals(_headers['Content-Disposition'], 'attachment; filename="demorepoone_master.tar.gz"')
+
+        # suffix on a file that is there - the file, not an archive.
+        self.assertEquals(len(_get('projects/demorepoone/master/firstdoc.txt')), 65)
+        # suffix on a file - not a folder, not found.
+        self.assertRaises(Exception, _get, 'projects/demorepoone/master/firstdoc.txt.tar')
+
+    def test_06_commits_sharing_a_tree(self):
+        _cache_path = os.path.join(os.path.split(self.base_path)[0], 'archives')
+        self.h = subject.FuzzyPathHandler(
+            content_path = self.base_path,
+            archive_cache_path = _cache_path
+            )
+        _g = git.Git(os.path.join(self.base_path, 'projects', 'demorepoone'))
+        _headers = {}
+        def _start_response(code, headers):
+            self._start_response(code, headers)
+            _headers.update(headers)
+        def _get():
+            _environ = {
+                'wsgi.version': (1,1),
+                'REQUEST_METHOD': 'GET',
+                'wsgi.input': io.BytesIO(''),
+                'PATH_INFO': 'projects/demorepoone/master'
+                }
+            _z = zipfile.ZipFile(io.BytesIO(self._string_from_iterator(self.h(_environ, _start_response))))
+            return _z.comment, _headers['ETag']
+
+        _first = _get()
+        # new commit, same tree, same name.
+        _id = _g.execute(['git', '-c', 'user.name=T', '-c', 'user.email=t@e',
+            'commit-tree', 'master^{tree}', '-p', 'master', '-m', 'same tree'])
+        _g.update_ref('refs/heads/master', _id)
+        _second = _get()
+        # zip's comment is the id of the commit git archived.
+        self.assertEquals(_second[0], _id)
+        self.assertNotEquals(_first[0], _second[0])
+        self.assertNotEquals(_first[1], _second[1])
+        self.assertEquals(self.h.archive_cache.stats()['entries'], 2)
+
+    def test_07_tar_zst_only_with_zstd(self):
+        import subprocess
+        import tarfile
+        _environ = {
+            'wsgi.version': (1,1),
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'PATH_INFO': 'projects/demorepoone/master.tar.zst'
+            }
+        _h = subject.FuzzyPathHandler(
+            content_path = self.base_path,
+            archive_filters = {'tar.zst': 'no-such-zstd-here -c -q'}
+            )
+        self.assertFalse('tar.zst' in _h.archive_formats)
+        self.assertTrue('tar.gz' in _h.archive_formats)
+        self.assertRaises(Exception, lambda: ''.join(_h(dict(_environ), self._start_response)))
+        # not picked by Accept either.
+        self.assertEquals(_h._archive_format_from_accept('application/zstd'), None)
+
+        if not git.utils.find_executable('zstd'):
+            self.skipTest('zstd is not installed')
+        _h = subject.FuzzyPathHandler(content_path = self.base_path)
+        self.assertTrue('tar.zst' in _h.archive_formats)
+        _data = ''.join(_h(dict(_environ), self._start_response))
+        self.assertEquals(_data[:4], '\x28\xb5\x2f\xfd')
+        _tar = subprocess.Popen(['zstd', '-d', '-c', '-q'],
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE).communicate(_data)[0]
+        _names = tarfile.open(fileobj = io.BytesIO(_tar)).getnames()
+        self.assertTrue('demorepoone/master/firstdoc.txt' in _names)
+
+    def test_08_archives_never_spill(self):
+        _environ = {
+            'wsgi.version': (1,1),
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'PATH_INFO': 'projects/demorepoone/master.tar'
+            }
+        self.h.bufsize = 1024
+        _response = self.h(_environ, self._start_response)
+        self.assertTrue(isinstance(_response, subject.subprocessio.SubprocessIOChunker))
+        # nobody reads. Output past the buffer waits in the pipe, not on disk.
+        time.sleep(0.5)
+        self.assertTrue(_response.output.reading_paused)
+        self.assertFalse(isinstance(_response.output.data, subject.subprocessio.SpillBuffer))
+        self.assertEquals(subject.subprocessio.buffer_stats()['spilled_bytes'], 0)
+        self.assertTrue(len(self._string_from_iterator(_response)) > 1024)
+        _response.close()
+
 def suite():
         return unittest.TestSuite([
             # unittest.TestLoader().loadTestsFromTestCase(test_JSONRPCHandlerRouter) ,
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import unittest
+import tempfile
+import shutil
+import zipfile
+import threading
+import time
+
+import git
+from git import catfile
+
+class test_ObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        _p = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(_p)
+        self.base_path = os.path.join(_p, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.split(self.base_path)[0], True)
+
+    def test_01_lru_budget(self):
+        _c = git.ObjectCache(max_bytes = 3000, max_blob_bytes = 1000)
+        _sha = '%040x'
+        _c.set('r', 'data', _sha % 1, 'a' * 900)
+        _c.set('r', 'data', _sha % 2, 'b' * 900)
+        # not a SHA - names like 'master' are not immutable.
+        _c.set('r', 'data', 'master', 'c')
+        # too big a blob
+        _c.set('r', 'data', _sha % 3, 'd' * 1001)
+        self.assertEquals(_c.get('r', 'data', 'master'), None)
+        self.assertEquals(_c.get('r', 'data', _sha % 3), None)
+        # touching 1 makes 2 the least recently used one.
+        self.assertEquals(_c.get('r', 'data', _sha % 1), 'a' * 900)
+        _c.set('r', 'data', _sha % 4, 'e' * 900)
+        self.assertEquals(_c.get('r', 'data', _sha % 2), None)
+        self.assertEquals(_c.get('r', 'data', _sha % 1), 'a' * 900)
+        _s = _c.stats()
+        self.assertEquals(_s['evictions'], 1)
+        self.assertEquals(_s['hits'], {'data': 2})
+        self.assertEquals(_s['misses'], {'data': 3})
+        self.assertTrue(_s['bytes'] <= 3000)
+
+    def test_02_tree_listing_is_shared(self):
+        _cache = git.ObjectCache()
+        _sizes = []
+        for i in range(2):
+            _r = git.Repo(self.repo_path)
+            _r.object_cache = _cache
+            _t = _r.tree('79f8e83ff57a3284521e5430aad9ef079e737aa4', long_listing = True)
+            _sizes.append(_t['firstdoc.txt'].size)
+        self.assertEquals(_sizes, [65, 65])
+        self.assertEquals(_cache.stats()['hits'], {'tree': 1})
+
+class test_TreeListing(unittest.TestCase):
+
+    names = ['plain.txt', 'tab\there.txt', 'new\nline.txt', ' lead and trail ']
+
+    def setUp(self):
+        # names with tabs and new lines cannot be in the zip fixture.
+        self.repo_path = tempfile.mkdtemp()
+        _g = git.Git(self.repo_path)
+        _g.init()
+        for _i, _name in enumerate(self.names):
+            open(os.path.join(self.repo_path, _name), 'wb').write('x' * (_i + 1))
+        os.mkdir(os.path.join(self.repo_path, 'sub\tdir'))
+        open(os.path.join(self.repo_path, 'sub\tdir', 'in\nside'), 'wb').write('y' * 10)
+        _g.add('.')
+        _g.execute(['git', '-c', 'user.name=T', '-c', 'user.email=t@e', 'commit', '-q', '-m', 'names'])
+        self.repo = git.Repo(self.repo_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path, True)
+
+    def test_01_parse(self):
+        _entries = git.Tree.entries_from_long_listing(
+            self.repo.git.ls_tree('HEAD', l = True, z = True, with_raw_output = True))
+        _by_name = dict([(_e[3], _e) for _e in _entries])
+        self.assertEquals(sorted(_by_name.keys()), sorted(self.names + ['sub\tdir']))
+        for _i, _name in enumerate(self.names):
+            self.assertEquals(_by_name[_name][1], 'blob')
+            self.assertEquals(_by_name[_name][4], _i + 1)
+        self.assertEquals(_by_name['sub\tdir'][1:2] + _by_name['sub\tdir'][4:], ('tree', None))
+
+    def test_02_long_listing(self):
+        _tree = self.repo.tree(self.repo.commit('HEAD').tree.id, long_listing = True)
+        self.assertEquals(sorted(_tree.keys()), sorted(self.names + ['sub\tdir']))
+        self.assertEquals([_tree[_n].size for _n in self.names], [1, 2, 3, 4])
+        _sub = _tree['sub\tdir']
+        self.assertTrue(_sub.long_listing)
+        self.assertEquals(_sub['in\nside'].size, 10)
+        self.assertEquals(_sub['in\nside'].data, 'y' * 10)
+        # same entries as read through cat-file
+        _plain = self.repo.tree(_tree.id)
+        self.assertEquals(sorted([(_k, _v.id) for _k, _v in _plain.items()]),
+            sorted([(_k, _v.id) for _k, _v in _tree.items()]))
+
+class test_RefTable(unittest.TestCase):
+
+    def setUp(self):
+        _p = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(_p)
+        self.base_path = os.path.join(_p, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.split(self.base_path)[0], True)
+
+    def test_01_resolve(self):
+        _r = git.Repo(self.repo_path)
+        self.assertEquals(_r.resolve_ref('master'), '3408e8f7720eff4a1fd16e9bf654332036c39bf8')
+        self.assertEquals(_r.resolve_ref('heads/stable'), '263e545b2227821bd7254bfb60fb11dae3aa9d0b')
+        # annotated tag is peeled to the commit
+        self.assertEquals(_r.resolve_ref('0.1'), '457c6388d3d6f2608038a543e272e7fc1dfc2082')
+        self.assertEquals(_r.resolve_ref('HEAD'), '3408e8f7720eff4a1fd16e9bf654332036c39bf8')
+        # not plain ref names. git has to deal with these.
+        self.assertEquals(_r.resolve_ref('master~1'), None)
+        self.assertEquals(_r.resolve_ref('nosuchbranch'), None)
+        self.assertEquals(_r.commit('0.2').id, '263e545b2227821bd7254bfb60fb11dae3aa9d0b')
+        self.assertEquals(_r.commit('master~1').id, '5294a5c8ac538df0b1427779fb2664b25e11d8b5')
+        self.assertRaises(ValueError, _r.commit, 'master~100')
+
+    def test_04_sha_must_name_a_commit(self):
+        _r = git.Repo(self.repo_path)
+        _commit = '3408e8f7720eff4a1fd16e9bf654332036c39bf8'
+        self.assertEquals(_r.resolve_ref(_commit), _commit)
+        self.assertEquals(_r.commit(_commit).id, _commit)
+        # annotated tag object, peeled to its commit.
+        _tag = _r.git.rev_parse('refs/tags/0.1')
+        self.assertNotEquals(_tag, '457c6388d3d6f2608038a543e272e7fc1dfc2082')
+        self.assertEquals(_r.resolve_ref(_tag), '457c6388d3d6f2608038a543e272e7fc1dfc2082')
+        # missing object, tree
+        for _sha in ['0' * 40, _r.commit(_commit).tree.id]:
+            self.assertEquals(_r.resolve_ref(_sha), None)
+            self.assertRaises(ValueError, _r.commit, _sha)
+
+    def test_02_rebuilt_only_when_refs_change(self):
+        _r = git.Repo(self.repo_path)
+        _table = _r.ref_table
+        _builds = _table.builds
+        for i in range(3):
+            git.Repo(self.repo_path).resolve_ref('master')
+        self.assertEquals(_table.builds, _builds)
+
+        _r.git.update_ref('refs/heads/newbranch', 'stable')
+        self.assertEquals(_r.resolve_ref('newbranch'), '263e545b2227821bd7254bfb60fb11dae3aa9d0b')
+        self.assertEquals(_table.builds, _builds + 1)
+
+    def test_03_ref_summary(self):
+        _r = git.Repo(self.repo_path)
+        _heads, _tags = _r.ref_summary()
+        _heads = dict([(_e.name, _e.commit) for _e in _heads])
+        _tags = dict([(_e.name, _e.commit) for _e in _tags])
+        self.assertEquals(_heads['master'].id, '3408e8f7720eff4a1fd16e9bf654332036c39bf8')
+        self.assertEquals(_tags['0.1'].id, '457c6388d3d6f2608038a543e272e7fc1dfc2082')
+        # branch and tag pointing at same commit share the Commit object
+        self.assertTrue(_heads['stable'] is _tags['0.2'])
+        # prefilled, no `git rev-list` needed.
+        _c = _heads['master']
+        self.assertEquals(_c.message, _r.commit('master~0').message.split('\n')[0])
+        self.assertEquals(_c.author.name, _r.commit('master~0').author.name)
+        # summary is kept with the ref table, until refs change.
+        self.assertTrue(_r.ref_table.summary(_r.git) is _r.ref_table.summary(_r.git))
+
+    def test_05_fingerprint_sees_ref_renamed_into_place(self):
+        # git writes refs/heads/x.lock and renames it to refs/heads/x.
+        # Same second, same size: only the inode tells the two apart.
+        _heads = os.path.join(self.repo_path, 'refs', 'heads')
+        _ref = os.path.join(_heads, 'fingerprinted')
+        open(_ref, 'wb').write('3408e8f7720eff4a1fd16e9bf654332036c39bf8\n')
+        _times = (int(time.time()), int(time.time()))
+        os.utime(_ref, _times)
+        os.utime(_heads, _times)
+        _before = git.utils.refs_fingerprint(self.repo_path)
+        _lock = _ref + '.lock'
+        open(_lock, 'wb').write('263e545b2227821bd7254bfb60fb11dae3aa9d0b\n')
+        os.utime(_lock, _times)
+        os.rename(_lock, _ref)
+        os.utime(_heads, _times)
+        _after = git.utils.refs_fingerprint(self.repo_path)
+        self.assertEquals(
+            [_p[:3] for _p in _before],
+            [_p[:3] for _p in _after]
+            )
+        self.assertNotEquals(_before, _after)
+
+class test_CatFilePool(unittest.TestCase):
+
+    def setUp(self):
+        _p = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(_p)
+        self.base_path = os.path.join(_p, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+        self.pool = catfile.CatFilePool(self.repo_path, max_processes = 2, idle_timeout = 60)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(os.path.split(self.base_path)[0], True)
+
+    def test_01_header_and_body(self):
+        _ref = '79f8e83ff57a3284521e5430aad9ef079e737aa4:firstdoc.txt'
+        _id, _type, _size, _data = self.pool.request(_ref)
+        self.assertEquals((len(_id), _type, _size, _data), (40, 'blob', 65, None))
+        _id2, _type, _size, _data = self.pool.request(_ref, '--batch')
+        self.assertEquals((_id2, _type, _size, len(_data)), (_id, 'blob', 65, 65))
+        self.assertEquals(self.pool.request(_id, '--batch')[3], _data)
+        self.assertEquals(self.pool.request('master', '--batch')[1], 'commit')
+        self.assertTrue(self.pool.request('master', '--batch')[3].startswith('tree '))
+        # missing objects leave the process in sync, and in the pool.
+        _p = self.pool._idle['--batch'][0]
+        self.assertRaises(ValueError, self.pool.request, '0' * 40, '--batch')
+        self.assertRaises(ValueError, self.pool.request, 'nosuchbranch', '--batch')
+        self.assertTrue(self.pool._idle['--batch'] == [_p] and _p.alive)
+        self.assertEquals(self.pool.request(_id, '--batch')[3], _data)
+
+    def test_02_process_cap(self):
+        _p1 = self.pool._checkout('--batch')
+        _p2 = self.pool._checkout('--batch')
+        _got = []
+        _t = threading.Thread(target = lambda: _got.append(self.pool._checkout('--batch')))
+        _t.start()
+        time.sleep(0.2)
+        # both busy, the third waits.
+        self.assertEquals(_got, [])
+        self.assertEquals(self.pool._count['--batch'], 2)
+        self.pool._checkin(_p1)
+        _t.join(10)
+        self.assertTrue(_got == [_p1])
+        self.pool._checkin(_p1)
+        self.pool._checkin(_p2)
+        self.assertEquals(self.pool._count['--batch'], 2)
+
+    def test_03_idle_sweep(self):
+        self.pool.request('master')
+        self.pool.request('master', '--batch')
+        _procs = self.pool._idle['--batch'] + self.pool._idle['--batch-check']
+        self.assertEquals(self.pool.evict_idle(), 2)
+        self.assertEquals(self.pool.evict_idle(time.time() + 61), 0)
+        self.assertEquals([_p.alive for _p in _procs], [False, False])
+        self.assertEquals(self.pool.request('master')[1], 'commit')
+
+    def test_04_recovers_from_failed_read(self):
+        class _Failing(object):
+            '''Passes the header on, then fails reading the body.'''
+            def __init__(self, stream):
+                self.stream = stream
+            def readline(self):
+                return self.stream.readline()
+            def read(self, size):
+                raise IOError('read failed')
+            def close(self):
+                self.stream.close()
+        self.pool.request('master', '--batch')
+        _p = self.pool._idle['--batch'][0]
+        _p.proc.stdout = _Failing(_p.proc.stdout)
+        self.assertRaises(git.GitCommandError, self.pool.request, 'master', '--batch')
+        # the process, out of sync now, is gone, and its slot is free.
+        self.assertFalse(_p.alive)
+        self.assertEquals((self.pool._idle['--batch'], self.pool._count['--batch']), ([], 0))
+        self.assertTrue(self.pool.request('master', '--batch')[3].startswith('tree '))
+
+class test_GitExecutable(unittest.TestCase):
+
+    def test_01_resolved_once(self):
+        _path = git.utils.git_executable()
+        self.assertTrue(os.path.isabs(_path))
+        self.assertTrue(os.access(_path, os.X_OK))
+        self.assertTrue(git.utils.git_executable() is _path)
+        # commands are exec'd with the resolved path, no shell.
+        self.assertTrue(git.Git(None).version().startswith('git version'))
+
+def suite():
+    return  unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(test_ObjectCache),
+            unittest.TestLoader().loadTestsFromTestCase(test_TreeListing),
+            unittest.TestLoader().loadTestsFromTestCase(test_RefTable),
+            unittest.TestLoader().loadTestsFromTestCase(test_CatFilePool),
+            unittest.TestLoader().loadTestsFromTestCase(test_GitExecutable),
+        ])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run( suite() )
@@ -0,0 +1,792 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import io
+import unittest
+import tempfile
+import shutil
+import zipfile
+import gzip
+import zlib
+import threading
+import time
+
+import git_http_backend
+import pack_cache
+import post_push
+import admission
+import response_compression
+import request_trace
+import metrics
+import on_close
+
+class test_PackCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+        self.cache_path = os.path.join(self.temp_path, 'packs')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def _request(self, handler, git_command, body):
+        _status = []
+        _headers = {}
+        def _start_response(code, headers):
+            _status.append(code)
+            _headers.update(headers)
+        _response = handler(
+            {
+                'wsgi.version': (1,1),
+                'wsgi.errors': sys.stderr,
+                'REQUEST_METHOD': 'POST',
+                'wsgi.input': io.BytesIO(body),
+                'wsgiorg.routing_args': ([], {
+                    'working_path': 'projects/demorepoone',
+                    'git_command': git_command
+                    })
+            },
+            _start_response
+            )
+        _body = ''.join(_response)
+        if hasattr(_response, 'close'):
+            _response.close()
+        return _status[0], _headers, _body
+
+    def test_01_upload_pack_response_is_reused(self):
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(
+            content_path = self.base_path,
+            pack_cache_path = self.cache_path
+            )
+        _body = '0032want 3408e8f7720eff4a1fd16e9bf654332036c39bf8\n00000009done\n'
+        _status, _headers, _first = self._request(_h, 'git-upload-pack', _body)
+        self.assertEquals(_status, '200 OK')
+        self.assertTrue(_first.startswith('0008NAK\n'))
+        _status, _headers, _second = self._request(_h, 'git-upload-pack', _body)
+        self.assertEquals(_first, _second)
+        self.assertEquals(_headers['Content-Length'], str(len(_first)))
+        self.assertEquals(_h.pack_cache.stats()['hits'], 1)
+
+        # push, even an empty one, drops what we have for the repo.
+        self._request(_h, 'git-receive-pack', '0000')
+        self.assertEquals(_h.pack_cache.stats()['entries'], 0)
+
+    def test_02_concurrent_requests_share_one_producer(self):
+        _cache = pack_cache.PackCache(self.cache_path, chunk_size = 4)
+        _go = threading.Event()
+        _produced = []
+        def _producer():
+            _produced.append(1)
+            def _slow():
+                yield 'abcd'
+                _go.wait()
+                yield 'efgh'
+            return _slow()
+        _key = _cache.key(self.repo_path, 'git-upload-pack', 'body')
+        _readers = [_cache.get(_key, self.repo_path, _producer)[0] for i in range(3)]
+        self.assertEquals([_r.next() for _r in _readers], ['abcd'] * 3)
+        _go.set()
+        self.assertEquals([''.join(_r) for _r in _readers], ['efgh'] * 3)
+        self.assertEquals(len(_produced), 1)
+        _t = time.time() + 5
+        while _cache.stats()['entries'] != 1 and time.time() < _t:
+            time.sleep(0.01)
+        _f, _size = _cache.get(_key, self.repo_path, _producer)
+        self.assertEquals((_f.read(), _size), ('abcdefgh', 8))
+        _f.close()
+
+    def test_03_too_large_to_keep(self):
+        _cache = pack_cache.PackCache(self.cache_path, max_bytes = 6, chunk_size = 4)
+        _go = [threading.Event(), threading.Event()]
+        _produced = []
+        def _producer():
+            _produced.append(1)
+            def _slow():
+                yield 'abcd'
+                _go[0].wait()
+                yield 'efgh'
+                _go[1].wait()
+                yield 'ijkl'
+            return _slow()
+        _key = _cache.key(self.repo_path, 'git-upload-pack', 'body')
+        _reader = _cache.get(_key, self.repo_path, _producer)[0]
+        self.assertEquals(_reader.next(), 'abcd')
+        _go[0].set()
+        self.assertEquals(_reader.next(), 'efgh')
+        # over max_bytes while still being written. Dropped right away.
+        _t = time.time() + 5
+        while os.listdir(self.cache_path) and time.time() < _t:
+            time.sleep(0.01)
+        self.assertEquals(os.listdir(self.cache_path), [])
+        self.assertEquals(_cache.stats()['filling'], 0)
+        _other = _cache.get(_key, self.repo_path, _producer)[0]
+        self.assertEquals(len(_produced), 2)
+        _go[1].set()
+        self.assertEquals(''.join(_reader), 'ijkl')
+        self.assertEquals(''.join(_other), 'abcdefghijkl')
+        self.assertEquals(_cache.stats()['entries'], 0)
+
+    def test_04_large_request_body_is_not_cached(self):
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(
+            content_path = self.base_path,
+            pack_cache_path = self.cache_path,
+            pack_cache_max_body_bytes = 16
+            )
+        _body = '0032want 3408e8f7720eff4a1fd16e9bf654332036c39bf8\n00000009done\n'
+        for i in range(2):
+            _status, _headers, _pack = self._request(_h, 'git-upload-pack', _body)
+            self.assertEquals(_status, '200 OK')
+            self.assertTrue(_pack.startswith('0008NAK\n'))
+        self.assertEquals(_h.pack_cache.stats()['misses'], 0)
+        self.assertEquals(_h.pack_cache.stats()['entries'], 0)
+
+class test_InfoRefs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def _request(self, handler, if_none_match = None):
+        _status = []
+        _headers = {}
+        def _start_response(code, headers):
+            _status.append(code)
+            _headers.update(headers)
+        _environ = {
+            'wsgi.version': (1,1),
+            'wsgi.errors': sys.stderr,
+            'REQUEST_METHOD': 'GET',
+            'wsgi.input': io.BytesIO(''),
+            'wsgiorg.routing_args': ([], {
+                'working_path': 'projects/demorepoone',
+                'git_command': 'git-upload-pack'
+                })
+            }
+        if if_none_match:
+            _environ['HTTP_IF_NONE_MATCH'] = if_none_match
+        _body = ''.join(handler(_environ, _start_response))
+        return _status[0], _headers, _body
+
+    def test_01_advert_cached_until_refs_change(self):
+        _h = git_http_backend.GitHTTPBackendInfoRefs(content_path = self.base_path)
+        _status, _headers, _body = self._request(_h)
+        self.assertEquals(_status, '200 OK')
+        self.assertTrue(_body.startswith('001d# service=git-upload-pack0000'))
+        self.assertEquals(_headers['Content-Length'], str(len(_body)))
+        _etag = _headers['ETag']
+        _cached = _h._adverts.values()[0]
+
+        _status, _headers, _body = self._request(_h, _etag)
+        self.assertEquals(_status, '304 Not Modified')
+        self.assertTrue(_h._adverts.values()[0] is _cached)
+
+        import git
+        git.Repo(self.repo_path).git.update_ref('refs/heads/newbranch', 'stable')
+        _status, _headers, _body = self._request(_h, _etag)
+        self.assertEquals(_status, '200 OK')
+        self.assertNotEquals(_headers['ETag'], _etag)
+        self.assertTrue('refs/heads/newbranch' in _body)
+
+class test_GzipRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def _gzip(self, data):
+        _f = io.BytesIO()
+        _g = gzip.GzipFile(fileobj = _f, mode = 'wb')
+        _g.write(data)
+        _g.close()
+        return _f.getvalue()
+
+    def test_01_decoder(self):
+        _data = ''.join([str(i) for i in xrange(200000)])
+        # two gzip members, one after the other, are one stream.
+        _body = io.BytesIO(self._gzip(_data[:1000]) + self._gzip(_data[1000:]))
+        _d = git_http_backend.GzipDecoder(_body, chunk_size = 1000)
+        _parts = list(iter(lambda: _d.read(4096), ''))
+        self.assertEquals(''.join(_parts), _data)
+        self.assertTrue(max([len(_p) for _p in _parts]) <= 4096)
+
+        _d = git_http_backend.GzipDecoder(io.BytesIO('not gzip at all'))
+        self.assertRaises(IOError, _d.read, 100)
+
+    def test_02_upload_pack(self):
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(content_path = self.base_path)
+        _body = '003ewant 3408e8f7720eff4a1fd16e9bf654332036c39bf8 no-progress\n00000009done\n'
+        _responses = []
+        for _input, _encoding in [(_body, None), (self._gzip(_body), 'gzip')]:
+            _environ = {
+                'wsgi.version': (1,1),
+                'wsgi.errors': sys.stderr,
+                'REQUEST_METHOD': 'POST',
+                'wsgi.input': io.BytesIO(_input),
+                'wsgiorg.routing_args': ([], {
+                    'working_path': 'projects/demorepoone',
+                    'git_command': 'git-upload-pack'
+                    })
+                }
+            if _encoding:
+                _environ['HTTP_CONTENT_ENCODING'] = _encoding
+            _status = []
+            _response = _h(_environ, lambda code, headers: _status.append(code))
+            _responses.append(''.join(_response))
+            _response.close()
+            self.assertEquals(_status, ['200 OK'])
+        self.assertEquals(_responses[0], _responses[1])
+        self.assertTrue(_responses[0].startswith('0008NAK\nPACK'))
+
+class test_ResponseCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def _request(self, handler, method, git_command, body = '', **environ):
+        _status = []
+        _headers = {}
+        def _start_response(code, headers):
+            _status.append(code)
+            _headers.update(headers)
+        _environ = {
+            'wsgi.version': (1,1),
+            'wsgi.errors': sys.stderr,
+            'REQUEST_METHOD': method,
+            'wsgi.input': io.BytesIO(body),
+            'wsgiorg.routing_args': ([], {
+                'working_path': 'projects/demorepoone',
+                'git_command': git_command
+                })
+            }
+        _environ.update(environ)
+        _response = handler(_environ, _start_response)
+        _body = ''.join(_response)
+        if hasattr(_response, 'close'):
+            _response.close()
+        return _status[0], _headers, _body
+
+    def test_01_negotiation_and_policy(self):
+        _n = lambda _h: (response_compression.negotiate(_h) or [None])[0]
+        self.assertEquals(_n('gzip, deflate'), 'gzip')
+        self.assertEquals(_n('deflate, gzip;q=0.5'), 'deflate')
+        self.assertEquals(_n('gzip;q=0, deflate'), 'deflate')
+        self.assertEquals(_n('x-gzip'), 'gzip')
+        self.assertEquals(_n('*'), 'gzip')
+        self.assertEquals(_n('identity'), None)
+        self.assertEquals(_n(None), None)
+        _c = response_compression.compressible
+        self.assertTrue(_c('text/html; charset=utf-8'))
+        self.assertTrue(_c('application/json'))
+        self.assertTrue(_c('application/x-git-upload-pack-advertisement'))
+        self.assertFalse(_c('application/x-git-upload-pack-result'))
+        self.assertFalse(_c('application/zip'))
+        self.assertFalse(_c(None))
+
+    def test_02_advert_compressed(self):
+        _h = git_http_backend.GitHTTPBackendInfoRefs(content_path = self.base_path)
+        _status, _headers, _plain = self._request(_h, 'GET', 'git-upload-pack')
+        self.assertFalse('Content-Encoding' in _headers)
+
+        _h.gzip_response = True
+        _status, _headers, _body = self._request(_h, 'GET', 'git-upload-pack',
+            HTTP_ACCEPT_ENCODING = 'gzip')
+        self.assertEquals(_headers['Content-Encoding'], 'gzip')
+        self.assertEquals(_headers['Vary'], 'Accept-Encoding')
+        self.assertEquals(_headers['Content-Length'], str(len(_body)))
+        self.assertEquals(gzip.GzipFile(fileobj = io.BytesIO(_body)).read(), _plain)
+        self.assertTrue(_headers['ETag'].startswith('W/"'))
+
+        # weak ETag of the compressed advert still validates.
+        _status, _headers, _body = self._request(_h, 'GET', 'git-upload-pack',
+            HTTP_ACCEPT_ENCODING = 'gzip', HTTP_IF_NONE_MATCH = _headers['ETag'])
+        self.assertEquals(_status, '304 Not Modified')
+
+        # client not asking for it gets it plain, but caches are told to look.
+        _status, _headers, _body = self._request(_h, 'GET', 'git-upload-pack')
+        self.assertEquals(_body, _plain)
+        self.assertEquals(_headers['Vary'], 'Accept-Encoding')
+
+    def test_03_pack_not_compressed(self):
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(
+            content_path = self.base_path, gzip_response = True)
+        _status, _headers, _body = self._request(_h, 'POST', 'git-upload-pack',
+            '003ewant 3408e8f7720eff4a1fd16e9bf654332036c39bf8 no-progress\n00000009done\n',
+            HTTP_ACCEPT_ENCODING = 'gzip, deflate')
+        self.assertEquals(_status, '200 OK')
+        self.assertFalse('Content-Encoding' in _headers)
+        self.assertTrue(_body.startswith('0008NAK\nPACK'))
+
+    def test_04_middleware_streams(self):
+        _closed = []
+        class _Body(object):
+            def __iter__(self):
+                for i in xrange(1000):
+                    yield '{"name": "file%s.txt", "type": "blob"},' % i
+            def close(self):
+                _closed.append(True)
+        def _app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return _Body()
+        _headers = {}
+        def _start_response(code, headers):
+            _headers.update(headers)
+        _response = response_compression.CompressionMiddleware(_app)(
+            {'HTTP_ACCEPT_ENCODING': 'deflate'}, _start_response)
+        _body = ''.join(_response)
+        _response.close()
+        self.assertEquals(_headers['Content-Encoding'], 'deflate')
+        self.assertFalse('Content-Length' in _headers)
+        self.assertEquals(zlib.decompress(_body), ''.join(_Body()))
+        self.assertTrue(len(_body) * 10 < len(zlib.decompress(_body)))
+        self.assertEquals(_closed, [True])
+
+    def test_05_middleware_empty_body(self):
+        _closed = []
+        class _Body(object):
+            def __init__(self, start_response, status):
+                self.start_response = start_response
+                self.status = status
+            def __iter__(self):
+                if self.status:
+                    self.start_response(self.status, [('Content-Type', 'text/plain')])
+                return iter([])
+            def close(self):
+                _closed.append(True)
+        _headers = {}
+        def _start_response(code, headers):
+            _headers['status'] = code
+        _app = lambda environ, start_response: _Body(start_response, '204 No Content')
+        _response = response_compression.CompressionMiddleware(_app)({}, _start_response)
+        self.assertEquals(list(_response), [])
+        self.assertEquals(_headers['status'], '204 No Content')
+        self.assertEquals(_closed, [True])
+
+        # the app never calls start_response.
+        _app = lambda environ, start_response: _Body(start_response, None)
+        self.assertRaises(RuntimeError,
+            response_compression.CompressionMiddleware(_app), {}, _start_response)
+        self.assertEquals(_closed, [True, True])
+
+class test_PostPush(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def test_01_coalesced(self):
+        import subprocess
+        _calls = []
+        _process = subprocess.Popen(['sleep', '0.3'])
+        def _hook(repo_path):
+            _calls.append((repo_path, _process.returncode))
+        def _broken(repo_path):
+            raise EnvironmentError('broken hook')
+        _q = post_push.PostPushQueue([_broken, _hook], delay = 0.1)
+        for i in range(3):
+            _q.schedule('a')
+        _q.schedule('b', _process)
+        self.assertTrue(_q.wait_idle(10))
+        self.assertEquals(sorted(_calls), [('a', None), ('b', 0)])
+        _s = _q.stats()
+        self.assertEquals((_s['scheduled'], _s['coalesced'], _s['runs'], _s['failures']), (4, 2, 2, 2))
+
+    def test_02_after_receive_pack(self):
+        _info_refs = os.path.join(self.repo_path, 'info', 'refs')
+        if os.path.exists(_info_refs):
+            os.remove(_info_refs)
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(
+            content_path = self.base_path, post_push_delay = 0)
+        _environ = {
+            'wsgi.version': (1,1),
+            'wsgi.errors': sys.stderr,
+            'REQUEST_METHOD': 'POST',
+            'wsgi.input': io.BytesIO('0000'),
+            'wsgiorg.routing_args': ([], {
+                'working_path': 'projects/demorepoone',
+                'git_command': 'git-receive-pack'
+                })
+            }
+        _status = []
+        _response = _h(_environ, lambda code, headers: _status.append(code))
+        ''.join(_response)
+        self.assertEquals(_status, ['200 OK'])
+        # nothing until the server is done with the response.
+        self.assertEquals(_h.post_push.stats()['scheduled'], 0)
+        _response.close()
+        self.assertTrue(_h.post_push.wait_idle(10))
+        self.assertTrue(os.path.isfile(_info_refs))
+        self.assertEquals(_h.post_push.stats()['failures'], 0)
+
+class test_Admission(unittest.TestCase):
+
+    def test_01_limits_and_queue(self):
+        _a = admission.Admission(max_total = 2, max_per_repo = 1,
+            class_limits = {'archive': 1}, max_queue = 1, max_wait = 10)
+        _t1 = _a.acquire('a', 'upload-pack')
+        _t2 = _a.acquire('b', 'archive')
+        _granted = []
+        def _wait():
+            _granted.append(_a.acquire('c', 'archive'))
+        _th = threading.Thread(target = _wait)
+        _th.start()
+        while not _a.stats()['queue_depth']:
+            time.sleep(0.01)
+        # queue of one is full
+        self.assertRaises(admission.AdmissionRefused, _a.acquire, 'd', 'upload-pack')
+        # frees a total slot, but 'c' waits for the archive one.
+        _t1.release()
+        _t1.release()
+        time.sleep(0.1)
+        self.assertEquals(_granted, [])
+        _t2.release()
+        _th.join(10)
+        self.assertEquals(len(_granted), 1)
+        _s = _a.stats()
+        self.assertEquals((_s['running'], _s['queue_depth'], _s['refused'], _s['queued']), (1, 0, 1, 1))
+        self.assertEquals(_s['per_class'], {'archive': 1})
+        self.assertTrue(_s['max_wait_seconds'] > 0)
+
+    def test_02_wait_times_out(self):
+        _a = admission.Admission(max_total = 1, max_wait = 0.2, retry_after = 7)
+        _t = _a.acquire('a', 'upload-pack')
+        try:
+            _a.acquire('b', 'upload-pack')
+            self.fail('Was not refused')
+        except admission.AdmissionRefused as e:
+            self.assertEquals(e.retry_after, 7)
+        self.assertEquals(_a.stats()['timed_out'], 1)
+        _t.release()
+        _a.acquire('b', 'upload-pack').release()
+        self.assertEquals(_a.stats()['running'], 0)
+
+    def test_03_busy_is_503(self):
+        _p = tempfile.mkdtemp()
+        try:
+            zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(_p)
+            _a = admission.Admission(max_total = 1, max_queue = 0)
+            _h = git_http_backend.GitHTTPBackendSmartHTTP(
+                content_path = os.path.join(_p, 'reposbase'), admission = _a)
+            def _request():
+                _environ = {
+                    'wsgi.version': (1,1),
+                    'wsgi.errors': io.BytesIO(),
+                    'REQUEST_METHOD': 'POST',
+                    'wsgi.input': io.BytesIO(
+                        '003ewant 3408e8f7720eff4a1fd16e9bf654332036c39bf8 no-progress\n00000009done\n'),
+                    'wsgiorg.routing_args': ([], {
+                        'working_path': 'projects/demorepoone',
+                        'git_command': 'git-upload-pack'
+                        })
+                    }
+                _status = []
+                _headers = {}
+                def _start_response(code, headers):
+                    _status.append(code)
+                    _headers.update(headers)
+                _response = _h(_environ, _start_response)
+                ''.join(_response)
+                if hasattr(_response, 'close'):
+                    _response.close()
+                return _status[0], _headers
+
+            _t = _a.acquire('elsewhere', 'archive')
+            _status, _headers = _request()
+            self.assertEquals(_status, '503 Service Unavailable')
+            self.assertEquals(_headers['Retry-After'], '10')
+            _t.release()
+            _status, _headers = _request()
+            self.assertEquals(_status, '200 OK')
+            self.assertEquals(_a.stats()['running'], 0)
+        finally:
+            shutil.rmtree(_p, True)
+
+class test_RequestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+        self.repo_path = os.path.join(self.base_path, 'projects', 'demorepoone')
+        self.logged = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def _request(self, handler, method, git_command, body = ''):
+        _status = []
+        _headers = {}
+        def _start_response(code, headers):
+            _status.append(code)
+            _headers.update(headers)
+        _environ = {
+            'wsgi.version': (1,1),
+            'wsgi.errors': sys.stderr,
+            'REQUEST_METHOD': method,
+            'PATH_INFO': '/projects/demorepoone/' + git_command,
+            'wsgi.input': io.BytesIO(body),
+            'wsgiorg.routing_args': ([], {
+                'working_path': 'projects/demorepoone',
+                'git_command': git_command
+                })
+            }
+        _app = request_trace.TraceMiddleware(handler, log = self.logged.append)
+        _response = _app(_environ, _start_response)
+        try:
+            _body = ''.join(_response)
+        finally:
+            _response.close()
+        return _status[0], _headers, _body
+
+    def test_01_command_name(self):
+        for _argv, _name in [
+                (['/usr/bin/git', 'upload-pack', '--stateless-rpc', '/r'], 'git-upload-pack'),
+                (['git', '--git-dir', '/r', 'update-server-info'], 'git-update-server-info'),
+                (['git', '-c', 'a=b', '--bare', 'cat-file', '--batch'], 'git-cat-file'),
+                ('git rev-list HEAD', 'git-rev-list'),
+                (['git', '--version'], 'git'),
+                (['/bin/true'], 'true')]:
+            self.assertEquals(request_trace.command_name(_argv), _name)
+        self.assertEquals(request_trace.start_span(['git', 'status']), None)
+
+    def test_02_git_execute(self):
+        import git
+        _repo = git.Repo(self.repo_path)
+        def _app(environ, start_response):
+            _heads = [_repo.git.rev_parse(_h) for _h in ('master', 'stable')]
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['\n'.join(_heads)]
+        _status, _headers, _body = self._request(_app, 'GET', 'heads')
+        self.assertTrue(_headers['Server-Timing'].startswith('git-rev-parse;desc="2 processes";dur='))
+        self.assertTrue(', app;dur=' in _headers['Server-Timing'])
+        self.assertEquals(len(self.logged), 1)
+        _log = self.logged[0]
+        self.assertEquals((_log['method'], _log['status'], _log['processes']), ('GET', '200', 2))
+        self.assertEquals([(_s['cmd'], _s['out'], _s['exit'], _s['finished']) for _s in _log['spans']],
+            [('git-rev-parse', 41, 0, True)] * 2)
+        self.assertEquals(_log['spans'][0]['argv'][-1], 'master')
+        # the trace ends with the request
+        self.assertEquals(request_trace.current(), None)
+
+    def test_03_chunker(self):
+        _body = '003ewant 3408e8f7720eff4a1fd16e9bf654332036c39bf8 no-progress\n00000009done\n'
+        _h = git_http_backend.GitHTTPBackendSmartHTTP(content_path = self.base_path)
+        _status, _headers, _response = self._request(_h, 'POST', 'git-upload-pack', _body)
+        self.assertEquals(_status, '200 OK')
+        self.assertTrue(_headers['Server-Timing'].startswith('git-upload-pack;desc="1 process";dur='))
+        _span = self.logged[0]['spans'][0]
+        self.assertEquals(_span['cmd'], 'git-upload-pack')
+        self.assertEquals((_span['in'], _span['out'], _span['exit']), (len(_body), len(_response), 0))
+
+        _h = git_http_backend.GitHTTPBackendInfoRefs(content_path = self.base_path)
+        _status, _headers, _response = self._request(_h, 'GET', 'git-upload-pack')
+        _span = self.logged[1]['spans'][0]
+        self.assertEquals((_span['in'], _span['exit']), (0, 0))
+        self.assertTrue(_span['out'] > 0)
+        self.assertTrue('--advertise-refs' in _span['argv'])
+
+    def test_04_failed_process(self):
+        import subprocessio
+        _trace = request_trace.begin('GET', '/')
+        try:
+            self.assertRaises(EnvironmentError, subprocessio.SubprocessIOChunker,
+                ['git', '--git-dir', os.path.join(self.temp_path, 'nothere'), 'rev-parse', 'HEAD'])
+        finally:
+            request_trace.end()
+        _span = _trace.as_dict()['spans'][0]
+        self.assertEquals((_span['cmd'], _span['finished'], _span['out']), ('git-rev-parse', True, 0))
+        self.assertNotEquals(_span['exit'], 0)
+
+class test_Metrics(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(self.temp_path)
+        self.base_path = os.path.join(self.temp_path, 'reposbase')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, True)
+
+    def test_01_sharded(self):
+        _m = metrics.Metrics()
+        _m.describe('hits_total', 'counter', 'Hits.')
+        _m.describe('wait_seconds', 'histogram', 'Waits.', [0.1, 1])
+        def _count():
+            for i in xrange(1000):
+                _m.inc('hits_total', (('kind', 'a'),))
+            _m.observe('wait_seconds', (), 0.5)
+        _threads = [threading.Thread(target = _count) for i in xrange(4)]
+        for _t in _threads:
+            _t.start()
+        for _t in _threads:
+            _t.join()
+        _m.inc('hits_total', (('kind', 'b'),), 2)
+        _m.observe('wait_seconds', (), 0.1)
+        _m.observe('wait_seconds', (), 5)
+        _counters, _histograms = _m.values()
+        self.assertEquals(_counters[('hits_total', (('kind', 'a'),))], 4000)
+        # shards of the threads, gone, are folded into one.
+        self.assertEquals(len(_m._shards), 1)
+        self.assertEquals(_m.values()[0][('hits_total', (('kind', 'a'),))], 4000)
+        _text = _m.render()
+        for _line in [
+                '# TYPE hits_total counter',
+                'hits_total{kind="a"} 4000',
+                'hits_total{kind="b"} 2',
+                '# TYPE wait_seconds histogram',
+                'wait_seconds_bucket{le="0.1"} 1',
+                'wait_seconds_bucket{le="1.0"} 5',
+                'wait_seconds_bucket{le="+Inf"} 6',
+                'wait_seconds_sum 7.1',
+                'wait_seconds_count 6']:
+            self.assertTrue(_line in _text.splitlines(), _line)
+
+    def test_02_requests_and_processes(self):
+        _m = metrics.Metrics()
+        _h = metrics.MetricsMiddleware(metrics.route('git-rpc',
+            git_http_backend.GitHTTPBackendSmartHTTP(content_path = self.base_path)), _m)
+        _started = metrics.registry.values()[0].get(
+            ('ges_processes_started_total', (('cmd', 'git-upload-pack'),)), 0)
+        _environ = {
+            'wsgi.version': (1,1),
+            'wsgi.errors': sys.stderr,
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/projects/demorepoone/git-upload-pack',
+            'wsgi.input': io.BytesIO(
+                '003ewant 3408e8f7720eff4a1fd16e9bf654332036c39bf8 no-progress\n00000009done\n'),
+            'wsgiorg.routing_args': ([], {
+                'working_path': 'projects/demorepoone',
+                'git_command': 'git-upload-pack'
+                })
+            }
+        _response = _h(_environ, lambda code, headers: None)
+        self.assertEquals(metrics.live_processes()[(('cmd', 'git-upload-pack'),)], 1)
+        _body = ''.join(_response)
+        _response.close()
+        self.assertEquals(metrics.live_processes()[(('cmd', 'git-upload-pack'),)], 0)
+        self.assertEquals(metrics.registry.values()[0][
+            ('ges_processes_started_total', (('cmd', 'git-upload-pack'),))], _started + 1)
+
+        _counters, _histograms = _m.values()
+        self.assertEquals(_counters[('ges_requests_total',
+            (('route', 'git-rpc'), ('method', 'POST'), ('status', '200')))], 1)
+        self.assertEquals(_counters[('ges_response_bytes_total', (('route', 'git-rpc'),))], len(_body))
+        self.assertEquals(sum(_histograms[('ges_request_duration_seconds', (('route', 'git-rpc'),))][:-1]), 1)
+
+        _status = []
+        _text = ''.join(metrics.MetricsApp(_m)({'REQUEST_METHOD': 'GET'},
+            lambda code, headers: _status.append((code, dict(headers)))))
+        self.assertEquals(_status[0][1]['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertTrue('ges_response_bytes_total{route="git-rpc"} %s' % len(_body) in _text)
+
+    def test_03_gauges(self):
+        import subprocessio
+        import wsgiserver
+        _before = subprocessio.buffer_stats()
+        _c = subprocessio.SubprocessIOChunker(['git', 'version'])
+        _c.output.done_reading_event.wait(10)
+        _s = subprocessio.buffer_stats()
+        self.assertEquals(_s['chunkers'], _before['chunkers'] + 1)
+        self.assertTrue(_s['memory_bytes'] > _before['memory_bytes'])
+        _c.close()
+        self.assertEquals(subprocessio.buffer_stats()['chunkers'], _before['chunkers'])
+
+        _m = metrics.Metrics()
+        _pool = wsgiserver.ThreadPool(None, min = 0)
+        _pool.put(object())
+        _m.watch_thread_pool(_pool)
+        class _Cache(object):
+            def stats(self):
+                return {'hits': {'blob': 2, 'tree': 1}, 'misses': {'blob': 1}}
+        _m.watch_caches({'object': _Cache()})
+        _text = _m.render().splitlines()
+        for _line in [
+                'ges_server_threads{state="busy"} 0',
+                'ges_server_threads_queue 1',
+                'ges_cache_hits_total{cache="object"} 3',
+                'ges_cache_hit_ratio{cache="object"} 0.75']:
+            self.assertTrue(_line in _text, _line)
+
+class test_OnClose(unittest.TestCase):
+
+    def test_01_callback_once_and_attributes(self):
+        _calls = []
+        class _Response(object):
+            closed = False
+            def __iter__(self):
+                return iter(['a', 'b'])
+            def close(self):
+                self.closed = True
+            def splice_source(self):
+                return 'spliced'
+        _r = _Response()
+        # wrappers stack, as admission, trace and metrics do in ges.
+        _w = on_close.OnClose(on_close.OnClose(_r, lambda: _calls.append('inner')), lambda: _calls.append('outer'))
+        self.assertEquals(list(_w), ['a', 'b'])
+        self.assertEquals(_w.splice_source(), 'spliced')
+        _w.close()
+        _w.close()
+        self.assertTrue(_r.closed)
+        self.assertEquals(_calls, ['inner', 'outer'])
+        self.assertFalse(hasattr(on_close.OnClose(['a'], None), 'splice_source'))
+
+def suite():
+    return  unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(test_PackCache),
+            unittest.TestLoader().loadTestsFromTestCase(test_InfoRefs),
+            unittest.TestLoader().loadTestsFromTestCase(test_GzipRequest),
+            unittest.TestLoader().loadTestsFromTestCase(test_ResponseCompression),
+            unittest.TestLoader().loadTestsFromTestCase(test_PostPush),
+            unittest.TestLoader().loadTestsFromTestCase(test_Admission),
+            unittest.TestLoader().loadTestsFromTestCase(test_RequestTrace),
+            unittest.TestLoader().loadTestsFromTestCase(test_Metrics),
+            unittest.TestLoader().loadTestsFromTestCase(test_OnClose),
+        ])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run( suite() )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import unittest
+import tempfile
+import shutil
+import zipfile
+import subprocess
+import time
+
+import repo_index
+
+class test_RepoIndex(unittest.TestCase):
+
+    def setUp(self):
+        _p = tempfile.mkdtemp()
+        zipfile.ZipFile('./test/sample_tree_of_repos_v2.zip').extractall(_p)
+        self.base_path = os.path.join(_p, 'reposbase')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.split(self.base_path)[0], True)
+
+    def test_01_find_repo_in_path(self):
+        _i = repo_index.RepoIndex(self.base_path, watch = None)
+        self.assertEquals(
+            _i.find_repo_in_path('projects/demorepoone/master/firstdoc.txt'),
+            (os.path.join(self.base_path, 'projects', 'demorepoone'), 'master/firstdoc.txt')
+            )
+        self.assertEquals(_i.find_repo_in_path('projects'), (None, ''))
+        self.assertEquals(_i.find_repo_in_path('projects/nosuchfolder/a'), (None, 'nosuchfolder/a'))
+        self.assertEquals(
+            _i.list_dir(self.base_path),
+            [('projects', False), ('teams', False), ('users', False)]
+            )
+        self.assertTrue(('demorepoone', True) in _i.list_dir(os.path.join(self.base_path, 'projects')))
+
+    def test_02_new_repo_found_without_watcher(self):
+        _i = repo_index.RepoIndex(self.base_path, watch = None)
+        _r = os.path.join(self.base_path, 'projects', 'newrepo')
+        subprocess.call(['git', 'init', '--quiet', '--bare', _r])
+        # not in index yet, but a miss is checked on disk.
+        self.assertEquals(_i.find_repo_in_path('projects/newrepo/master'), (_r, 'master'))
+        self.assertTrue(('newrepo', True) in _i.list_dir(os.path.join(self.base_path, 'projects')))
+
+    def test_03_watcher(self):
+        if not repo_index._get_watcher():
+            return
+        _i = repo_index.RepoIndex(self.base_path)
+        _r = os.path.join(self.base_path, 'teams', 'newrepo')
+        subprocess.call(['git', 'init', '--quiet', '--bare', _r])
+        _t = time.time() + 5
+        # folder shows up first, its contents a moment later.
+        while not getattr(_i._nodes.get(_r), 'is_repo', False) and time.time() < _t:
+            time.sleep(0.05)
+        self.assertTrue(_i._nodes[_r].is_repo)
+        shutil.rmtree(_r)
+        _t = time.time() + 5
+        while _r in _i._nodes and time.time() < _t:
+            time.sleep(0.05)
+        self.assertFalse(_r in _i._nodes)
+
+    def test_04_no_watcher_on_import(self):
+        # fresh process, as other tests start the watcher in this one.
+        _code = 'import threading, repo_index; ' \
+            'repo_index.RepoIndex(%r, watch = "rescan", rescan_interval = 3600); ' \
+            'print repo_index._watcher_started, threading.active_count()' % self.base_path
+        _out = subprocess.Popen(
+            [sys.executable, '-c', _code],
+            cwd = os.path.abspath(os.path.join(os.path.dirname(repo_index.__file__))),
+            stdout = subprocess.PIPE
+            ).communicate()[0]
+        # main thread plus the rescanner.
+        self.assertEquals(_out.split(), ['False', '2'])
+
+    def test_05_sibling_with_same_prefix(self):
+        _i = repo_index.RepoIndex(self.base_path, watch = None)
+        _sibling = self.base_path + '2'
+        subprocess.call(['git', 'init', '--quiet', '--bare', os.path.join(_sibling, 'stray')])
+        _i.refresh(_sibling)
+        self.assertFalse(_sibling in _i._nodes)
+        self.assertEquals(_i.get(os.path.join(_sibling, 'stray')), None)
+        self.assertFalse(os.path.join(_sibling, 'stray') in _i._nodes)
+        shutil.rmtree(_sibling, True)
+
+def suite():
+    return  unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(test_RepoIndex),
+        ])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run( suite() )
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2010  Daniel Dotsenko <dotsa (a) hotmail com>
+
+This file is part of Git Enablement Server Project.
+
+Git Enablement Server Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Git Enablement Server Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Git Enablement Server Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os.path
+import os
+import sys
+
+if '__file__' in dir():
+    tfpath, trash = os.path.split(__file__)
+    sys.path.append( os.path.abspath(tfpath + os.path.sep + '..') )
+
+import io
+import unittest
+import threading
+import subprocess
+import time
+import socket
+import httplib
+
+import subprocessio
+import spawner
+import wsgiserver
+from wsgiserver import wsgiserver2
+
+_python = sys.executable
+
+class test_SubprocessIOChunker(unittest.TestCase):
+
+    def setUp(self):
+        self.use_io_loop = subprocessio.use_io_loop
+
+    def tearDown(self):
+        subprocessio.use_io_loop = self.use_io_loop
+
+    def _echo(self, inputstream):
+        return subprocessio.SubprocessIOChunker(
+            [_python, '-c', 'import sys, shutil; shutil.copyfileobj(sys.stdin, sys.stdout)'],
+            inputstream = inputstream,
+            buffer_size = 16384
+            )
+
+    def test_01_output_larger_than_buffer(self):
+        for _use_loop in [True, False]:
+            subprocessio.use_io_loop = _use_loop
+            _c = subprocessio.SubprocessIOChunker(
+                [_python, '-c', 'import sys; sys.stdout.write("x" * 1000000)'],
+                buffer_size = 16384
+                )
+            self.assertEquals(isinstance(_c.output.worker, subprocessio.PipeReader), _use_loop)
+            self.assertEquals(len(''.join(_c)), 1000000)
+            _c.close()
+
+    def test_02_input(self):
+        _data = ''.join([chr(i % 256) for i in xrange(300000)])
+        for _source in [_data, io.BytesIO(_data)]:
+            _c = self._echo(_source)
+            self.assertEquals(''.join(_c), _data)
+            _c.close()
+
+    def test_03_errors(self):
+        self.assertRaises(
+            EnvironmentError,
+            subprocessio.SubprocessIOChunker,
+            [_python, '-c', 'import sys; sys.stderr.write("bad"); sys.exit(1)']
+            )
+
+    def test_05_stderr_tail(self):
+        _cmd = [_python, '-c', 'import sys; sys.stderr.write("x" * 1000000 + "THE END"); sys.exit(1)']
+        for _use_loop in [True, False]:
+            subprocessio.use_io_loop = _use_loop
+            try:
+                subprocessio.SubprocessIOChunker(_cmd, error_tail_size = 1000)
+                self.fail('Error was not detected.')
+            except EnvironmentError as e:
+                # only the tail is kept.
+                self.assertTrue(len(str(e)) < 1100)
+                self.assertTrue(str(e).endswith('THE END'))
+
+            _p = subprocess.Popen(_cmd, stderr = subprocess.PIPE)
+            _tail = subprocessio.StreamTail(_p.stderr, 1000)
+            self.assertEquals(_tail.tail(wait = True), 'x' * 993 + 'THE END')
+            self.assertEquals(_tail.bytes_seen, 1000007)
+            # read in blocks, not bytes.
+            self.assertTrue(len(_tail.data.chunks) <= 2)
+            _p.wait()
+
+    def test_07_stderr_is_not_an_error(self):
+        # says something on stderr before any output, exits with 0.
+        _cmd = [_python, '-c', 'import sys, time; sys.stderr.write("warning"); sys.stderr.flush(); time.sleep(0.2); sys.stdout.write("out")']
+        for _use_loop in [True, False]:
+            subprocessio.use_io_loop = _use_loop
+            _c = subprocessio.SubprocessIOChunker(_cmd)
+            self.assertEquals(''.join(_c), 'out')
+            self.assertEquals(_c.error.tail(wait = True), 'warning')
+            _c.close()
+
+    def test_08_file_input_with_output_paused(self):
+        _data = ''.join([chr(i % 251) for i in xrange(2000000)])
+        for _use_loop in [True, False]:
+            subprocessio.use_io_loop = _use_loop
+            _c = subprocessio.SubprocessIOChunker(
+                [_python, '-c', 'import sys, shutil; shutil.copyfileobj(sys.stdin, sys.stdout)'],
+                inputstream = io.BytesIO(_data),
+                buffer_size = 16384,
+                spill = False
+                )
+            time.sleep(0.5)
+            # nobody reads. Output stops at the buffer, input at the pipes.
+            self.assertEquals(_c.process.poll(), None)
+            self.assertTrue(_c.output.length <= 16384 + 65536)
+            self.assertTrue(_c.input_streamer.written < len(_data))
+            self.assertEquals(''.join(_c), _data)
+            self.assertEquals(_c._bytes_fed(), len(_data))
+            _c.close()
+
+        # exits without reading its input. The feeder is not left stuck.
+        _c = subprocessio.SubprocessIOChunker(
+            [_python, '-c', 'import sys; sys.stdout.write("done")'],
+            inputstream = io.BytesIO(_data)
+            )
+        self.assertEquals(''.join(_c), 'done')
+        _c.input_streamer.join(5)
+        self.assertFalse(_c.input_streamer.is_alive())
+        _c.close()
+
+    def test_09_spill_limit(self):
+        _cmd = [_python, '-c', 'import sys; sys.stdout.write("".join([chr(i % 256) for i in xrange(1000000)]))']
+        _expected = ''.join([chr(i % 256) for i in xrange(1000000)])
+        _max_spill_bytes = subprocessio.max_spill_bytes
+        subprocessio.max_spill_bytes = 100000
+        try:
+            for _use_loop in [True, False]:
+                subprocessio.use_io_loop = _use_loop
+                _c = subprocessio.SubprocessIOChunker(_cmd, buffer_size = 16384, spill = True)
+                time.sleep(0.5)
+                # spilled up to the limit, then paused.
+                self.assertEquals(_c.process.poll(), None)
+                self.assertTrue(_c.output.reading_paused)
+                self.assertTrue(100000 <= _c.output.data.spilled_bytes <= 100000 + 4096)
+                self.assertEquals(''.join(_c), _expected)
+                _c.close()
+        finally:
+            subprocessio.max_spill_bytes = _max_spill_bytes
+
+    def test_04_threads_do_not_grow_with_subprocesses(self):
+        subprocessio.get_loop()
+        _threads = threading.active_count()
+        _chunkers = [self._echo('abc' * 10000) for i in range(20)]
+        self.assertEquals(threading.active_count(), _threads)
+        for _c in _chunkers:
+            self.assertEquals(''.join(_c), 'abc' * 10000)
+            _c.close()
+
+    def test_10_small_file_input_needs_no_thread(self):
+        subprocessio.get_loop()
+        _threads = threading.active_count()
+        _chunkers = [self._echo(io.BytesIO('abc' * 10000)) for i in range(20)]
+        _chunkers.append(self._echo(io.BytesIO('')))
+        # threads of earlier tests may still be ending.
+        self.assertTrue(threading.active_count() <= _threads)
+        for _c in _chunkers:
+            self.assertEquals(_c.input_streamer, None)
+        self.assertEquals(''.join(_chunkers.pop()), '')
+        for _c in _chunkers:
+            self.assertEquals(''.join(_c), 'abc' * 10000)
+            self.assertEquals(_c._bytes_fed(), 30000)
+            _c.close()
+
+        # past the limit, a thread copies the rest, after what was read.
+        _max_inline_input_bytes = subprocessio.max_inline_input_bytes
+        subprocessio.max_inline_input_bytes = 1000
+        try:
+            _data = ''.join([chr(i % 251) for i in xrange(300000)])
+            _c = self._echo(io.BytesIO(_data))
+            self.assertNotEquals(_c.input_streamer, None)
+            self.assertEquals(''.join(_c), _data)
+            _c.close()
+        finally:
+            subprocessio.max_inline_input_bytes = _max_inline_input_bytes
+
+    def test_11_peeked_reader(self):
+        _r = subprocessio.PeekedReader(io.BytesIO('abcdef'), 3)
+        self.assertEquals((_r.complete, _r.head), (False, 'abcd'))
+        self.assertEquals(_r.read(2), 'ab')
+        self.assertEquals(_r.read(), 'cdef')
+        _r = subprocessio.PeekedReader(io.BytesIO('abc'), 3)
+        self.assertEquals((_r.complete, _r.head), (True, 'abc'))
+
+    def test_06_slow_consumer(self):
+        _cmd = [_python, '-c', 'import sys; sys.stdout.write("".join([chr(i % 256) for i in xrange(1000000)]))']
+        _expected = ''.join([chr(i % 256) for i in xrange(1000000)])
+        for _use_loop in [True, False]:
+            subprocessio.use_io_loop = _use_loop
+            _c = subprocessio.SubprocessIOChunker(_cmd, buffer_size = 16384, spill = True)
+            # finishes while nobody reads. Output waits for us on disk.
+            _c.process.wait()
+            self.assertTrue(_c.output.data.memory_bytes <= 16384)
+            self.assertEquals(''.join(_c), _expected)
+            _c.close()
+
+            _c = subprocessio.SubprocessIOChunker(_cmd, buffer_size = 16384, spill = False)
+            time.sleep(0.5)
+            # stalled, waiting for us.
+            self.assertEquals(_c.process.poll(), None)
+            self.assertEquals(''.join(_c), _expected)
+            _c.close()
+
+class test_Splice(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join([chr(i % 251) for i in xrange(3000000)])
+        _s = socket.socket()
+        _s.bind(('127.0.0.1', 0))
+        self.port = _s.getsockname()[1]
+        _s.close()
+        # written piecemeal, like git does, so that we get to splice most of it.
+        _cmd = [_python, '-c', '\n'.join([
+            'import sys, time',
+            'data = "".join([chr(i % 251) for i in xrange(3000000)])',
+            'for i in xrange(0, 3000000, 300000): time.sleep(0.02); sys.stdout.write(data[i:i + 300000]); sys.stdout.flush()'
+            ])]
+        self.chunkers = []
+        def _app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            if environ['PATH_INFO'] == '/spill':
+                # like git's RPC responses in git_http_backend.
+                self.chunkers.append(subprocessio.SubprocessIOChunker(
+                    [_python, '-c', 'import sys; sys.stdout.write("x" * 30000000)'],
+                    spill = True
+                    ))
+                return self.chunkers[-1]
+            return subprocessio.SubprocessIOChunker(_cmd)
+        self.server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', self.port), _app)
+        self.spliced = []
+        self._splice = wsgiserver2.splice_pipe_to_socket
+        def _counting_splice(*args):
+            self.spliced.append(self._splice(*args))
+            return self.spliced[-1]
+        wsgiserver2.splice_pipe_to_socket = _counting_splice
+        _t = threading.Thread(target = self.server.start)
+        _t.daemon = True
+        _t.start()
+        while not self.server.ready:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        wsgiserver2.splice_pipe_to_socket = self._splice
+        self.server.stop()
+
+    def test_01_chunked(self):
+        if wsgiserver2._splice is None:
+            raise unittest.SkipTest('No splice() on this platform.')
+        _c = httplib.HTTPConnection('127.0.0.1', self.port)
+        for i in range(2):
+            # keep-alive. Response must end exactly where it should.
+            _c.request('GET', '/')
+            _r = _c.getresponse()
+            self.assertEquals(_r.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEquals(_r.read(), self.data)
+        _c.close()
+        self.assertEquals(len(self.spliced), 2)
+        # the first chunks were read by the chunker itself.
+        self.assertTrue(0 < self.spliced[0] < len(self.data))
+
+    def test_02_http_1_0(self):
+        if wsgiserver2._splice is None:
+            raise unittest.SkipTest('No splice() on this platform.')
+        _s = socket.create_connection(('127.0.0.1', self.port))
+        _s.sendall('GET / HTTP/1.0\r\n\r\n')
+        _f = _s.makefile('rb')
+        _response = _f.read()
+        _s.close()
+        self.assertEquals(_response.split('\r\n\r\n', 1)[1], self.data)
+        self.assertEquals(len(self.spliced), 1)
+
+    def test_03_spilled_output_is_not_spliced(self):
+        _s = socket.socket()
+        _s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        _s.connect(('127.0.0.1', self.port))
+        _s.sendall('GET /spill HTTP/1.0\r\n\r\n')
+        # client reads nothing for now. The subprocess finishes anyway.
+        _t = time.time() + 10
+        while not (self.chunkers and self.chunkers[0].process.poll() is not None) and time.time() < _t:
+            time.sleep(0.05)
+        self.assertEquals(self.chunkers[0].process.poll(), 0)
+        self.assertTrue(self.chunkers[0].output.data.spilled_bytes > 0)
+        _f = _s.makefile('rb')
+        _response = _f.read()
+        _s.close()
+        self.assertEquals(len(_response.split('\r\n\r\n', 1)[1]), 30000000)
+        self.assertEquals(self.spliced, [])
+
+class test_Spawner(unittest.TestCase):
+
+    def setUp(self):
+        self.assertTrue(spawner.start())
+
+    def tearDown(self):
+        spawner.stop()
+
+    def test_01_popen(self):
+        _p = spawner.popen([_python, '-c',
+                'import sys; sys.stdout.write(sys.stdin.read()); sys.stderr.write("err"); sys.exit(3)'],
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        self.assertTrue(isinstance(_p, spawner.SpawnedProcess))
+        _p.stdin.write('hello')
+        _p.stdin.close()
+        self.assertEquals(_p.stdout.read(), 'hello')
+        self.assertEquals(_p.stderr.read(), 'err')
+        self.assertEquals(_p.wait(), 3)
+
+        _p = spawner.popen(['sleep', '30'])
+        self.assertEquals(_p.poll(), None)
+        _p.terminate()
+        self.assertEquals(_p.wait(), -15)
+        # reaped. Signals are not sent any more.
+        _p.kill()
+
+        _r, _w = os.pipe()
+        _p = spawner.popen('echo $GES_TEST; pwd', shell = True, stdout = _w,
+            env = {'GES_TEST': 'x', 'PATH': os.environ['PATH']}, cwd = '/')
+        os.close(_w)
+        self.assertEquals(os.fdopen(_r).read(), 'x\n/\n')
+        self.assertEquals(_p.wait(), 0)
+
+        self.assertRaises(OSError, spawner.popen, ['/no/such/command'])
+
+    def test_02_chunker(self):
+        _data = ''.join([chr(i % 251) for i in xrange(1000000)])
+        _c = subprocessio.SubprocessIOChunker(['cat'], inputstream = _data)
+        self.assertTrue(isinstance(_c.process, spawner.SpawnedProcess))
+        self.assertEquals(''.join(_c), _data)
+        self.assertEquals(_c.process.wait(), 0)
+        _c.close()
+
+        try:
+            subprocessio.SubprocessIOChunker([_python, '-c', 'import sys; sys.stderr.write("boom"); sys.exit(1)'])
+            self.fail('Error was not raised')
+        except EnvironmentError as e:
+            self.assertTrue('boom' in str(e))
+
+    def test_03_fallback(self):
+        spawner._spawner.helper.kill()
+        spawner._spawner.helper.wait()
+        _p = spawner.popen(['true'])
+        self.assertTrue(isinstance(_p, subprocess.Popen))
+        self.assertEquals(_p.wait(), 0)
+
+def suite():
+    return  unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(test_SubprocessIOChunker),
+            unittest.TestLoader().loadTestsFromTestCase(test_Splice),
+            unittest.TestLoader().loadTestsFromTestCase(test_Spawner),
+        ])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run( suite() )
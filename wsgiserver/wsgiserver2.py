@@ -955,6 +955,88 @@ class FatalSSLAlert(Exception):
     pass
 
 
+def _load_splice():
+    """Return libc's splice() (Linux only) as a ctypes function, or None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        splice = libc.splice
+    except (ImportError, OSError, AttributeError):
+        return None
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+    return splice
+
+_splice = _load_splice()
+SPLICE_F_MOVE, SPLICE_F_NONBLOCK, SPLICE_F_MORE = 1, 2, 4
+SPLICE_MAX = 1024 * 1024
+
+if _splice is not None:
+    import array
+    import ctypes
+    import fcntl
+    import select
+    import termios
+
+
+def _wait_for(fd, event, timeout):
+    """Poll fd for event. timeout in seconds, None = forever."""
+    p = select.poll()
+    p.register(fd, event)
+    while True:
+        try:
+            if p.poll(None if timeout is None else int(timeout * 1000)):
+                return
+            raise socket.timeout("timed out")
+        except select.error, e:
+            if e.args[0] not in socket_error_eintr:
+                raise
+
+
+def splice_pipe_to_socket(pipe_fd, sock, chunked=False, counter=None):
+    """Move everything from pipe_fd (till EOF) to sock, in the kernel.
+
+    The data never enters user space. With chunked=True, it is framed in
+    chunked transfer-coding. Chunk sizes are taken from what the pipe has
+    (FIONREAD) at the time. Returns the number of bytes moved.
+    """
+    sock_fd = sock.fileno()
+    timeout = sock.gettimeout()
+    available = array.array('i', [0])
+    total = 0
+    while True:
+        _wait_for(pipe_fd, select.POLLIN, None)
+        fcntl.ioctl(pipe_fd, termios.FIONREAD, available, True)
+        left = available[0]
+        if not left:
+            # readable, with nothing in it, is EOF.
+            return total
+        if chunked:
+            sock.sendall(hex(left)[2:] + CRLF)
+        while left:
+            moved = _splice(pipe_fd, None, sock_fd, None, min(left, SPLICE_MAX),
+                            SPLICE_F_MOVE | SPLICE_F_MORE | SPLICE_F_NONBLOCK)
+            if moved < 0:
+                err = ctypes.get_errno()
+                if err in socket_errors_nonblocking:
+                    _wait_for(sock_fd, select.POLLOUT, timeout)
+                    continue
+                if err in socket_error_eintr:
+                    continue
+                raise socket.error(err, os.strerror(err))
+            if moved == 0:
+                raise socket.error(errno.EPIPE, "Pipe ended short of its FIONREAD count.")
+            left -= moved
+            total += moved
+            if counter is not None:
+                counter.bytes_written += moved
+        if chunked:
+            sock.sendall(CRLF)
+
+
 class CP_fileobject(socket._fileobject):
     """Faux file object attached to a socket object."""
 
@@ -1488,6 +1570,11 @@ class ThreadPool(object):
         return len([t for t in self._threads if t.conn is None])
     idle = property(_get_idle, doc=_get_idle.__doc__)
 
+    def _get_qsize(self):
+        """Number of connections waiting for a worker thread. Read-only."""
+        return self._queue.qsize()
+    qsize = property(_get_qsize, doc=_get_qsize.__doc__)
+
     def put(self, obj):
         self._queue.put(obj)
         if obj is _SHUTDOWNREQUEST:
@@ -2108,6 +2195,10 @@ class CherryPyWSGIServer(HTTPServer):
 class WSGIGateway(Gateway):
     """A base class to interface HTTPServer with WSGI."""
 
+    use_splice = True
+    """If True (and on Linux), responses offering a pipe (splice_source())
+    are moved from the pipe to the socket by the kernel. See splice_response."""
+
     def __init__(self, req):
         self.req = req
         self.started_response = False
@@ -2122,6 +2213,8 @@ class WSGIGateway(Gateway):
         """Process the current request."""
         response = self.req.server.wsgi_app(self.env, self.start_response)
         try:
+            if self.use_splice and self.splice_response(response):
+                return
             for chunk in response:
                 # "The start_response callable must not actually transmit
                 # the response headers. Instead, it must store them for the
@@ -2137,6 +2230,38 @@ class WSGIGateway(Gateway):
             if hasattr(response, "close"):
                 response.close()
 
+    def splice_response(self, response):
+        """Send the response with splice(), if it allows. Return True if done.
+
+        The response must have splice_source() returning (chunks, pipe fd)
+        or None, and splice_finished(), called with the number of bytes
+        moved once the pipe is drained (see subprocessio.SubprocessIOChunker). Plain sockets and
+        identity-encoded bodies of unknown length only.
+        """
+        req = self.req
+        if (_splice is None or req.server.ssl_adapter is not None
+            or self.remaining_bytes_out is not None
+            or not hasattr(response, 'splice_source')
+            or not isinstance(req.conn.socket, socket.socket)):
+            return False
+        for k, v in req.outheaders:
+            if k.lower() == 'content-encoding' and v.lower() != 'identity':
+                return False
+        source = response.splice_source()
+        if source is None:
+            return False
+        chunks, pipe_fd = source
+        for chunk in chunks:
+            if chunk:
+                self.write(chunk)
+        if not req.sent_headers:
+            req.sent_headers = True
+            req.send_headers()
+        moved = splice_pipe_to_socket(pipe_fd, req.conn.socket,
+                                      req.chunked_write, req.conn.wfile)
+        response.splice_finished(moved)
+        return True
+
     def start_response(self, status, headers, exc_info = None):
         """WSGI callable to begin the HTTP response."""
         # "The application may call start_response more than once,
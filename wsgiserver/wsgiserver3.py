@@ -1222,6 +1222,11 @@ class ThreadPool(object):
         return len([t for t in self._threads if t.conn is None])
     idle = property(_get_idle, doc=_get_idle.__doc__)
 
+    def _get_qsize(self):
+        """Number of connections waiting for a worker thread. Read-only."""
+        return self._queue.qsize()
+    qsize = property(_get_qsize, doc=_get_qsize.__doc__)
+
     def put(self, obj):
         self._queue.put(obj)
         if obj is _SHUTDOWNREQUEST: